@@ -11,6 +11,8 @@ from auth.interface import AuthInterface
 from config.config import config
 from config.auth import AuthProvider
 
+from common.tracing import start_span
+
 from auth.no_auth_provider import NoAuthProvider
 from auth.simple_auth_provider import SimpleAuthProvider
 from auth.redis_auth_provider import RedisAuthProvider
@@ -46,16 +48,27 @@ class AuthProviderManager:
         self.provider = provider()
 
     async def get_key_permission(self, request: Request):
-        test_key = get_test_key(request)
-        return await self.provider.get_permission(test_key)
+        # Memoized per request, since routes check the key after its depends
+        permission = getattr(request.state, "auth_permission", None)
+        if permission is None:
+            test_key = get_test_key(request)
+            permission = await self.provider.get_permission(test_key)
+            request.state.auth_permission = permission
+
+        return permission
 
     def require_permission(self, *roles):
-        async def internal_require_permission(authorization: SecretStr = Header(None)):  # noqa: B008
+        async def internal_require_permission(
+            request: Request,
+            authorization: SecretStr = Header(None),  # noqa: B008
+        ):
             if not authorization:
                 raise HTTPException(401, "Please provide an API key")
 
-            test_key = get_test_key(authorization)
-            if not await self.provider.authenticate(test_key, *roles):
+            with start_span("auth"):
+                permission = await self.get_key_permission(request)
+
+            if permission not in roles:
                 raise HTTPException(401, "invalid API key")
 
         return internal_require_permission
@@ -0,0 +1,211 @@
+"""
+Per-key rate limits on requests, prompt tokens and generated tokens.
+
+Each limit is a token bucket that holds a minute of budget and refills
+continuously. Token usage is only known after a generation, so requests are
+admitted while the token buckets aren't empty and charged once they finish.
+A long generation can leave its key in debt until the bucket refills.
+"""
+
+import math
+import time
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from loguru import logger
+
+from auth import AuthManager
+from auth.utils import get_key_id
+from common.networking import handle_request_error
+from common.optional_dependencies import dependencies
+from config.auth import PermissionRateLimits
+from config.config import config
+
+if dependencies.redis:
+    from auth.redis_auth_provider import create_redis_client
+
+# Full buckets are the same as missing ones, so they're dropped once there
+# are this many buckets
+MIN_BUCKETS_TO_PRUNE = 10000
+
+# Refills a Redis bucket and takes cost if it holds at least the minimum.
+# Returns the seconds until the minimum is available, or 0 if taken.
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local minimum = tonumber(ARGV[3])
+local rate = capacity / 60
+
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local state = redis.call("HMGET", KEYS[1], "level", "updated")
+local level = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+level = math.min(capacity, level + (now - updated) * rate)
+
+if minimum and level < minimum then
+    return tostring((minimum - level) / rate)
+end
+
+level = level - cost
+redis.call("HSET", KEYS[1], "level", tostring(level), "updated", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil((capacity - level) / rate) + 1)
+
+return "0"
+"""
+
+
+class RateLimiterClass:
+    """Class to manage the rate limit buckets global state"""
+
+    def __init__(self):
+        # Bucket key -> (level, last refill time)
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._prune_at = MIN_BUCKETS_TO_PRUNE
+        self._redis = None
+        self._take_script = None
+
+    def _take_local(
+        self, key: str, capacity: int, cost: float, minimum: Optional[float]
+    ):
+        rate = capacity / 60
+        now = time.monotonic()
+
+        level, updated = self._buckets.get(key, (capacity, now))
+        level = min(capacity, level + (now - updated) * rate)
+
+        if minimum is not None and level < minimum:
+            return (minimum - level) / rate
+
+        self._buckets[key] = (level - cost, now)
+
+        if len(self._buckets) > self._prune_at:
+            self._drop_full_buckets(now)
+
+        return 0.0
+
+    def _drop_full_buckets(self, now: float):
+        for key, (level, updated) in list(self._buckets.items()):
+            capacity = self._capacity_of(key)
+            if capacity is None or level + (now - updated) * capacity / 60 >= capacity:
+                del self._buckets[key]
+
+        # Don't scan again until the active buckets have doubled
+        self._prune_at = max(MIN_BUCKETS_TO_PRUNE, len(self._buckets) * 2)
+
+    def _capacity_of(self, key: str):
+        permission, kind = key.split(":")[1:]
+        return getattr(getattr(config.rate_limits, permission, None), kind, None)
+
+    async def _take(
+        self, key: str, capacity: int, cost: float, minimum: Optional[float]
+    ):
+        """Returns the seconds to wait before the bucket has the minimum."""
+
+        if not config.rate_limits.shared:
+            return self._take_local(key, capacity, cost, minimum)
+
+        if not dependencies.redis:
+            logger.warning("Redis is not installed, using local rate limits.")
+            config.rate_limits.shared = False
+            return self._take_local(key, capacity, cost, minimum)
+
+        if self._redis is None:
+            self._redis = create_redis_client()
+            self._take_script = self._redis.register_script(TAKE_SCRIPT)
+
+        try:
+            wait = await self._take_script(
+                keys=[f"{config.auth.redis.prefix}ratelimit-{key}"],
+                args=[capacity, cost, "" if minimum is None else minimum],
+            )
+            return float(wait)
+        except Exception as e:
+            # Don't turn a Redis outage into an API outage
+            logger.error(f"Redis rate limit error: {e}")
+            return 0.0
+
+    def _buckets_of(self, key_id: str, permission: str):
+        """Returns the bucket prefix and limits of a key."""
+
+        permission = getattr(permission, "value", permission)
+        limits = getattr(config.rate_limits, permission, None)
+        if not isinstance(limits, PermissionRateLimits):
+            limits = None
+
+        return f"{key_id}:{permission}", limits
+
+    async def _identify(self, request: Request):
+        """Returns the bucket prefix and limits of a request's key."""
+
+        permission = await AuthManager.get_key_permission(request)
+        return self._buckets_of(get_key_id(request), permission)
+
+    async def admit(self, request: Request):
+        """Takes a request from the key's budget or raises a 429."""
+
+        prefix, limits = await self._identify(request)
+        if limits is None:
+            return
+
+        # Token usage is charged later, so only check for debt here
+        waits = [
+            await self._take(f"{prefix}:{kind}", capacity, 0, 1)
+            for kind in ("prompt_tokens_per_minute", "generated_tokens_per_minute")
+            if (capacity := getattr(limits, kind))
+        ]
+
+        if not any(waits) and limits.requests_per_minute:
+            waits.append(
+                await self._take(
+                    f"{prefix}:requests_per_minute", limits.requests_per_minute, 1, 1
+                )
+            )
+
+        wait = max(waits, default=0.0)
+        if wait > 0:
+            retry_after = math.ceil(wait)
+            error_message = handle_request_error(
+                f"Rate limit exceeded. Retry after {retry_after} seconds.",
+                exc_info=False,
+            ).error.message
+
+            raise HTTPException(
+                429, error_message, headers={"Retry-After": str(retry_after)}
+            )
+
+    async def charge(
+        self, key_id: str, permission: str, prompt_tokens: int, generated_tokens: int
+    ):
+        """
+        Takes the tokens of a finished request from the key's budget.
+
+        This takes the key instead of a request, since batch requests run
+        after the request that submitted them.
+        """
+
+        if not config.rate_limits.enable:
+            return
+
+        prefix, limits = self._buckets_of(key_id, permission)
+        if limits is None:
+            return
+
+        for kind, cost in (
+            ("prompt_tokens_per_minute", prompt_tokens),
+            ("generated_tokens_per_minute", generated_tokens),
+        ):
+            capacity = getattr(limits, kind)
+            if capacity and cost:
+                await self._take(f"{prefix}:{kind}", capacity, cost, None)
+
+
+RateLimiter = RateLimiterClass()
+
+
+async def check_rate_limit(request: Request):
+    """FastAPI depends that enforces the rate limits of a key."""
+
+    if config.rate_limits.enable:
+        await RateLimiter.admit(request)
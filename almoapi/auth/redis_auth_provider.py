@@ -1,5 +1,8 @@
+import asyncio
 import secrets
-from typing import Optional
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
 from pydantic import SecretStr
 from loguru import logger
 from hashlib import sha512
@@ -14,6 +17,67 @@ from common.optional_dependencies import dependencies
 if dependencies.redis:
     import redis.asyncio as redis
 
+# Seconds to wait before resubscribing to the invalidation channel
+RESUBSCRIBE_DELAY = 5
+
+
+def create_redis_client():
+    """Creates a client for the Redis server of the auth config."""
+
+    redis_args = filter_none_values(
+        {
+            "host": config.auth.redis.host,
+            "port": config.auth.redis.port,
+            "username": config.auth.redis.username,
+            "password": config.auth.redis.password,
+            "ssl": config.auth.redis.ssl,
+            "ssl_cert_reqs": config.auth.redis.ssl_certfile,
+            "ssl_keyfile": config.auth.redis.ssl_keyfile,
+            "ssl_ca_certs": config.auth.redis.ssl_ca_certs,
+        }
+    )
+
+    return redis.Redis(**redis_args, decode_responses=True)
+
+
+class PermissionCache:
+    """Bounded LRU cache of hashed keys to permissions with per-entry expiry"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+
+    def get(self, hashed: str) -> Optional[str]:
+        entry = self._entries.get(hashed)
+        if entry is None:
+            return None
+
+        expiry, permission = entry
+        if expiry <= time.monotonic():
+            del self._entries[hashed]
+            return None
+
+        self._entries.move_to_end(hashed)
+        return permission
+
+    def set(self, hashed: str, permission: str, ttl: float):
+        if ttl <= 0:
+            return
+
+        self._entries[hashed] = (time.monotonic() + ttl, permission)
+        self._entries.move_to_end(hashed)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, hashed: Optional[str] = None):
+        """Drops one key, or every key if none is given."""
+
+        if hashed is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(hashed, None)
+
 
 class RedisAuthProvider(AuthInterface):
     """Reids Backed auth provider"""
@@ -28,38 +92,49 @@ class RedisAuthProvider(AuthInterface):
             )
             exit(1)
 
-        redis_args = filter_none_values(
-            {
-                "host": config.auth.redis.host,
-                "port": config.auth.redis.port,
-                "username": config.auth.redis.username,
-                "password": config.auth.redis.password,
-                "ssl": config.auth.redis.ssl,
-                "ssl_cert_reqs": config.auth.redis.ssl_certfile,
-                "ssl_keyfile": config.auth.redis.ssl_keyfile,
-                "ssl_ca_certs": config.auth.redis.ssl_ca_certs,
-            }
-        )
+        self.Redis = create_redis_client()
 
-        self.Redis = redis.Redis(**redis_args, decode_responses=True)
+        self.cache = PermissionCache(config.auth.redis.cache_size)
+        self._listener: Optional[asyncio.Task] = None
 
     async def get_permission(self, token: SecretStr) -> AuthPermission:
         """Get the permission level of a token"""
         if not token.get_secret_value():
             return AuthPermission.unauthenticated
 
+        # Redis clients are bound to a loop, so listen once one is running
+        if config.auth.redis.invalidation_channel and self._listener is None:
+            self._listener = asyncio.create_task(self._listen_for_invalidations())
+
         hashed = sha512(token.get_secret_value().encode()).hexdigest()
+        cached = self.cache.get(hashed)
+        if cached is not None:
+            return cached
+
+        name = f"{config.auth.redis.prefix}key-{hashed}"
         try:
-            redis_token = await self.Redis.get(
-                f"{config.auth.redis.prefix}key-{hashed}"
-            )
+            # Fetch the key's expiry in the same round trip
+            async with self.Redis.pipeline(transaction=False) as pipe:
+                redis_token, expires_in = await pipe.get(name).ttl(name).execute()
         except Exception as e:
             logger.error(f"Redis error: {e}")
             exit(1)
 
         if not redis_token:
+            self.cache.set(
+                hashed,
+                AuthPermission.unauthenticated,
+                config.auth.redis.negative_cache_ttl,
+            )
             return AuthPermission.unauthenticated
 
+        # Don't serve a key from the cache after it expires in Redis
+        ttl = config.auth.redis.cache_ttl
+        if expires_in is not None and expires_in >= 0:
+            ttl = min(ttl, expires_in)
+
+        self.cache.set(hashed, redis_token, ttl)
+
         return redis_token
 
     async def set_token(
@@ -79,10 +154,16 @@ class RedisAuthProvider(AuthInterface):
         )
         try:
             await self.Redis.set(**args)
+
+            # Other servers may have cached the old permission
+            if config.auth.redis.invalidation_channel:
+                await self.Redis.publish(config.auth.redis.invalidation_channel, hashed)
         except Exception as e:
             logger.error(f"Redis error: {e}")
             exit(1)
 
+        self.cache.invalidate(hashed)
+
     async def add_token(
         self, permission: AuthPermission, expiration: Optional[int] = None
     ) -> SecretStr:
@@ -90,3 +171,30 @@ class RedisAuthProvider(AuthInterface):
         token = SecretStr(secrets.token_hex(16))
         await self.set_token(token, permission, expiration)
         return token
+
+    async def _listen_for_invalidations(self):
+        """Drops cached keys that are published to the invalidation channel."""
+
+        channel = config.auth.redis.invalidation_channel
+
+        while True:
+            try:
+                async with self.Redis.pubsub() as pubsub:
+                    await pubsub.subscribe(channel)
+
+                    # Revocations may have been missed while unsubscribed
+                    self.cache.invalidate()
+
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+
+                        hashed = message["data"]
+                        self.cache.invalidate(None if hashed == "*" else hashed)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Redis invalidation channel error: {e}")
+
+            self.cache.invalidate()
+            await asyncio.sleep(RESUBSCRIBE_DELAY)
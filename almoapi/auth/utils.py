@@ -1,3 +1,4 @@
+from hashlib import sha256
 from fastapi import Request
 from typing import Union
 
@@ -17,3 +18,14 @@ def get_test_key(request: Union[Request, SecretStr]) -> SecretStr:
         test_key = test_key.split(" ")[1]
 
     return SecretStr(test_key)
+
+
+def get_key_id(request: Request) -> str:
+    """Returns a stable ID for the API key of a request without exposing it."""
+
+    try:
+        test_key = get_test_key(request).get_secret_value()
+    except ValueError:
+        test_key = ""
+
+    return sha256(test_key.encode()).hexdigest()[:16]
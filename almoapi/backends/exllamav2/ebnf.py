@@ -0,0 +1,858 @@
+"""
+Context-free grammar constraint engine for EBNF (Lark syntax) grammars.
+
+Grammars are compiled to BNF rules over terminals, and every terminal is
+compiled to a character-level DFA. Parsing is an incremental Earley
+recognizer over terminals with a nondeterministic scanner in front of it, so
+a generation never has to be reparsed from the start.
+
+Earley sets are hash-consed: a set is identified by its items, and items
+reference the sets they started in. Identical parse contexts therefore share
+the same objects, which lets token masks be memoized per context and reused
+across steps and requests.
+
+Supported syntax covers rules, terminals, literals (with the i flag),
+regexes without flags, ranges, grouping, optionals, repetition operators,
+aliases, %import of the common library and %ignore. Templates, %declare and
+imports from other modules raise a ValueError so callers can fall back to
+another engine.
+"""
+
+import ast
+import re
+import threading
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+
+from backends.exllamav2.regex_dfa import Dfa
+from backends.exllamav2.vocab import MaskCache, TokenMask, TokenVocabulary
+
+START_RULE = "start"
+
+MAX_REPEAT = 100
+MAX_CACHED_MASKS = 64
+MAX_CACHED_CONFIG_MASKS = 256
+MAX_CACHED_ROWS = 128
+
+# Bounds for the interned parser states and character transitions. Clearing
+# them only loses sharing, live parser states stay valid.
+MAX_INTERNED_STATES = 100_000
+MAX_CACHED_STEPS = 500_000
+
+# Terminals from Lark's common.lark, in the regex dialect of the DFA compiler
+_FLOAT = r"[0-9]+[eE][+\-]?[0-9]+|(?:[0-9]+\.[0-9]*|\.[0-9]+)(?:[eE][+\-]?[0-9]+)?"
+COMMON_TERMINALS = {
+    "DIGIT": r"[0-9]",
+    "HEXDIGIT": r"[a-fA-F0-9]",
+    "INT": r"[0-9]+",
+    "SIGNED_INT": r"[+\-]?[0-9]+",
+    "DECIMAL": r"[0-9]+\.[0-9]*|\.[0-9]+",
+    "FLOAT": _FLOAT,
+    "SIGNED_FLOAT": rf"[+\-]?(?:{_FLOAT})",
+    "NUMBER": rf"{_FLOAT}|[0-9]+",
+    "SIGNED_NUMBER": rf"[+\-]?(?:{_FLOAT}|[0-9]+)",
+    "ESCAPED_STRING": r'"(?:[^"\\\n]|\\.)*"',
+    "LETTER": r"[A-Za-z]",
+    "LCASE_LETTER": r"[a-z]",
+    "UCASE_LETTER": r"[A-Z]",
+    "WORD": r"[A-Za-z]+",
+    "CNAME": r"[_A-Za-z][_A-Za-z0-9]*",
+    "WS_INLINE": r"[ \t]+",
+    "WS": r"[ \t\f\r\n]+",
+    "CR": r"\r",
+    "LF": r"\n",
+    "NEWLINE": r"(?:\r?\n)+",
+    "SH_COMMENT": r"#[^\n]*",
+    "CPP_COMMENT": r"//[^\n]*",
+    "C_COMMENT": r"/\*(?:[^*]|\*+[^*/])*\*+/",
+    "SQL_COMMENT": r"--[^\n]*",
+}
+
+_TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<skip>[ \t\f\r]+|//[^\n]*|\\\n)
+    | (?P<newline>\n)
+    | (?P<string>"(?:[^"\\\n]|\\.)*"i?)
+    | (?P<regex>/(?![/*])(?:[^/\\\n]|\\.)+/[a-z]*)
+    | (?P<directive>%[a-z]+)
+    | (?P<name>[_A-Za-z][_A-Za-z0-9]*)
+    | (?P<number>[0-9]+)
+    | (?P<op>->|\.\.|[:|()\[\]*+?~,.{}!])
+    """,
+    re.VERBOSE,
+)
+
+# Grammar AST nodes are tuples so identical subexpressions share helper rules
+Node = Tuple
+
+
+def _is_terminal_name(name: str) -> bool:
+    return name.lstrip("_")[:1].isupper()
+
+
+def _escape(text: str) -> str:
+    return "".join(char if char.isalnum() else "\\" + char for char in text)
+
+
+def _tokenize(text: str) -> List[Tuple[str, str]]:
+    tokens = []
+    position = 0
+
+    while position < len(text):
+        match = _TOKEN_PATTERN.match(text, position)
+        if match is None:
+            raise ValueError(f"Unexpected character {text[position]!r} in the grammar")
+
+        kind = match.lastgroup
+        if kind != "skip":
+            tokens.append((kind, match.group()))
+
+        position = match.end()
+
+    return tokens
+
+
+def _split_statements(tokens: List[Tuple[str, str]]):
+    """Splits tokens into statements, joining continued alternatives."""
+
+    statements = []
+    current = []
+    depth = 0
+
+    for index, (kind, value) in enumerate(tokens):
+        if kind == "newline":
+            upcoming = next(
+                (token for token in tokens[index + 1 :] if token[0] != "newline"),
+                None,
+            )
+
+            if depth == 0 and upcoming != ("op", "|") and current:
+                statements.append(current)
+                current = []
+
+            continue
+
+        if value in ("(", "["):
+            depth += 1
+        elif value in (")", "]"):
+            depth -= 1
+
+        current.append((kind, value))
+
+    if current:
+        statements.append(current)
+
+    return statements
+
+
+class _StatementParser:
+    """Recursive descent parser for a single grammar statement."""
+
+    def __init__(self, tokens: List[Tuple[str, str]]):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self) -> Tuple[Optional[str], Optional[str]]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+
+        return None, None
+
+    def take(self, kind: Optional[str] = None, value: Optional[str] = None) -> str:
+        token_kind, token_value = self.peek()
+        if (
+            token_kind is None
+            or (kind and token_kind != kind)
+            or (value and token_value != value)
+        ):
+            expected = value or kind or "a token"
+            raise ValueError(f"Expected {expected} in the grammar, got {token_value!r}")
+
+        self.position += 1
+        return token_value
+
+    def accept(self, value: str) -> bool:
+        if self.peek() == ("op", value):
+            self.position += 1
+            return True
+
+        return False
+
+    def at_end(self) -> bool:
+        return self.position >= len(self.tokens)
+
+    def expansions(self) -> Node:
+        alternatives = [self.alias_expansion()]
+        while self.accept("|"):
+            alternatives.append(self.alias_expansion())
+
+        return alternatives[0] if len(alternatives) == 1 else ("alt", *alternatives)
+
+    def alias_expansion(self) -> Node:
+        items = []
+        while True:
+            kind, value = self.peek()
+            if kind is None or value in ("|", ")", "]", "->"):
+                break
+
+            items.append(self.expression())
+
+        # Aliases only rename tree nodes, which doesn't affect recognition
+        if self.accept("->"):
+            self.take("name")
+
+        return items[0] if len(items) == 1 else ("seq", *items)
+
+    def expression(self) -> Node:
+        atom = self.atom()
+
+        if self.accept("*"):
+            return ("rep", atom, 0, None)
+        if self.accept("+"):
+            return ("rep", atom, 1, None)
+        if self.accept("?"):
+            return ("rep", atom, 0, 1)
+        if self.accept("~"):
+            low = int(self.take("number"))
+            high = int(self.take("number")) if self.accept("..") else low
+            if low > high or high > MAX_REPEAT:
+                raise ValueError(f"Invalid repetition range {low}..{high}")
+
+            return ("rep", atom, low, high)
+
+        return atom
+
+    def atom(self) -> Node:
+        kind, value = self.peek()
+
+        if self.accept("("):
+            node = self.expansions()
+            self.take("op", ")")
+            return node
+
+        if self.accept("["):
+            node = self.expansions()
+            self.take("op", "]")
+            return ("rep", node, 0, 1)
+
+        if kind == "string":
+            self.position += 1
+            literal = _parse_string(value)
+            if self.accept(".."):
+                end = _parse_string(self.take("string"))
+                if len(literal) != 1 or len(end) != 1:
+                    raise ValueError("Ranges must be between single characters")
+
+                return ("range", literal, end)
+
+            return ("lit", literal, value.endswith("i"))
+
+        if kind == "regex":
+            self.position += 1
+            pattern, _, flags = value[1:].rpartition("/")
+            if flags:
+                raise ValueError(f"Regex flags aren't supported: /{pattern}/{flags}")
+
+            return ("re", pattern.replace("\\/", "/"))
+
+        if kind == "name":
+            self.position += 1
+            if self.peek() == ("op", "{"):
+                raise ValueError("Grammar templates aren't supported")
+
+            return ("ref", value)
+
+        raise ValueError(f"Unexpected {value!r} in the grammar")
+
+
+def _parse_string(token: str) -> str:
+    try:
+        literal = ast.literal_eval(token.rstrip("i"))
+    except (SyntaxError, ValueError) as exc:
+        raise ValueError(f"Invalid string literal {token}") from exc
+
+    if not literal:
+        raise ValueError("Empty string literals aren't allowed")
+
+    return literal
+
+
+class Grammar:
+    """
+    EBNF grammar compiled to BNF rules over terminals.
+
+    Terminal symbols are negative (~terminal_id) and nonterminals are
+    non-negative. Rule 0 is the augmented start rule.
+    """
+
+    terminals: List[str]
+    rules: List[Tuple[int, Tuple[int, ...]]]
+    ignored: FrozenSet[int]
+
+    def __init__(self, text: str):
+        self.rule_defs: Dict[str, Node] = {}
+        self.terminal_defs: Dict[str, Node] = {}
+        self.imports: Dict[str, str] = {}
+        ignores: List[Node] = []
+
+        for statement in _split_statements(_tokenize(text)):
+            parser = _StatementParser(statement)
+            kind, value = parser.peek()
+
+            if kind == "directive":
+                parser.position += 1
+                if value == "%import":
+                    self._parse_import(parser)
+                elif value == "%ignore":
+                    ignores.append(parser.expansions())
+                else:
+                    raise ValueError(f"Unsupported grammar directive {value}")
+            else:
+                # Inline and keep-all-tokens markers don't affect recognition
+                if not parser.accept("?"):
+                    parser.accept("!")
+
+                name = parser.take("name")
+                if parser.accept("."):
+                    parser.take("number")
+
+                parser.take("op", ":")
+                node = parser.expansions()
+
+                if _is_terminal_name(name):
+                    self.terminal_defs[name] = node
+                else:
+                    self.rule_defs[name] = node
+
+            if not parser.at_end():
+                raise ValueError(f"Unexpected {parser.peek()[1]!r} in the grammar")
+
+        if START_RULE not in self.rule_defs:
+            raise ValueError(f"The grammar has no '{START_RULE}' rule")
+
+        self.terminals = []
+        self.rules = []
+        self._terminal_ids: Dict[str, int] = {}
+        self._terminal_regexes: Dict[str, str] = {}
+        self._resolving = set()
+        self._nonterminals: Dict[object, int] = {}
+        self._pending = []
+
+        start = self._nonterminal(START_RULE)
+        self.rules.append((self._new_nonterminal(), (start,)))
+
+        self.ignored = frozenset(~self._symbol(node) for node in ignores)
+        if any(symbol < 0 for symbol in self.ignored):
+            raise ValueError("Only terminals can be ignored")
+
+        # Rules are compiled on first reference so unused ones are skipped
+        while self._pending:
+            name, symbol = self._pending.pop()
+            for sequence in self._alternatives(self.rule_defs[name]):
+                self.rules.append((symbol, sequence))
+
+        self.nullable = self._find_nullable()
+
+    def _parse_import(self, parser: _StatementParser):
+        path = [parser.take("name")]
+        while parser.accept("."):
+            path.append(parser.take("name"))
+
+        if parser.accept("("):
+            names = [parser.take("name")]
+            while parser.accept(","):
+                names.append(parser.take("name"))
+
+            parser.take("op", ")")
+            module = path
+            aliases = {name: name for name in names}
+        else:
+            module = path[:-1]
+            alias = parser.take("name") if parser.accept("->") else path[-1]
+            aliases = {alias: path[-1]}
+
+        if module != ["common"]:
+            raise ValueError(f"Only imports from common are supported: {path}")
+
+        for alias, name in aliases.items():
+            if name not in COMMON_TERMINALS:
+                raise ValueError(f"Unknown common terminal {name}")
+
+            self.imports[alias] = name
+
+    def _terminal_regex(self, name: str) -> str:
+        regex = self._terminal_regexes.get(name)
+        if regex is not None:
+            return regex
+
+        if name in self.terminal_defs:
+            if name in self._resolving:
+                raise ValueError(f"Terminal {name} is recursive")
+
+            self._resolving.add(name)
+            regex = self._to_regex(self.terminal_defs[name])
+            self._resolving.discard(name)
+        elif name in self.imports:
+            regex = COMMON_TERMINALS[self.imports[name]]
+        else:
+            raise ValueError(f"Undefined terminal {name}")
+
+        self._terminal_regexes[name] = regex
+        return regex
+
+    def _to_regex(self, node: Node) -> str:
+        kind = node[0]
+
+        if kind == "lit":
+            _, text, case_insensitive = node
+            if not case_insensitive:
+                return _escape(text)
+
+            return "".join(
+                f"[{char.lower()}{char.upper()}]"
+                if char.lower() != char.upper()
+                else _escape(char)
+                for char in text
+            )
+
+        if kind == "re":
+            return f"(?:{node[1]})"
+
+        if kind == "range":
+            return f"[{_escape(node[1])}-{_escape(node[2])}]"
+
+        if kind == "ref":
+            if not _is_terminal_name(node[1]):
+                raise ValueError(f"Terminal can't reference the rule {node[1]}")
+
+            return f"(?:{self._terminal_regex(node[1])})"
+
+        if kind == "seq":
+            return "".join(self._to_regex(child) for child in node[1:])
+
+        if kind == "alt":
+            return "(?:" + "|".join(self._to_regex(child) for child in node[1:]) + ")"
+
+        _, child, low, high = node
+        upper = "" if high is None else high
+        return f"(?:{self._to_regex(child)}){{{low},{upper}}}"
+
+    def _terminal(self, regex: str) -> int:
+        terminal_id = self._terminal_ids.get(regex)
+        if terminal_id is None:
+            terminal_id = len(self.terminals)
+            self._terminal_ids[regex] = terminal_id
+            self.terminals.append(regex)
+
+        return ~terminal_id
+
+    def _new_nonterminal(self) -> int:
+        symbol = len(self._nonterminals)
+        self._nonterminals[("helper", symbol)] = symbol
+        return symbol
+
+    def _nonterminal(self, name: str) -> int:
+        symbol = self._nonterminals.get(name)
+        if symbol is None:
+            if name not in self.rule_defs:
+                raise ValueError(f"Undefined rule {name}")
+
+            symbol = len(self._nonterminals)
+            self._nonterminals[name] = symbol
+            self._pending.append((name, symbol))
+
+        return symbol
+
+    def _symbol(self, node: Node) -> int:
+        kind = node[0]
+
+        if kind == "ref":
+            name = node[1]
+            if _is_terminal_name(name):
+                return self._terminal(self._terminal_regex(name))
+
+            return self._nonterminal(name)
+
+        if kind in ("lit", "re", "range"):
+            return self._terminal(self._to_regex(node))
+
+        symbol = self._nonterminals.get(node)
+        if symbol is not None:
+            return symbol
+
+        symbol = self._new_nonterminal()
+        self._nonterminals[node] = symbol
+
+        if kind in ("alt", "seq"):
+            sequences = self._alternatives(node)
+        else:
+            _, child, low, high = node
+            item = self._symbol(child)
+            if high is None:
+                # Left recursion keeps Earley sets small for long repetitions
+                sequences = [(item,) * low, (symbol, item)]
+            else:
+                sequences = [(item,) * count for count in range(low, high + 1)]
+
+        for sequence in sequences:
+            self.rules.append((symbol, sequence))
+
+        return symbol
+
+    def _alternatives(self, node: Node) -> List[Tuple[int, ...]]:
+        if node[0] == "alt":
+            return [self._sequence(child) for child in node[1:]]
+
+        return [self._sequence(node)]
+
+    def _sequence(self, node: Node) -> Tuple[int, ...]:
+        if node[0] == "seq":
+            return tuple(self._symbol(child) for child in node[1:])
+
+        return (self._symbol(node),)
+
+    def _find_nullable(self) -> FrozenSet[int]:
+        nullable = set()
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs in self.rules:
+                if lhs not in nullable and all(symbol in nullable for symbol in rhs):
+                    nullable.add(lhs)
+                    changed = True
+
+        return frozenset(nullable)
+
+
+class _ParserState:
+    """An interned Earley set."""
+
+    __slots__ = ("waiting", "expected", "accepting", "scans", "starts")
+
+    def __init__(self):
+        # Symbol -> items waiting on it, with origins resolved
+        self.waiting: Dict[int, List[Tuple[int, int, "_ParserState"]]] = {}
+        self.expected: Tuple[int, ...] = ()
+        self.accepting = False
+        self.scans: Dict[int, Tuple["_ParserState", ...]] = {}
+        self.starts: Dict[str, tuple] = {}
+
+
+# A set of scanner configurations: (parser state, terminal, DFA state).
+# A terminal of None marks a boundary where no terminal has started yet.
+CfgState = FrozenSet[Tuple[_ParserState, Optional[int], Optional[int]]]
+
+
+class CfgEngine:
+    """
+    Incremental grammar constraint engine bound to a model's vocabulary.
+
+    Parser states and character transitions are shared between all requests
+    using the same grammar, so masks for repeated contexts are lookups.
+    """
+
+    def __init__(self, grammar: Grammar, vocab: TokenVocabulary):
+        self.grammar = grammar
+        self.vocab = vocab
+        self.masks = MaskCache(MAX_CACHED_MASKS)
+        self.config_masks = MaskCache(MAX_CACHED_CONFIG_MASKS)
+        self.rows = MaskCache(MAX_CACHED_ROWS)
+
+        self.dfas = []
+        for regex in grammar.terminals:
+            dfa = Dfa(regex)
+            if dfa.accepting[0]:
+                raise ValueError(f"Terminal /{regex}/ can match an empty string")
+
+            self.dfas.append(dfa)
+
+        self.rules_by_lhs: Dict[int, List[int]] = {}
+        for index, (lhs, _) in enumerate(grammar.rules):
+            self.rules_by_lhs.setdefault(lhs, []).append(index)
+
+        self._interned: Dict[FrozenSet, _ParserState] = {}
+        self._steps: Dict[Tuple[CfgState, str], Optional[CfgState]] = {}
+        self._lock = threading.Lock()
+
+        initial = self._build_state([(0, 0, None)])
+        self.initial_state: CfgState = frozenset({(initial, None, None)})
+
+    def _build_state(self, kernel) -> _ParserState:
+        """Runs prediction and completion, then interns the resulting set."""
+
+        rules = self.grammar.rules
+        nullable = self.grammar.nullable
+
+        # Origins of None refer to the set being built
+        items = set(kernel)
+        agenda = list(items)
+        while agenda:
+            rule, dot, origin = agenda.pop()
+            lhs, rhs = rules[rule]
+
+            if dot < len(rhs):
+                symbol = rhs[dot]
+                if symbol < 0:
+                    continue
+
+                derived = [
+                    (predicted, 0, None) for predicted in self.rules_by_lhs[symbol]
+                ]
+                if symbol in nullable:
+                    derived.append((rule, dot + 1, origin))
+            elif origin is not None:
+                derived = [
+                    (waiting_rule, waiting_dot + 1, waiting_origin)
+                    for waiting_rule, waiting_dot, waiting_origin in origin.waiting.get(
+                        lhs, ()
+                    )
+                ]
+            else:
+                # Empty completions are covered by the nullable prediction
+                continue
+
+            for item in derived:
+                if item not in items:
+                    items.add(item)
+                    agenda.append(item)
+
+        key = frozenset(items)
+        state = self._interned.get(key)
+        if state is not None:
+            return state
+
+        state = _ParserState()
+        expected = set()
+        for rule, dot, origin in items:
+            rhs = rules[rule][1]
+            if dot < len(rhs):
+                state.waiting.setdefault(rhs[dot], []).append(
+                    (rule, dot, state if origin is None else origin)
+                )
+                if rhs[dot] < 0:
+                    expected.add(~rhs[dot])
+            elif rule == 0:
+                state.accepting = True
+
+        state.expected = tuple(sorted(expected | self.grammar.ignored))
+
+        with self._lock:
+            if len(self._interned) >= MAX_INTERNED_STATES:
+                self._interned.clear()
+
+            return self._interned.setdefault(key, state)
+
+    def _scan(self, state: _ParserState, terminal: int):
+        """Returns the parser states after a complete terminal."""
+
+        next_states = state.scans.get(terminal)
+        if next_states is not None:
+            return next_states
+
+        next_states = ()
+        waiting = state.waiting.get(~terminal)
+        if waiting:
+            kernel = [(rule, dot + 1, origin) for rule, dot, origin in waiting]
+            next_states = (self._build_state(kernel),)
+
+        if terminal in self.grammar.ignored:
+            next_states += (state,)
+
+        state.scans[terminal] = next_states
+        return next_states
+
+    def _start_terminals(self, state: _ParserState, char: str):
+        """Returns configurations for terminals starting with a character."""
+
+        configs = state.starts.get(char)
+        if configs is None:
+            configs = []
+            for terminal in state.expected:
+                dfa_state = self.dfas[terminal].next_state(0, char)
+                if dfa_state is not None:
+                    configs.append((state, terminal, dfa_state))
+
+            configs = tuple(configs)
+            state.starts[char] = configs
+
+        return configs
+
+    def step(self, configs: CfgState, char: str) -> Optional[CfgState]:
+        """Advances by one character. Returns None if it's invalid."""
+
+        key = (configs, char)
+        try:
+            return self._steps[key]
+        except KeyError:
+            pass
+
+        result = set()
+        for state, terminal, dfa_state in configs:
+            if terminal is None:
+                result.update(self._start_terminals(state, char))
+                continue
+
+            dfa = self.dfas[terminal]
+            next_dfa_state = dfa.next_state(dfa_state, char)
+            if next_dfa_state is not None:
+                result.add((state, terminal, next_dfa_state))
+
+            # The character may also begin the next terminal
+            if dfa.accepting[dfa_state]:
+                for next_state in self._scan(state, terminal):
+                    result.update(self._start_terminals(next_state, char))
+
+        next_configs = frozenset(result) if result else None
+
+        if len(self._steps) >= MAX_CACHED_STEPS:
+            self._steps.clear()
+
+        self._steps[key] = next_configs
+        return next_configs
+
+    def is_accepting(self, configs: Optional[CfgState]) -> bool:
+        """Whether the text so far is a complete sentence of the grammar."""
+
+        if configs is None:
+            return False
+
+        for state, terminal, dfa_state in configs:
+            if terminal is None:
+                if state.accepting:
+                    return True
+            elif self.dfas[terminal].accepting[dfa_state] and any(
+                next_state.accepting for next_state in self._scan(state, terminal)
+            ):
+                return True
+
+        return False
+
+    def advance(self, configs: Optional[CfgState], token_id: int):
+        """Advances the parser by a sampled token."""
+
+        if configs is None or token_id >= len(self.vocab.pieces):
+            return None
+
+        if token_id in self.vocab.eos_token_ids:
+            return None
+
+        for char in self.vocab.pieces[token_id]:
+            configs = self.step(configs, char)
+            if configs is None:
+                return None
+
+        return configs
+
+    def get_mask(self, configs: Optional[CfgState]) -> TokenMask:
+        """Returns the memoized token mask for a parser state."""
+
+        if configs is None:
+            return TokenMask(self.vocab.eos_token_ids, [])
+
+        return self.masks.get(configs, lambda: self._compute_mask(configs))
+
+    def _terminal_row(self, terminal: int, dfa_state: int):
+        """
+        Splits the vocabulary for a DFA state of a terminal.
+
+        Returns the tokens that stay inside the terminal, and the tokens that
+        only survive by ending it mid-token with the offsets where it may end.
+        Rows don't depend on the parse context, so all contexts share them.
+        """
+
+        dfa = self.dfas[terminal]
+
+        def step(walk_state, char):
+            current, depth, offsets = walk_state
+            if current is not None:
+                if depth and dfa.accepting[current]:
+                    offsets += (depth,)
+
+                current = dfa.next_state(current, char)
+
+            if current is None and not offsets:
+                return None
+
+            return (current, depth + 1, offsets)
+
+        token_ids, end_states = self.vocab.walk((dfa_state, 0, ()), step)
+
+        inside, leaving = [], []
+        for token_id, (current, _, offsets) in zip(token_ids, end_states, strict=True):
+            if current is not None:
+                inside.append(token_id)
+            else:
+                leaving.append((token_id, offsets))
+
+        return np.sort(np.asarray(inside, dtype=np.int32)), leaving
+
+    def _boundary_masks(self, state: _ParserState):
+        return [self._config_mask(state, terminal, 0) for terminal in state.expected]
+
+    def _config_mask(self, state: _ParserState, terminal: int, dfa_state: int):
+        """Returns the memoized allowed tokens of a single configuration."""
+
+        key = (state, terminal, dfa_state)
+        return self.config_masks.get(key, lambda: self._compute_config_mask(*key))
+
+    def _compute_config_mask(
+        self, state: _ParserState, terminal: int, dfa_state: int
+    ) -> np.ndarray:
+        inside, leaving = self.rows.get(
+            (terminal, dfa_state), lambda: self._terminal_row(terminal, dfa_state)
+        )
+
+        next_states = self._scan(state, terminal)
+        if not next_states:
+            return inside
+
+        masks = [inside]
+
+        # The terminal may already be complete before the token
+        if self.dfas[terminal].accepting[dfa_state]:
+            for next_state in next_states:
+                masks.extend(self._boundary_masks(next_state))
+
+        # The rest of a token ending the terminal starts from a boundary
+        if leaving:
+            boundary = frozenset((next_state, None, None) for next_state in next_states)
+            pieces = self.vocab.pieces
+            continued = [
+                token_id
+                for token_id, offsets in leaving
+                if any(
+                    self._accepts_prefix(boundary, pieces[token_id][offset:])
+                    for offset in offsets
+                )
+            ]
+            masks.append(np.asarray(continued, dtype=np.int32))
+
+        return np.unique(np.concatenate(masks))
+
+    def _accepts_prefix(self, configs: CfgState, text: str) -> bool:
+        for char in text:
+            configs = self.step(configs, char)
+            if configs is None:
+                return False
+
+        return True
+
+    def _compute_mask(self, configs: CfgState) -> TokenMask:
+        # Configurations are alternatives, so the mask is the union of theirs
+        masks = []
+        for state, terminal, dfa_state in configs:
+            if terminal is None:
+                masks.extend(self._boundary_masks(state))
+            else:
+                masks.append(self._config_mask(state, terminal, dfa_state))
+
+        allowed = np.unique(np.concatenate(masks)).tolist() if masks else []
+        if self.is_accepting(configs):
+            allowed = sorted(set(allowed).union(self.vocab.eos_token_ids))
+
+        # Never leave the sampler without a valid token
+        if not allowed:
+            allowed = list(self.vocab.eos_token_ids)
+
+        return TokenMask(allowed, [])
@@ -1,3 +1,4 @@
+import pathlib
 import traceback
 from exllamav2 import ExLlamaV2, ExLlamaV2Tokenizer
 from exllamav2.generator.filters import ExLlamaV2Filter, ExLlamaV2PrefixFilter
@@ -11,9 +12,17 @@ from lmformatenforcer.integrations.exllamav2 import (
     build_token_enforcer_tokenizer_data,
 )
 from loguru import logger
-from typing import List
+from typing import List, Union
 from functools import lru_cache
 
+from backends.exllamav2.ebnf import CfgEngine, Grammar
+from backends.exllamav2.json_mode import INITIAL_STATE, JsonModeEngine
+from backends.exllamav2.regex_dfa import RegexEngine
+from backends.exllamav2.vocab import TokenVocabulary
+
+# A schema accepting any object is served by the generic JSON mode engine
+JSON_MODE_SCHEMA = {"type": "object"}
+
 
 class OutlinesTokenizerWrapper:
     """Wrapper for Outlines tokenizer"""
@@ -100,11 +109,71 @@ class ExLlamaV2TokenEnforcerFilter(ExLlamaV2Filter):
         return True
 
 
+@lru_cache(10)
+def _get_token_vocabulary(tokenizer: ExLlamaV2Tokenizer):
+    return TokenVocabulary.from_exllamav2(tokenizer)
+
+
+@lru_cache(10)
+def _get_json_mode_engine(tokenizer: ExLlamaV2Tokenizer):
+    return JsonModeEngine(_get_token_vocabulary(tokenizer))
+
+
+@lru_cache(32)
+def _get_regex_engine(
+    tokenizer: ExLlamaV2Tokenizer, pattern: str, cache_dir: pathlib.Path
+):
+    return RegexEngine.load_or_compile(
+        pattern, _get_token_vocabulary(tokenizer), cache_dir
+    )
+
+
+@lru_cache(16)
+def _get_cfg_engine(tokenizer: ExLlamaV2Tokenizer, grammar: str):
+    return CfgEngine(Grammar(grammar), _get_token_vocabulary(tokenizer))
+
+
+class ExLlamaV2StateMachineFilter(ExLlamaV2Filter):
+    """Filter class for the in-house grammar engines"""
+
+    def __init__(
+        self,
+        model: ExLlamaV2,
+        tokenizer: ExLlamaV2Tokenizer,
+        engine: Union[JsonModeEngine, RegexEngine, CfgEngine],
+        initial_state,
+    ):
+        super().__init__(model, tokenizer)
+        self.engine = engine
+        self.initial_state = initial_state
+        self.state = initial_state
+
+    def begin(self, prefix_str: str):
+        self.state = self.initial_state
+
+    def feed(self, token):
+        self.state = self.engine.advance(self.state, int(token[0][0]))
+
+    def next(self):
+        mask = self.engine.get_mask(self.state)
+        if not hasattr(self, "allow_return_type_list"):
+            return mask.as_sets()
+        else:
+            return mask.allowed, mask.end
+
+    def use_background_worker(self):
+        return True
+
+
 def clear_grammar_func_cache():
     """Flush tokenizer_data cache to avoid holding references to
     tokenizers after unloading a model"""
 
     _get_lmfe_tokenizer_data.cache_clear()
+    _get_json_mode_engine.cache_clear()
+    _get_regex_engine.cache_clear()
+    _get_cfg_engine.cache_clear()
+    _get_token_vocabulary.cache_clear()
 
 
 class ExLlamaV2Grammar:
@@ -123,6 +192,10 @@ class ExLlamaV2Grammar:
     ):
         """Adds an ExllamaV2 filter based on a JSON schema."""
 
+        if json_schema == JSON_MODE_SCHEMA:
+            self.add_json_mode_filter(model, tokenizer)
+            return
+
         # Create the parser
         try:
             schema_parser = JsonSchemaParser(json_schema)
@@ -144,13 +217,43 @@ class ExLlamaV2Grammar:
         # Append the filters
         self.filters.extend([lmfilter, prefix_filter])
 
+    def add_json_mode_filter(
+        self,
+        model: ExLlamaV2,
+        tokenizer: ExLlamaV2Tokenizer,
+    ):
+        """Adds a filter that accepts any JSON object (JSON mode)."""
+
+        engine = _get_json_mode_engine(tokenizer)
+        self.filters.append(
+            ExLlamaV2StateMachineFilter(model, tokenizer, engine, INITIAL_STATE)
+        )
+
     def add_regex_filter(
         self,
         pattern: str,
         model: ExLlamaV2,
         tokenizer: ExLlamaV2Tokenizer,
     ):
-        """Adds an ExllamaV2 filter based on regular expressions."""
+        """
+        Adds an ExllamaV2 filter based on regular expressions.
+
+        Compiling a new pattern walks the whole vocabulary, so callers should
+        run this outside of the event loop.
+        """
+
+        # Compiled token tables are reused across restarts
+        cache_dir = pathlib.Path(model.config.model_dir) / ".grammar_cache"
+
+        try:
+            engine = _get_regex_engine(tokenizer, pattern, cache_dir)
+            self.filters.append(
+                ExLlamaV2StateMachineFilter(model, tokenizer, engine, 0)
+            )
+
+            return
+        except ValueError as exc:
+            logger.warning(f"Falling back to LMFE for the regex pattern: {exc}")
 
         # Create the parser
         try:
@@ -177,9 +280,24 @@ class ExLlamaV2Grammar:
     ):
         """
         Add an EBNF grammar filter.
-        Possibly replace outlines with an in-house solution in the future.
+
+        Grammars use Lark syntax. Grammars the in-house engine can't handle
+        fall back to Outlines. Compiling a new grammar builds a DFA for each
+        terminal, so callers should run this outside of the event loop.
         """
 
+        try:
+            engine = _get_cfg_engine(tokenizer, ebnf_string)
+            self.filters.append(
+                ExLlamaV2StateMachineFilter(
+                    model, tokenizer, engine, engine.initial_state
+                )
+            )
+
+            return
+        except ValueError as exc:
+            logger.warning(f"Falling back to Outlines for the EBNF grammar: {exc}")
+
         try:
             ebnf_filter = ExLlamaV2EbnfFilter(model, tokenizer, ebnf_string)
         except ImportError:
@@ -0,0 +1,367 @@
+"""
+Generic JSON constraint engine for JSON mode.
+
+Implements a character-level pushdown automaton for JSON documents whose root
+is an object. Token masks are computed once per distinct parser state and
+memoized on the engine, which is shared by all requests for a loaded model.
+"""
+
+from typing import List, Optional, Tuple
+
+from backends.exllamav2.vocab import MaskCache, TokenMask, TokenVocabulary
+
+# Parser modes
+(
+    ROOT,
+    VALUE,
+    OBJECT_START,
+    KEY,
+    COLON,
+    AFTER_VALUE,
+    ARRAY_START,
+    STRING,
+    ESCAPE,
+    UNICODE,
+    NUMBER,
+    LITERAL,
+    DONE,
+) = range(13)
+
+# Number sub-states
+MINUS, ZERO, INT, FRAC_START, FRAC, EXP_START, EXP_SIGN, EXP = range(8)
+
+NUMBER_CAN_END = frozenset({ZERO, INT, FRAC, EXP})
+
+# Number sub-states where any run of digits is valid
+NUMBER_TAKES_DIGITS = frozenset({INT, FRAC_START, FRAC, EXP_START, EXP_SIGN, EXP})
+
+WHITESPACE = frozenset(" \t\n\r")
+DIGITS = frozenset("0123456789")
+HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+ESCAPES = frozenset('"\\/bfnrt')
+LITERALS = {"t": "rue", "f": "alse", "n": "ull"}
+WHITESPACE_MODES = frozenset(
+    {VALUE, OBJECT_START, KEY, COLON, AFTER_VALUE, ARRAY_START, DONE}
+)
+
+# Stops models from looping on whitespace between tokens forever
+MAX_CONSECUTIVE_WHITESPACE = 32
+
+# Modes with masks that take whitespace. DONE only allows EOS.
+MASKED_WHITESPACE_MODES = WHITESPACE_MODES - {DONE}
+
+# (mode, auxiliary data) pairs of every other mode: the root, key and value
+# strings and escapes, the digits left in unicode escapes, number sub-states
+# and the letters left in literals
+OTHER_MODE_STATES = (
+    1
+    + 2 * 2
+    + 2 * 4
+    + EXP
+    + 1
+    + len(
+        {
+            literal[start:]
+            for literal in LITERALS.values()
+            for start in range(len(literal))
+        }
+    )
+)
+
+# (mode, auxiliary data, consecutive whitespace, bracket stack)
+JsonState = Tuple[int, object, int, Tuple[str, ...]]
+
+INITIAL_STATE: JsonState = (ROOT, None, 0, ())
+DONE_STATE: JsonState = (DONE, None, 0, ())
+
+
+def _finish_value(stack: Tuple[str, ...]) -> JsonState:
+    if stack:
+        return (AFTER_VALUE, None, 0, stack)
+
+    return DONE_STATE
+
+
+def _start_value(char: str, stack: Tuple[str, ...]) -> Optional[JsonState]:
+    if char == '"':
+        return (STRING, False, 0, stack)
+    if char == "{":
+        return (OBJECT_START, None, 0, stack + ("{",))
+    if char == "[":
+        return (ARRAY_START, None, 0, stack + ("[",))
+    if char == "-":
+        return (NUMBER, MINUS, 0, stack)
+    if char == "0":
+        return (NUMBER, ZERO, 0, stack)
+    if char in DIGITS:
+        return (NUMBER, INT, 0, stack)
+
+    literal = LITERALS.get(char)
+    if literal:
+        return (LITERAL, literal, 0, stack)
+
+    return None
+
+
+def _close(char: str, stack: Tuple[str, ...]) -> Optional[JsonState]:
+    if stack and (
+        (char == "}" and stack[-1] == "{") or (char == "]" and stack[-1] == "[")
+    ):
+        return _finish_value(stack[:-1])
+
+    return None
+
+
+def _step_number(sub_state: int, char: str, stack) -> Optional[JsonState]:
+    if char in DIGITS:
+        if sub_state == MINUS:
+            return (NUMBER, ZERO if char == "0" else INT, 0, stack)
+        if sub_state == INT:
+            return (NUMBER, INT, 0, stack)
+        if sub_state in (FRAC_START, FRAC):
+            return (NUMBER, FRAC, 0, stack)
+        if sub_state in (EXP_START, EXP_SIGN, EXP):
+            return (NUMBER, EXP, 0, stack)
+    elif char == "." and sub_state in (ZERO, INT):
+        return (NUMBER, FRAC_START, 0, stack)
+    elif char in "eE" and sub_state in (ZERO, INT, FRAC):
+        return (NUMBER, EXP_START, 0, stack)
+    elif char in "+-" and sub_state == EXP_START:
+        return (NUMBER, EXP_SIGN, 0, stack)
+
+    # The character terminates the number and is parsed as structure
+    if sub_state in NUMBER_CAN_END:
+        return step(_finish_value(stack), char)
+
+    return None
+
+
+def step(state: JsonState, char: str) -> Optional[JsonState]:
+    """Advances the parser by one character. Returns None if it's invalid."""
+
+    mode, aux, whitespace, stack = state
+
+    if mode == STRING:
+        if char == '"':
+            return (COLON, None, 0, stack) if aux else _finish_value(stack)
+        if char == "\\":
+            return (ESCAPE, aux, 0, stack)
+        if char < " ":
+            return None
+
+        return state
+
+    if mode == ESCAPE:
+        if char in ESCAPES:
+            return (STRING, aux, 0, stack)
+        if char == "u":
+            return (UNICODE, (aux, 4), 0, stack)
+
+        return None
+
+    if mode == UNICODE:
+        if char not in HEX_DIGITS:
+            return None
+
+        is_key, remaining = aux
+        if remaining == 1:
+            return (STRING, is_key, 0, stack)
+
+        return (UNICODE, (is_key, remaining - 1), 0, stack)
+
+    if mode == NUMBER:
+        return _step_number(aux, char, stack)
+
+    if mode == LITERAL:
+        if char != aux[0]:
+            return None
+
+        return _finish_value(stack) if len(aux) == 1 else (LITERAL, aux[1:], 0, stack)
+
+    if char in WHITESPACE:
+        if mode in WHITESPACE_MODES and whitespace < MAX_CONSECUTIVE_WHITESPACE:
+            return (mode, aux, whitespace + 1, stack)
+
+        return None
+
+    if mode == ROOT:
+        return (OBJECT_START, None, 0, ("{",)) if char == "{" else None
+
+    if mode == VALUE:
+        return _start_value(char, stack)
+
+    if mode == OBJECT_START:
+        if char == '"':
+            return (STRING, True, 0, stack)
+
+        return _close(char, stack)
+
+    if mode == KEY:
+        return (STRING, True, 0, stack) if char == '"' else None
+
+    if mode == COLON:
+        return (VALUE, None, 0, stack) if char == ":" else None
+
+    if mode == AFTER_VALUE:
+        if char == ",":
+            return (KEY if stack[-1] == "{" else VALUE, None, 0, stack)
+
+        return _close(char, stack)
+
+    if mode == ARRAY_START:
+        if char == "]":
+            return _close(char, stack)
+
+        return _start_value(char, stack)
+
+    # Nothing but whitespace may follow a complete document
+    return None
+
+
+def advance(state: Optional[JsonState], text: str) -> Optional[JsonState]:
+    """Advances the parser over a string."""
+
+    for char in text:
+        if state is None:
+            return None
+
+        state = step(state, char)
+
+    return state
+
+
+def _is_string_safe(piece: str) -> bool:
+    return '"' not in piece and "\\" not in piece and min(piece) >= " "
+
+
+class JsonModeEngine:
+    """
+    Generic JSON constraint engine bound to a model's vocabulary.
+
+    Token classes (string-safe and numeric) are precomputed once so
+    most of the vocabulary is accepted or rejected in bulk. Every other token
+    is only simulated the first time its parser state is seen.
+    """
+
+    vocab: TokenVocabulary
+    string_safe: List[int]
+    digits: List[int]
+
+    def __init__(self, vocab: TokenVocabulary):
+        self.vocab = vocab
+
+        pieces = vocab.pieces
+        self.string_safe = []
+        self.digits = []
+        self.string_unsafe_by_first_char = {}
+        self.non_digit_by_first_char = {}
+
+        max_closers = 0
+        max_leading_whitespace = 0
+        for first_char, token_ids in vocab.by_first_char.items():
+            for token_id in token_ids:
+                piece = pieces[token_id]
+
+                if _is_string_safe(piece):
+                    self.string_safe.append(token_id)
+                else:
+                    self.string_unsafe_by_first_char.setdefault(first_char, []).append(
+                        token_id
+                    )
+
+                if piece.isdigit() and piece.isascii():
+                    self.digits.append(token_id)
+                else:
+                    self.non_digit_by_first_char.setdefault(first_char, []).append(
+                        token_id
+                    )
+
+                max_closers = max(max_closers, piece.count("}") + piece.count("]"))
+                max_leading_whitespace = max(
+                    max_leading_whitespace,
+                    len(piece) - len(piece.lstrip("".join(WHITESPACE))),
+                )
+
+        # A single token can pop at most max_closers brackets, so masks only
+        # depend on that many stack entries plus one to detect the root.
+        self.stack_window = max_closers + 1
+
+        # A token fits if its leading whitespace fits under the limit, so
+        # every count up to this floor has the same mask.
+        self.whitespace_floor = max(
+            MAX_CONSECUTIVE_WHITESPACE - max_leading_whitespace, 0
+        )
+
+        # Keep every state of the stack windows on one path to the deepest
+        # window, which covers the states of a typical document
+        whitespace_states = MAX_CONSECUTIVE_WHITESPACE - self.whitespace_floor + 1
+        self.masks = MaskCache(
+            (OTHER_MODE_STATES + len(MASKED_WHITESPACE_MODES) * whitespace_states)
+            * self.stack_window
+        )
+
+    def advance(self, state: Optional[JsonState], token_id: int):
+        """Advances a parser state by a sampled token."""
+
+        if token_id in self.vocab.eos_token_ids:
+            return DONE_STATE
+
+        if state is None or token_id >= len(self.vocab.pieces):
+            return None
+
+        return advance(state, self.vocab.pieces[token_id])
+
+    def get_mask(self, state: Optional[JsonState]) -> TokenMask:
+        """Returns the memoized token mask for a parser state."""
+
+        if state is None or state[0] == DONE:
+            return TokenMask(self.vocab.eos_token_ids, [])
+
+        mode, aux, whitespace, stack = state
+        key = (
+            mode,
+            aux,
+            max(whitespace, self.whitespace_floor),
+            stack[-self.stack_window :],
+        )
+
+        return self.masks.get(key, lambda: self._compute_mask(key))
+
+    def _compute_mask(self, state: JsonState) -> TokenMask:
+        mode, aux = state[0], state[1]
+        pieces = self.vocab.pieces
+
+        # Bulk-accept token classes that can't change the parser state
+        if mode == STRING:
+            allowed = list(self.string_safe)
+            candidates = self.string_unsafe_by_first_char
+        elif mode == NUMBER and aux in NUMBER_TAKES_DIGITS:
+            allowed = list(self.digits)
+            candidates = self.non_digit_by_first_char
+        else:
+            allowed = []
+            candidates = self.vocab.by_first_char
+
+        end = []
+        for first_char, token_ids in candidates.items():
+            first_state = step(state, first_char)
+            if first_state is None:
+                continue
+
+            for token_id in token_ids:
+                next_state = advance(first_state, pieces[token_id][1:])
+                if next_state is None:
+                    continue
+
+                allowed.append(token_id)
+                if next_state[0] == DONE:
+                    end.append(token_id)
+
+        # Never leave the sampler without a valid token
+        if not allowed:
+            allowed = list(self.vocab.eos_token_ids)
+
+        allowed.sort()
+        end.sort()
+
+        return TokenMask(allowed, end)
@@ -4,6 +4,7 @@ import asyncio
 import gc
 import math
 import pathlib
+import time
 import traceback
 import torch
 import uuid
@@ -56,8 +57,9 @@ from templating.templating import (
     TemplateLoadError,
     find_template_from_model,
 )
+from common.tracing import record_stages, start_span
 from common.transformers_utils import GenerationConfig, HuggingFaceConfig
-from common.utils import coalesce, unwrap
+from common.utils import coalesce, join_generations, unwrap
 
 
 class ExllamaV2Container:
@@ -869,48 +871,7 @@ class ExllamaV2Container:
         ):
             generations.append(generation)
 
-        joined_generation = {
-            "text": "",
-            "prompt_tokens": 0,
-            "generation_tokens": 0,
-            "tool_calls": None,
-            "offset": [],
-            "token_probs": {},
-            "logprobs": [],
-        }
-
-        if generations:
-            # Get finish_reason first and then shift where -1 points to
-            if "finish_reason" in generations[-1]:
-                finish_reason_gen = generations.pop()
-                joined_generation["finish_reason"] = finish_reason_gen.get(
-                    "finish_reason"
-                )
-                joined_generation["stop_str"] = finish_reason_gen.get("stop_str")
-            else:
-                joined_generation["finish_reason"] = "stop"
-
-        if len(generations) > 0:
-            for generation in generations:
-                joined_generation["text"] += unwrap(generation.get("text"), "")
-                joined_generation["offset"].append(unwrap(generation.get("offset"), -1))
-                joined_generation["token_probs"].update(
-                    unwrap(generation.get("token_probs"), {})
-                )
-
-                # Include empty logprob dicts for index preservation
-                joined_generation["logprobs"].append(
-                    unwrap(generation.get("logprobs"), {})
-                )
-
-            joined_generation["prompt_tokens"] = unwrap(
-                generations[-1].get("prompt_tokens"), 0
-            )
-            joined_generation["generated_tokens"] = unwrap(
-                generations[-1].get("generated_tokens"), 0
-            )
-
-        return joined_generation
+        return join_generations(generations)
 
     async def generate_gen(
         self,
@@ -930,6 +891,10 @@ class ExllamaV2Container:
         assert self.generator is not None
         assert gen_params is not None
 
+        # Time to first token includes waiting, grammar and tokenization
+        start_time = time.perf_counter()
+        first_token_time = None
+
         # Wait for load lock to be freed before processing
         async with self.load_condition:
             await self.load_condition.wait_for(lambda: not self.load_lock.locked())
@@ -1031,23 +996,32 @@ class ExllamaV2Container:
         # Initialize grammar handler
         grammar_handler = ExLlamaV2Grammar()
 
-        # Add JSON schema filter if it exists
-        if gen_params.json_schema:
-            grammar_handler.add_json_schema_filter(
-                gen_params.json_schema, self.model, self.tokenizer
-            )
+        with start_span("grammar"):
+            # Add JSON schema filter if it exists
+            if gen_params.json_schema:
+                grammar_handler.add_json_schema_filter(
+                    gen_params.json_schema, self.model, self.tokenizer
+                )
 
-        # Add regex filter if it exists
-        if gen_params.regex_pattern:
-            grammar_handler.add_regex_filter(
-                gen_params.regex_pattern, self.model, self.tokenizer
-            )
+            # Add regex filter if it exists
+            # New patterns are compiled against the vocabulary, so use a thread
+            if gen_params.regex_pattern:
+                await asyncio.to_thread(
+                    grammar_handler.add_regex_filter,
+                    gen_params.regex_pattern,
+                    self.model,
+                    self.tokenizer,
+                )
 
-        # Add EBNF filter if it exists
-        if gen_params.grammar_string:
-            grammar_handler.add_ebnf_filter(
-                gen_params.grammar_string, self.model, self.tokenizer
-            )
+            # Add EBNF filter if it exists
+            # New grammars are parsed and compiled per terminal, so use a thread
+            if gen_params.grammar_string:
+                await asyncio.to_thread(
+                    grammar_handler.add_ebnf_filter,
+                    gen_params.grammar_string,
+                    self.model,
+                    self.tokenizer,
+                )
 
         # Set banned strings
         if gen_params.banned_strings and len(grammar_handler.filters) > 0:
@@ -1067,8 +1041,12 @@ class ExllamaV2Container:
         self.generator.speculative_ngram = gen_params.speculative_ngram
 
         # Store the gen settings for logging purposes
-        # Deepcopy to save a snapshot of vars
-        gen_settings_log_dict = deepcopy(vars(gen_settings))
+        # Deepcopy to save a snapshot of vars, which is skipped if unused
+        gen_settings_log_dict = (
+            deepcopy(vars(gen_settings))
+            if config.logging.log_generation_params
+            else None
+        )
 
         # Set banned tokens
         if gen_params.banned_tokens:
@@ -1114,12 +1092,13 @@ class ExllamaV2Container:
             stop_conditions += eos_tokens
 
         # Encode both positive and negative prompts
-        input_ids = [
-            self.tokenizer.encode(
-                prompt, add_bos=gen_params.add_bos_token, encode_special_tokens=True
-            )
-            for prompt in prompts
-        ]
+        with start_span("tokenize"):
+            input_ids = [
+                self.tokenizer.encode(
+                    prompt, add_bos=gen_params.add_bos_token, encode_special_tokens=True
+                )
+                for prompt in prompts
+            ]
 
         # The first index will always be the positive prompt
         context_len = input_ids[0].size(dim=-1)
@@ -1140,14 +1119,16 @@ class ExllamaV2Container:
 
         # Log prompt to console. Add the BOS token if specified
         log_prompt(
-            f"{self.tokenizer.bos_token if gen_params.add_bos_token else ''}{prompt}",
+            prompt,
             request_id,
             negative_prompt,
+            self.tokenizer.bos_token if gen_params.add_bos_token else None,
         )
 
         # Create and add a new job
         # Don't use the request ID here as there can be multiple jobs per request
         job_id = uuid.uuid4().hex
+        job_span = start_span("job", job_id=job_id, context_len=context_len)
         job = ExLlamaV2DynamicJobAsync(
             self.generator,
             input_ids=input_ids,
@@ -1186,6 +1167,9 @@ class ExllamaV2Container:
                 result_id = result.get("identifier")
 
                 if stage == "streaming" and result_id == job_id:
+                    if first_token_time is None:
+                        first_token_time = time.perf_counter() - start_time
+
                     chunk = unwrap(result.get("text"), "")
                     full_response += chunk
 
@@ -1248,6 +1232,11 @@ class ExllamaV2Container:
                         generation = {
                             "prompt_tokens": generation.get("prompt_tokens"),
                             "generated_tokens": generation.get("generated_tokens"),
+                            "cached_tokens": result.get("cached_tokens"),
+                            "queue_time": result.get("time_enqueued"),
+                            "first_token_time": first_token_time,
+                            "prompt_time": result.get("time_prefill"),
+                            "generate_time": result.get("time_generate"),
                             "finish_reason": finish_reason,
                             "stop_str": stop_str,
                         }
@@ -1265,6 +1254,7 @@ class ExllamaV2Container:
                 "If this fails, please restart the server.\n"
             )
             await HealthManager.add_unhealthy_event(ex)
+            job_span.set_error(str(ex))
 
             asyncio.ensure_future(self.create_generator())
 
@@ -1272,28 +1262,29 @@ class ExllamaV2Container:
         finally:
             # Log generation options to console
             # Some options are too large, so log the args instead
-            log_generation_params(
-                request_id=request_id,
-                max_tokens=max_tokens,
-                min_tokens=gen_params.min_tokens,
-                stream=gen_params.stream,
-                **gen_settings_log_dict,
-                token_healing=gen_params.token_healing,
-                auto_scale_penalty_range=auto_scale_penalty_range,
-                bos_token_id=self.tokenizer.bos_token_id,
-                eos_token_id=eos_tokens,
-                add_bos_token=gen_params.add_bos_token,
-                ban_eos_token=gen_params.ban_eos_token,
-                skip_special_tokens=not decode_special_tokens,
-                speculative_ngram=self.generator.speculative_ngram,
-                logprobs=request_logprobs,
-                stop_conditions=stop_conditions,
-                banned_tokens=gen_params.banned_tokens,
-                allowed_tokens=gen_params.allowed_tokens,
-                banned_strings=gen_params.banned_strings,
-                logit_bias=gen_params.logit_bias,
-                filters=grammar_handler.filters,
-            )
+            if gen_settings_log_dict is not None:
+                log_generation_params(
+                    request_id=request_id,
+                    max_tokens=max_tokens,
+                    min_tokens=gen_params.min_tokens,
+                    stream=gen_params.stream,
+                    **gen_settings_log_dict,
+                    token_healing=gen_params.token_healing,
+                    auto_scale_penalty_range=auto_scale_penalty_range,
+                    bos_token_id=self.tokenizer.bos_token_id,
+                    eos_token_id=eos_tokens,
+                    add_bos_token=gen_params.add_bos_token,
+                    ban_eos_token=gen_params.ban_eos_token,
+                    skip_special_tokens=not decode_special_tokens,
+                    speculative_ngram=self.generator.speculative_ngram,
+                    logprobs=request_logprobs,
+                    stop_conditions=stop_conditions,
+                    banned_tokens=gen_params.banned_tokens,
+                    allowed_tokens=gen_params.allowed_tokens,
+                    banned_strings=gen_params.banned_strings,
+                    logit_bias=gen_params.logit_bias,
+                    filters=grammar_handler.filters,
+                )
 
             # Log the metrics if present
             if metrics_result:
@@ -1308,3 +1299,19 @@ class ExllamaV2Container:
                     context_len,
                     max_seq_len,
                 )
+
+                # The job only reports durations, so lay its stages out in order
+                job_span.set_attribute(
+                    "cached_tokens", metrics_result.get("cached_tokens")
+                )
+                job_span.set_attribute(
+                    "generated_tokens", metrics_result.get("new_tokens")
+                )
+                record_stages(
+                    job_span,
+                    queue=metrics_result.get("time_enqueued"),
+                    prefill=metrics_result.get("time_prefill"),
+                    decode=metrics_result.get("time_generate"),
+                )
+
+            job_span.end()
@@ -0,0 +1,707 @@
+"""
+Regex constraint engine backed by token-level DFA transition tables.
+
+A pattern is parsed, compiled to a Thompson NFA and determinized. The DFA is
+then lifted to the token level: for every DFA state reachable at a token
+boundary, each vocabulary token either dies or moves to another state. The
+resulting (state x token -> state) table is built once per pattern and
+vocabulary, cached on disk and turns per-step masking into a lookup.
+
+Patterns must match the whole generation. Backreferences, lookarounds,
+inline flags and word boundaries aren't supported and raise a ValueError so
+callers can fall back to another engine.
+"""
+
+import hashlib
+import pathlib
+from bisect import bisect_right
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from backends.exllamav2.vocab import (
+    MAX_CODEPOINT,
+    MaskCache,
+    TokenMask,
+    TokenVocabulary,
+)
+
+# Bump when the on-disk table format changes
+TABLE_VERSION = 1
+
+MAX_REPEAT = 1000
+MAX_DFA_STATES = 4096
+MAX_CACHED_MASKS = 64
+
+Intervals = Tuple[Tuple[int, int], ...]
+
+ANY_CHAR: Intervals = ((0, 9), (11, MAX_CODEPOINT))
+DIGIT: Intervals = ((48, 57),)
+WORD: Intervals = ((48, 57), (65, 90), (95, 95), (97, 122))
+SPACE: Intervals = ((9, 13), (32, 32))
+
+SIMPLE_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "0": "\0"}
+
+
+def _normalize(intervals) -> Intervals:
+    """Sorts and merges overlapping or adjacent intervals."""
+
+    merged = []
+    for low, high in sorted(intervals):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], high)
+        else:
+            merged.append([low, high])
+
+    return tuple((low, high) for low, high in merged)
+
+
+def _negate(intervals: Intervals) -> Intervals:
+    negated = []
+    start = 0
+    for low, high in _normalize(intervals):
+        if low > start:
+            negated.append((start, low - 1))
+        start = high + 1
+
+    if start <= MAX_CODEPOINT:
+        negated.append((start, MAX_CODEPOINT))
+
+    return tuple(negated)
+
+
+def _char(char: str) -> Intervals:
+    return ((ord(char), ord(char)),)
+
+
+class _Parser:
+    """Recursive descent parser from a regex pattern to a small AST."""
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.pos = 0
+
+    def parse(self):
+        # Generations are always matched in full, so edge anchors are implied
+        if self.pattern.startswith("^"):
+            self.pos = 1
+
+        end = len(self.pattern)
+        if self.pattern.endswith("$") and not self.pattern.endswith("\\$"):
+            end -= 1
+
+        self.pattern = self.pattern[:end]
+        node = self._alternation()
+
+        if self.pos != len(self.pattern):
+            raise ValueError(f"Unexpected '{self.pattern[self.pos]}' at {self.pos}")
+
+        return node
+
+    def _peek(self) -> Optional[str]:
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def _next(self) -> str:
+        if self.pos >= len(self.pattern):
+            raise ValueError("Unexpected end of pattern")
+
+        char = self.pattern[self.pos]
+        self.pos += 1
+        return char
+
+    def _alternation(self):
+        branches = [self._concat()]
+        while self._peek() == "|":
+            self.pos += 1
+            branches.append(self._concat())
+
+        return branches[0] if len(branches) == 1 else ("alt", branches)
+
+    def _concat(self):
+        items = []
+        while self._peek() not in (None, "|", ")"):
+            items.append(self._repeat())
+
+        return ("cat", items)
+
+    def _repeat(self):
+        node = self._atom()
+
+        while True:
+            char = self._peek()
+            if char == "*":
+                bounds = (0, None)
+            elif char == "+":
+                bounds = (1, None)
+            elif char == "?":
+                bounds = (0, 1)
+            elif char == "{":
+                bounds = self._braces()
+                if bounds is None:
+                    return node
+            else:
+                return node
+
+            if char != "{":
+                self.pos += 1
+
+            # Laziness doesn't change the language of a full match
+            if self._peek() in ("?", "+"):
+                self.pos += 1
+
+            low, high = bounds
+            if low > MAX_REPEAT or (high is not None and high > MAX_REPEAT):
+                raise ValueError(f"Repetition counts above {MAX_REPEAT} are too big")
+            if high is not None and high < low:
+                raise ValueError("Invalid repetition range")
+
+            node = ("repeat", node, low, high)
+
+    def _braces(self):
+        """Parses {m}, {m,} or {m,n}. Anything else is a literal brace."""
+
+        close = self.pattern.find("}", self.pos)
+        if close == -1:
+            return None
+
+        body = self.pattern[self.pos + 1 : close]
+        low, comma, high = body.partition(",")
+        if not low.isdigit() or (high and not high.isdigit()):
+            return None
+
+        self.pos = close + 1
+        if not comma:
+            return int(low), int(low)
+
+        return int(low), int(high) if high else None
+
+    def _atom(self):
+        char = self._next()
+
+        if char == "(":
+            if self.pattern.startswith("?:", self.pos):
+                self.pos += 2
+            elif self.pattern.startswith("?P<", self.pos):
+                self.pos = self.pattern.index(">", self.pos) + 1
+            elif self._peek() == "?":
+                raise ValueError("Lookarounds and inline flags aren't supported")
+
+            node = self._alternation()
+            if self._next() != ")":
+                raise ValueError("Unbalanced parenthesis")
+
+            return node
+
+        if char == "[":
+            return ("set", self._class())
+        if char == ".":
+            return ("set", ANY_CHAR)
+        if char == "\\":
+            return ("set", self._escape(in_class=False))
+        if char in "^$":
+            raise ValueError("Anchors are only supported at the pattern edges")
+        if char in "*+?":
+            raise ValueError(f"Nothing to repeat at {self.pos - 1}")
+        if char == ")":
+            raise ValueError("Unbalanced parenthesis")
+
+        return ("set", _char(char))
+
+    def _escape(self, in_class: bool) -> Intervals:
+        char = self._next()
+
+        if char == "d":
+            return DIGIT
+        if char == "w":
+            return WORD
+        if char == "s":
+            return SPACE
+        if char == "D":
+            return _negate(DIGIT)
+        if char == "W":
+            return _negate(WORD)
+        if char == "S":
+            return _negate(SPACE)
+        if char in SIMPLE_ESCAPES:
+            return _char(SIMPLE_ESCAPES[char])
+        if char in "xu":
+            width = 2 if char == "x" else 4
+            digits = self.pattern[self.pos : self.pos + width]
+            try:
+                codepoint = int(digits, 16)
+            except ValueError as exc:
+                raise ValueError(f"Invalid \\{char} escape") from exc
+
+            self.pos += width
+            return ((codepoint, codepoint),)
+        if char == "b" and in_class:
+            return _char("\b")
+        if char.isalnum():
+            raise ValueError(f"Unsupported escape \\{char}")
+
+        return _char(char)
+
+    def _class(self) -> Intervals:
+        negate = self._peek() == "^"
+        if negate:
+            self.pos += 1
+
+        intervals = []
+        first = True
+        while True:
+            char = self._next()
+            if char == "]" and not first:
+                break
+
+            first = False
+            if char == "\\":
+                item = self._escape(in_class=True)
+            else:
+                item = _char(char)
+
+            # Ranges only apply between two single characters
+            if (
+                self._peek() == "-"
+                and len(item) == 1
+                and item[0][0] == item[0][1]
+                and self.pattern[self.pos + 1 : self.pos + 2] not in ("]", "")
+            ):
+                self.pos += 1
+                end_char = self._next()
+                end = self._escape(in_class=True) if end_char == "\\" else None
+                high = end[0][0] if end else ord(end_char)
+                if high < item[0][0]:
+                    raise ValueError("Bad character range")
+
+                item = ((item[0][0], high),)
+
+            intervals.extend(item)
+
+        intervals = _normalize(intervals)
+        return _negate(intervals) if negate else intervals
+
+
+class _Nfa:
+    """Thompson NFA with interval-labelled edges."""
+
+    def __init__(self):
+        self.edges: List[List[Tuple[Intervals, int]]] = []
+        self.epsilons: List[List[int]] = []
+
+    def state(self) -> int:
+        self.edges.append([])
+        self.epsilons.append([])
+        return len(self.edges) - 1
+
+    def build(self, node) -> Tuple[int, int]:
+        kind = node[0]
+        start = self.state()
+
+        if kind == "set":
+            end = self.state()
+            self.edges[start].append((node[1], end))
+        elif kind == "cat":
+            end = start
+            for item in node[1]:
+                item_start, item_end = self.build(item)
+                self.epsilons[end].append(item_start)
+                end = item_end
+        elif kind == "alt":
+            end = self.state()
+            for branch in node[1]:
+                branch_start, branch_end = self.build(branch)
+                self.epsilons[start].append(branch_start)
+                self.epsilons[branch_end].append(end)
+        else:
+            _, inner, low, high = node
+            end = start
+
+            for _ in range(low):
+                item_start, item_end = self.build(inner)
+                self.epsilons[end].append(item_start)
+                end = item_end
+
+            if high is None:
+                loop = self.state()
+                item_start, item_end = self.build(inner)
+                self.epsilons[end].append(loop)
+                self.epsilons[loop].append(item_start)
+                self.epsilons[item_end].append(loop)
+                end = loop
+            else:
+                exit_state = self.state()
+                for _ in range(high - low):
+                    item_start, item_end = self.build(inner)
+                    self.epsilons[end].append(item_start)
+                    self.epsilons[end].append(exit_state)
+                    end = item_end
+
+                self.epsilons[end].append(exit_state)
+                end = exit_state
+
+        return start, end
+
+    def closure(self, states) -> FrozenSet[int]:
+        stack = list(states)
+        seen = set(stack)
+        while stack:
+            for target in self.epsilons[stack.pop()]:
+                if target not in seen:
+                    seen.add(target)
+                    stack.append(target)
+
+        return frozenset(seen)
+
+
+class Dfa:
+    """Character-level DFA with interval transitions per state."""
+
+    lows: List[List[int]]
+    highs: List[List[int]]
+    targets: List[List[int]]
+    accepting: List[bool]
+
+    def __init__(self, pattern: str):
+        nfa = _Nfa()
+        nfa_start, nfa_accept = nfa.build(_Parser(pattern).parse())
+
+        self.lows, self.highs, self.targets, self.accepting = [], [], [], []
+        self._char_cache: List[Dict[str, Optional[int]]] = []
+
+        start_set = nfa.closure([nfa_start])
+        index = {start_set: 0}
+        pending = [start_set]
+
+        while pending:
+            state_set = pending.pop()
+            if len(index) > MAX_DFA_STATES:
+                raise ValueError("Pattern is too complex to compile to a DFA")
+
+            labelled = [
+                (low, high, target)
+                for nfa_state in state_set
+                for intervals, target in nfa.edges[nfa_state]
+                for low, high in intervals
+            ]
+
+            # Split the alphabet at every interval boundary
+            points = sorted(
+                {low for low, _, _ in labelled} | {high + 1 for _, high, _ in labelled}
+            )
+
+            lows, highs, targets = [], [], []
+            for low, next_point in zip(points, points[1:], strict=False):
+                nfa_targets = [
+                    target
+                    for edge_low, edge_high, target in labelled
+                    if edge_low <= low <= edge_high
+                ]
+                if not nfa_targets:
+                    continue
+
+                target_set = nfa.closure(nfa_targets)
+                if target_set not in index:
+                    index[target_set] = len(index)
+                    pending.append(target_set)
+
+                target = index[target_set]
+
+                # Merge adjacent segments with the same target
+                if targets and targets[-1] == target and highs[-1] == low - 1:
+                    highs[-1] = next_point - 1
+                else:
+                    lows.append(low)
+                    highs.append(next_point - 1)
+                    targets.append(target)
+
+            self._set_state(index[state_set], lows, highs, targets)
+            self.accepting[index[state_set]] = nfa_accept in state_set
+
+        self._minimize()
+
+    def _transitions(self, state: int, blocks: List[int]):
+        """Transitions of a state with targets mapped to blocks."""
+
+        transitions = []
+        for low, high, target in zip(
+            self.lows[state], self.highs[state], self.targets[state], strict=True
+        ):
+            block = blocks[target]
+            if transitions and transitions[-1][2] == block:
+                if transitions[-1][1] == low - 1:
+                    transitions[-1] = (transitions[-1][0], high, block)
+                    continue
+
+            transitions.append((low, high, block))
+
+        return tuple(transitions)
+
+    def _minimize(self):
+        """
+        Merges equivalent states by partition refinement.
+
+        Subset construction leaves duplicates behind, and every duplicate
+        would become a separate row in token tables and mask caches.
+        """
+
+        count = len(self.accepting)
+        blocks = [int(accepting) for accepting in self.accepting]
+        block_count = len(set(blocks))
+
+        while True:
+            signatures = {}
+            refined = [
+                signatures.setdefault(
+                    (blocks[state], self._transitions(state, blocks)),
+                    len(signatures),
+                )
+                for state in range(count)
+            ]
+
+            # Refinement only ever splits blocks, so an equal count is stable
+            blocks = refined
+            if len(signatures) == block_count:
+                break
+
+            block_count = len(signatures)
+
+        if block_count == count:
+            return
+
+        # Blocks are numbered by first appearance, so the start state stays 0
+        representatives = {}
+        for state, block in enumerate(blocks):
+            representatives.setdefault(block, state)
+
+        accepting = self.accepting
+        transitions = [
+            self._transitions(representatives[block], blocks)
+            for block in range(block_count)
+        ]
+
+        self.lows, self.highs, self.targets, self.accepting = [], [], [], []
+        self._char_cache = []
+        for block, block_transitions in enumerate(transitions):
+            self._set_state(
+                block,
+                [low for low, _, _ in block_transitions],
+                [high for _, high, _ in block_transitions],
+                [target for _, _, target in block_transitions],
+            )
+            self.accepting[block] = accepting[representatives[block]]
+
+    def _set_state(self, state: int, lows, highs, targets):
+        while len(self.lows) <= state:
+            self.lows.append([])
+            self.highs.append([])
+            self.targets.append([])
+            self.accepting.append(False)
+            self._char_cache.append({})
+
+        self.lows[state] = lows
+        self.highs[state] = highs
+        self.targets[state] = targets
+
+    def next_state(self, state: int, char: str) -> Optional[int]:
+        """Returns the target state for a character, or None if it's dead."""
+
+        cache = self._char_cache[state]
+        try:
+            return cache[char]
+        except KeyError:
+            codepoint = ord(char)
+            position = bisect_right(self.lows[state], codepoint) - 1
+
+            target = None
+            if position >= 0 and codepoint <= self.highs[state][position]:
+                target = self.targets[state][position]
+
+            cache[char] = target
+            return target
+
+
+def table_key(pattern: str, vocab: TokenVocabulary) -> str:
+    """Key of a compiled table for a pattern and vocabulary."""
+
+    digest = hashlib.sha256(
+        f"{TABLE_VERSION}\x00{vocab.fingerprint}\x00{pattern}".encode(
+            "utf-8", "surrogatepass"
+        )
+    )
+    return digest.hexdigest()
+
+
+class RegexEngine:
+    """
+    Token-level transition table for a regex constraint.
+
+    States are integers with 0 as the start state. Row s of the table holds
+    the sorted token ids that are valid from state s and their next states.
+    """
+
+    def __init__(
+        self,
+        offsets: np.ndarray,
+        token_ids: np.ndarray,
+        next_states: np.ndarray,
+        accepting: np.ndarray,
+        eos_token_ids: List[int],
+    ):
+        self.offsets = offsets
+        self.token_ids = token_ids
+        self.next_states = next_states
+        self.accepting = accepting
+        self.eos_token_ids = eos_token_ids
+        self.masks = MaskCache(MAX_CACHED_MASKS)
+
+    @property
+    def state_count(self) -> int:
+        return len(self.accepting)
+
+    @classmethod
+    def compile(cls, pattern: str, vocab: TokenVocabulary):
+        """Compiles a pattern to a token-level transition table."""
+
+        dfa = Dfa(pattern)
+
+        # Only DFA states reachable at token boundaries get a row
+        index = {0: 0}
+        order = [0]
+        rows = []
+
+        while len(rows) < len(order):
+            dfa_state = order[len(rows)]
+            row_tokens, row_targets = vocab.walk(dfa_state, dfa.next_state)
+
+            mapped_targets = []
+            for target in row_targets:
+                if target not in index:
+                    index[target] = len(order)
+                    order.append(target)
+
+                mapped_targets.append(index[target])
+
+            row_tokens = np.asarray(row_tokens, dtype=np.int32)
+            row_targets = np.asarray(mapped_targets, dtype=np.int32)
+            sort_order = np.argsort(row_tokens, kind="stable")
+            rows.append((row_tokens[sort_order], row_targets[sort_order]))
+
+        accepting = np.array([dfa.accepting[state] for state in order], dtype=bool)
+
+        # Drop transitions into states that can't reach a match with this
+        # vocabulary, otherwise generation could get stuck in them
+        live = accepting.copy()
+        changed = True
+        while changed:
+            changed = False
+            for state, (_, row_targets) in enumerate(rows):
+                if not live[state] and live[row_targets].any():
+                    live[state] = True
+                    changed = True
+
+        rows = [
+            (row_tokens[live[row_targets]], row_targets[live[row_targets]])
+            for row_tokens, row_targets in rows
+        ]
+
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(row_tokens) for row_tokens, _ in rows])
+
+        empty = np.zeros(0, dtype=np.int32)
+        token_ids = np.concatenate([row[0] for row in rows] or [empty])
+        next_states = np.concatenate([row[1] for row in rows] or [empty])
+
+        return cls(offsets, token_ids, next_states, accepting, vocab.eos_token_ids)
+
+    @classmethod
+    def load_or_compile(
+        cls,
+        pattern: str,
+        vocab: TokenVocabulary,
+        cache_dir: Optional[pathlib.Path] = None,
+    ):
+        """Loads a compiled table from the disk cache or compiles a new one."""
+
+        cache_path = None
+        if cache_dir:
+            cache_path = cache_dir / f"regex-{table_key(pattern, vocab)}.npz"
+
+            if cache_path.exists():
+                try:
+                    with np.load(cache_path) as table:
+                        return cls(
+                            table["offsets"],
+                            table["token_ids"],
+                            table["next_states"],
+                            table["accepting"],
+                            vocab.eos_token_ids,
+                        )
+                except Exception as exc:
+                    logger.warning(
+                        f"Recompiling regex table because {cache_path.name} "
+                        f"couldn't be read: {exc}"
+                    )
+
+        engine = cls.compile(pattern, vocab)
+
+        if cache_path:
+            try:
+                cache_dir.mkdir(parents=True, exist_ok=True)
+
+                # Write to a temporary file first so readers never see partial data
+                temp_path = cache_path.with_suffix(".tmp.npz")
+                np.savez(
+                    temp_path,
+                    offsets=engine.offsets,
+                    token_ids=engine.token_ids,
+                    next_states=engine.next_states,
+                    accepting=engine.accepting,
+                )
+                temp_path.replace(cache_path)
+            except OSError as exc:
+                logger.warning(f"Couldn't save the regex table to {cache_dir}: {exc}")
+
+        return engine
+
+    def _row(self, state: int):
+        start, end = self.offsets[state], self.offsets[state + 1]
+        return self.token_ids[start:end], self.next_states[start:end]
+
+    def advance(self, state: Optional[int], token_id: int) -> Optional[int]:
+        """Looks up the next state for a sampled token."""
+
+        if state is None:
+            return None
+
+        row_tokens, row_targets = self._row(state)
+        position = np.searchsorted(row_tokens, token_id)
+        if position < len(row_tokens) and row_tokens[position] == token_id:
+            return int(row_targets[position])
+
+        return None
+
+    def get_mask(self, state: Optional[int]) -> TokenMask:
+        """Returns the memoized token mask for a state."""
+
+        if state is None:
+            return TokenMask(self.eos_token_ids, [])
+
+        return self.masks.get(state, lambda: self._compute_mask(state))
+
+    def _compute_mask(self, state: int) -> TokenMask:
+        row_tokens, row_targets = self._row(state)
+        row_lengths = np.diff(self.offsets)
+
+        # Tokens that complete the match with no way to continue end the filter
+        ends_match = self.accepting[row_targets] & (row_lengths[row_targets] == 0)
+
+        allowed = row_tokens.tolist()
+        if self.accepting[state]:
+            allowed = sorted(set(allowed).union(self.eos_token_ids))
+
+        # Never leave the sampler without a valid token
+        if not allowed:
+            allowed = list(self.eos_token_ids)
+
+        return TokenMask(allowed, row_tokens[ends_match].tolist())
@@ -0,0 +1,222 @@
+"""Shared vocabulary index used by the in-house grammar engines."""
+
+import hashlib
+import threading
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from functools import cached_property
+from typing import (
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+State = TypeVar("State")
+
+MAX_CODEPOINT = 0x10FFFF
+
+
+class TokenVocabulary:
+    """
+    Decoded token pieces of a tokenizer, indexed for constrained decoding.
+
+    Built once per loaded model and shared between every grammar engine and
+    request. Special tokens are excluded from the usable vocabulary so they can
+    never be emitted as part of constrained text.
+    """
+
+    pieces: List[str]
+    token_ids: List[int]
+    eos_token_ids: List[int]
+    by_first_char: Dict[str, List[int]]
+
+    def __init__(
+        self,
+        pieces: Sequence[str],
+        eos_token_ids: Sequence[int],
+        excluded_ids: Optional[Set[int]] = None,
+    ):
+        excluded_ids = excluded_ids or set()
+
+        self.pieces = list(pieces)
+        self.eos_token_ids = sorted(set(eos_token_ids))
+
+        # Token ids that can appear inside constrained text
+        self.token_ids = [
+            token_id
+            for token_id, piece in enumerate(self.pieces)
+            if piece and token_id not in excluded_ids
+        ]
+
+        # Grouping by first character lets engines reject most of the
+        # vocabulary with a single state transition per group
+        by_first_char = defaultdict(list)
+        for token_id in self.token_ids:
+            by_first_char[self.pieces[token_id][0]].append(token_id)
+
+        self.by_first_char = dict(by_first_char)
+
+    def __len__(self):
+        return len(self.pieces)
+
+    @cached_property
+    def sorted_tokens(self):
+        """Usable token pieces in lexicographic order with their ids."""
+
+        ordered = sorted(self.token_ids, key=self.pieces.__getitem__)
+        return [self.pieces[token_id] for token_id in ordered], ordered
+
+    def walk(
+        self, state: State, step: Callable[[State, str], Optional[State]]
+    ) -> Tuple[List[int], List[State]]:
+        """
+        Runs every usable token from a character-level grammar state.
+
+        Pieces are walked in sorted order so shared prefixes are only
+        evaluated once, and every token behind a dead prefix is skipped.
+        Returns the surviving token ids with the state each one leads to.
+        """
+
+        sorted_pieces, sorted_ids = self.sorted_tokens
+        token_ids, next_states = [], []
+        states = [state]
+        previous = ""
+        position = 0
+        count = len(sorted_pieces)
+
+        while position < count:
+            piece = sorted_pieces[position]
+
+            common = 0
+            limit = min(len(previous), len(piece), len(states) - 1)
+            while common < limit and previous[common] == piece[common]:
+                common += 1
+
+            del states[common + 1 :]
+            current = states[-1]
+            dead_at = None
+
+            for offset in range(common, len(piece)):
+                current = step(current, piece[offset])
+                if current is None:
+                    dead_at = offset
+                    break
+
+                states.append(current)
+
+            previous = piece
+            if dead_at is None:
+                token_ids.append(sorted_ids[position])
+                next_states.append(current)
+                position += 1
+                continue
+
+            # Jump past every piece that starts with the dead prefix
+            dead_prefix = piece[: dead_at + 1]
+            last = ord(dead_prefix[-1])
+            if last == MAX_CODEPOINT:
+                position += 1
+            else:
+                successor = dead_prefix[:-1] + chr(last + 1)
+                position = bisect_left(sorted_pieces, successor, lo=position + 1)
+
+        return token_ids, next_states
+
+    @cached_property
+    def fingerprint(self) -> str:
+        """Stable hash of the vocabulary for keying on-disk caches."""
+
+        digest = hashlib.sha256()
+        for token_id in self.token_ids:
+            digest.update(
+                f"{token_id}\x00{self.pieces[token_id]}\x00".encode(
+                    "utf-8", "surrogatepass"
+                )
+            )
+
+        digest.update(repr(self.eos_token_ids).encode())
+        return digest.hexdigest()
+
+    @classmethod
+    def from_exllamav2(cls, tokenizer):
+        """Create a vocabulary index from an ExLlamaV2 tokenizer."""
+
+        special_ids = set(tokenizer.extended_id_to_piece.keys())
+        special_ids.update(
+            token_id
+            for token_id in (
+                tokenizer.bos_token_id,
+                tokenizer.eos_token_id,
+                tokenizer.pad_token_id,
+                tokenizer.unk_token_id,
+            )
+            if token_id is not None
+        )
+
+        return cls(
+            tokenizer.get_id_to_piece_list(),
+            eos_token_ids=[tokenizer.eos_token_id],
+            excluded_ids=special_ids,
+        )
+
+
+class TokenMask:
+    """
+    Allowed and filter-ending token ids for a single grammar state.
+
+    Masks are memoized by the engines and shared between requests, so the
+    returned containers must be treated as read-only.
+    """
+
+    allowed: List[int]
+    end: List[int]
+
+    def __init__(self, allowed: List[int], end: List[int]):
+        self.allowed = allowed
+        self.end = end
+        self._sets = None
+
+    def as_sets(self):
+        """Lazily converts the mask to sets for filters that can't take lists."""
+
+        if self._sets is None:
+            self._sets = (frozenset(self.allowed), frozenset(self.end))
+
+        return self._sets
+
+
+class MaskCache:
+    """Thread-safe LRU memo of token masks (or rows) keyed by grammar state."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._masks: OrderedDict[Hashable, TokenMask] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, compute: Callable[[], TokenMask]) -> TokenMask:
+        """Returns the memoized mask for a key, computing it on a miss."""
+
+        with self._lock:
+            mask = self._masks.get(key)
+            if mask is not None:
+                self._masks.move_to_end(key)
+                return mask
+
+        # Compute outside the lock since it may walk the whole vocabulary
+        mask = compute()
+
+        with self._lock:
+            self._masks[key] = mask
+            if len(self._masks) > self.max_size:
+                self._masks.popitem(last=False)
+
+        return mask
+
+    def __len__(self):
+        return len(self._masks)
@@ -0,0 +1,166 @@
+"""Micro-batching of embedding inputs across concurrent requests."""
+
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from pydantic import BaseModel, Field
+
+
+class EmbeddingBatchStats(BaseModel):
+    """Embedding batch counters since the model was loaded"""
+
+    batches: int = Field(0, description="Batches sent to the engine")
+    requests: int = Field(0, description="Requests served by those batches")
+    inputs: int = Field(0, description="Inputs embedded in those batches")
+    max_batch_size: int = Field(0, description="Largest batch sent to the engine")
+    avg_batch_size: float = Field(0.0, description="Inputs per batch")
+    avg_requests_per_batch: float = Field(0.0, description="Requests per batch")
+
+
+class PendingRequest:
+    """Inputs of one request waiting for a batch"""
+
+    def __init__(self, sentences: List[str]):
+        self.sentences = sentences
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class EmbeddingBatcher:
+    """
+    Collects inputs of concurrent requests into shared engine batches.
+
+    A batch is sent once it holds max_batch_size inputs or the oldest
+    request has waited for max_wait seconds. Inputs are sorted by length
+    to keep padding low, and results are scattered back per request.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[List[str]], Awaitable[Tuple[list, int]]],
+        max_batch_size: int,
+        max_wait: float,
+    ):
+        self.embed_func = embed
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = EmbeddingBatchStats()
+
+        self._pending: List[PendingRequest] = []
+        self._pending_inputs = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+
+    async def embed(self, sentences: List[str]):
+        """Embeds inputs as part of a shared batch."""
+
+        pending = PendingRequest(sentences)
+        self._pending.append(pending)
+        self._pending_inputs += len(sentences)
+
+        if self._pending_inputs >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.max_wait, self._flush
+            )
+
+        return await pending.future
+
+    def get_stats(self):
+        """Returns a snapshot of the batch counters."""
+
+        batches = self.stats.batches
+        return self.stats.model_copy(
+            update={
+                "avg_batch_size": self.stats.inputs / batches if batches else 0.0,
+                "avg_requests_per_batch": (
+                    self.stats.requests / batches if batches else 0.0
+                ),
+            }
+        )
+
+    def _flush(self):
+        """Sends pending requests to the engine in batches."""
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        # Requests whose clients stopped waiting don't need embedding
+        for request in self._pending:
+            if request.future.cancelled():
+                self._pending_inputs -= len(request.sentences)
+
+        self._pending = [
+            request for request in self._pending if not request.future.cancelled()
+        ]
+
+        while self._pending:
+            batch = [self._pending.pop(0)]
+            batch_size = len(batch[0].sentences)
+
+            while (
+                self._pending
+                and batch_size + len(self._pending[0].sentences) <= self.max_batch_size
+            ):
+                batch_size += len(self._pending[0].sentences)
+                batch.append(self._pending.pop(0))
+
+            self._pending_inputs -= batch_size
+
+            task = asyncio.create_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: List[PendingRequest]):
+        """Embeds a batch and resolves the futures of its requests."""
+
+        # Longest inputs first so similar lengths share padded sub-batches
+        positions = [
+            (request_idx, sentence_idx)
+            for request_idx, request in enumerate(batch)
+            for sentence_idx in range(len(request.sentences))
+        ]
+        positions.sort(
+            key=lambda position: len(batch[position[0]].sentences[position[1]]),
+            reverse=True,
+        )
+
+        sentences = [
+            batch[request_idx].sentences[sentence_idx]
+            for request_idx, sentence_idx in positions
+        ]
+
+        self.stats.batches += 1
+        self.stats.requests += len(batch)
+        self.stats.inputs += len(sentences)
+        self.stats.max_batch_size = max(self.stats.max_batch_size, len(sentences))
+
+        try:
+            embeddings, usage = await self.embed_func(sentences)
+        except Exception as exc:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(exc)
+
+            return
+
+        results = [[None] * len(request.sentences) for request in batch]
+        for (request_idx, sentence_idx), embedding in zip(
+            positions, embeddings, strict=True
+        ):
+            results[request_idx][sentence_idx] = embedding
+
+        # Split usage by input length, rounding so the shares add up
+        total_chars = max(sum(len(sentence) for sentence in sentences), 1)
+        counted_chars = 0
+        counted_usage = 0
+
+        for request, request_embeddings in zip(batch, results, strict=True):
+            counted_chars += sum(len(sentence) for sentence in request.sentences)
+            request_usage = usage * counted_chars // total_chars - counted_usage
+            counted_usage += request_usage
+
+            # The request may have been cancelled while waiting
+            if not request.future.done():
+                request.future.set_result((request_embeddings, request_usage))
@@ -0,0 +1,90 @@
+"""Token-aware chunking of long embedding inputs and pooling of the chunks."""
+
+import json
+import pathlib
+from typing import List
+
+import numpy as np
+
+# Used when neither the model nor its tokenizer declare a max length
+DEFAULT_MAX_LENGTH = 512
+
+
+def get_max_length(model_dir: pathlib.Path, tokenizer):
+    """Finds the max input length of an embedding model in tokens."""
+
+    # Sentence transformers models declare the length the engine truncates at
+    sbert_config_path = model_dir / "sentence_bert_config.json"
+    if sbert_config_path.exists():
+        with open(sbert_config_path, "r", encoding="utf8") as sbert_config_file:
+            max_length = json.load(sbert_config_file).get("max_seq_length")
+
+        if max_length:
+            return max_length
+
+    # Tokenizers without a limit report a huge sentinel value
+    if tokenizer.model_max_length < 1e6:
+        return tokenizer.model_max_length
+
+    return DEFAULT_MAX_LENGTH
+
+
+class DocumentChunker:
+    """Splits texts into overlapping windows that fit an embedding model"""
+
+    def __init__(self, tokenizer, max_length: int):
+        self.tokenizer = tokenizer
+
+        # Leave room for the special tokens added around each chunk
+        self.window = max_length - tokenizer.num_special_tokens_to_add()
+
+    def split(self, text: str, overlap: int):
+        """
+        Splits a text into chunks of at most one window of tokens.
+        Returns the chunk texts and their token counts.
+        """
+
+        encoding = self.tokenizer(
+            text,
+            add_special_tokens=False,
+            return_offsets_mapping=self.tokenizer.is_fast,
+        )
+        input_ids = encoding["input_ids"]
+
+        if len(input_ids) <= self.window:
+            return [text], [max(len(input_ids), 1)]
+
+        overlap = min(overlap, self.window - 1)
+        step = self.window - overlap
+
+        chunks = []
+        token_counts = []
+        for start in range(0, len(input_ids) - overlap, step):
+            end = min(start + self.window, len(input_ids))
+
+            # Slice the original text where possible to keep it verbatim
+            if self.tokenizer.is_fast:
+                offsets = encoding["offset_mapping"]
+                chunks.append(text[offsets[start][0] : offsets[end - 1][1]])
+            else:
+                chunks.append(self.tokenizer.decode(input_ids[start:end]))
+
+            token_counts.append(end - start)
+
+        return chunks, token_counts
+
+
+def pool_chunks(embeddings: np.ndarray, token_counts: List[int], method: str):
+    """Pools the chunk embeddings of one input into a single vector."""
+
+    if method == "first" or len(embeddings) == 1:
+        return embeddings[0]
+
+    if method == "max":
+        pooled = embeddings.max(axis=0)
+    else:
+        # Longer chunks weigh more, so a short tail doesn't skew the mean
+        pooled = np.average(embeddings, axis=0, weights=token_counts)
+
+    norm = np.linalg.norm(pooled)
+    return pooled / norm if norm else pooled
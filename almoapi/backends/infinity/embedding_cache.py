@@ -0,0 +1,290 @@
+"""
+Content-addressed cache of embeddings.
+
+Entries are keyed by the embedding model and a hash of the normalized input
+text. Hot entries live in a memory LRU, and an optional disk tier keeps
+fixed-width records in a memory-mapped file that survives restarts.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import pathlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+# Size of a sha256 digest in the disk index
+DIGEST_SIZE = 32
+
+
+def text_key(model_name: str, text: str):
+    """Hashes an input text for a model after unicode normalization."""
+
+    normalized = unicodedata.normalize("NFC", text)
+    return hashlib.sha256(f"{model_name}\0{normalized}".encode()).digest()
+
+
+class EmbeddingDiskTier:
+    """
+    Fixed-width embedding records on disk.
+
+    Vectors are appended to a memory-mapped records file, and their key
+    digests to an index file in the same order. Writes stop once the
+    records reach the size budget.
+    """
+
+    def __init__(self, directory: pathlib.Path, dtype: str, max_bytes: int):
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.max_bytes = max_bytes
+
+        self.dim: Optional[int] = None
+        self.rows: Dict[bytes, int] = {}
+        self.lock = threading.Lock()
+
+        self._vectors: Optional[np.memmap] = None
+        self._full = False
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._open()
+
+    @property
+    def meta_path(self):
+        return self.directory / "meta.json"
+
+    @property
+    def vectors_path(self):
+        return self.directory / "vectors.bin"
+
+    @property
+    def index_path(self):
+        return self.directory / "index.bin"
+
+    def get_many(self, keys: List[bytes]):
+        """Returns float32 copies of the stored vectors, or None per key."""
+
+        with self.lock:
+            return [
+                np.array(self._vectors[self.rows[key]], dtype=np.float32)
+                if key in self.rows
+                else None
+                for key in keys
+            ]
+
+    def put_many(self, items: List[Tuple[bytes, np.ndarray]]):
+        """Appends new vectors to the records file."""
+
+        with self.lock:
+            if self.dim is None and items:
+                self.dim = len(items[0][1])
+                self.meta_path.write_text(
+                    json.dumps({"dim": self.dim, "dtype": self.dtype.name})
+                )
+
+            new_items = {
+                key: vector
+                for key, vector in items
+                if key not in self.rows and len(vector) == self.dim
+            }
+            if not new_items or self._full:
+                return
+
+            record_size = self.dim * self.dtype.itemsize
+            free_records = self.max_bytes // record_size - len(self.rows)
+            if free_records < len(new_items):
+                self._full = True
+                logger.warning(
+                    "The embedding cache disk tier is full. "
+                    "New embeddings will only be cached in memory."
+                )
+
+                new_items = dict(list(new_items.items())[: max(free_records, 0)])
+                if not new_items:
+                    return
+
+            vectors = np.stack(list(new_items.values())).astype(self.dtype)
+
+            # Records go first, so a torn write never indexes a missing vector
+            with open(self.vectors_path, "ab") as vectors_file:
+                vectors_file.write(vectors.tobytes())
+
+            with open(self.index_path, "ab") as index_file:
+                index_file.write(b"".join(new_items.keys()))
+
+            for key in new_items:
+                self.rows[key] = len(self.rows)
+
+            self._map()
+
+    def _open(self):
+        """Loads the index of an existing records file."""
+
+        if not self.meta_path.exists():
+            return
+
+        try:
+            meta = json.loads(self.meta_path.read_text())
+            dim, dtype = meta["dim"], meta["dtype"]
+        except (OSError, ValueError, KeyError) as exc:
+            logger.warning(f"Resetting the unreadable embedding cache: {exc}")
+            self._reset()
+            return
+
+        if dtype != self.dtype.name:
+            logger.warning(
+                f"Resetting the embedding cache since it stores {dtype} "
+                f"instead of {self.dtype.name} records."
+            )
+            self._reset()
+            return
+
+        self.dim = dim
+        record_size = dim * self.dtype.itemsize
+
+        digests = self.index_path.read_bytes() if self.index_path.exists() else b""
+        vectors_size = (
+            self.vectors_path.stat().st_size if self.vectors_path.exists() else 0
+        )
+        count = min(len(digests) // DIGEST_SIZE, vectors_size // record_size)
+
+        # Drop the tail of an interrupted write
+        for path, size in (
+            (self.vectors_path, count * record_size),
+            (self.index_path, count * DIGEST_SIZE),
+        ):
+            if path.exists():
+                os.truncate(path, size)
+
+        self.rows = {
+            digests[row * DIGEST_SIZE : (row + 1) * DIGEST_SIZE]: row
+            for row in range(count)
+        }
+        self._map()
+
+    def _map(self):
+        """Maps the records file into memory."""
+
+        if not self.rows:
+            self._vectors = None
+            return
+
+        self._vectors = np.memmap(
+            self.vectors_path,
+            dtype=self.dtype,
+            mode="r",
+            shape=(len(self.rows), self.dim),
+        )
+
+    def _reset(self):
+        for path in (self.meta_path, self.vectors_path, self.index_path):
+            path.unlink(missing_ok=True)
+
+
+class EmbeddingCache:
+    """Cache in front of an embedding model"""
+
+    def __init__(
+        self,
+        model_name: str,
+        max_memory_bytes: int,
+        disk_dir: Optional[pathlib.Path] = None,
+        disk_dtype: str = "float32",
+        max_disk_bytes: int = 0,
+    ):
+        self.model_name = model_name
+        self.max_memory_bytes = max_memory_bytes
+
+        self._entries: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        self._memory_bytes = 0
+
+        self.disk: Optional[EmbeddingDiskTier] = None
+        if disk_dir:
+            self.disk = EmbeddingDiskTier(
+                pathlib.Path(disk_dir) / model_name, disk_dtype, max_disk_bytes
+            )
+
+    async def embed(
+        self,
+        sentences: List[str],
+        embed_func: Callable[[List[str]], Awaitable[Tuple[list, int]]],
+    ):
+        """Embeds inputs, only sending cache misses to embed_func."""
+
+        keys = [text_key(self.model_name, sentence) for sentence in sentences]
+        results = [self._get_memory(key) for key in keys]
+
+        if self.disk:
+            disk_keys = [
+                key for key, result in zip(keys, results, strict=True) if result is None
+            ]
+            if disk_keys:
+                disk_results = await asyncio.to_thread(self.disk.get_many, disk_keys)
+                found = dict(zip(disk_keys, disk_results, strict=True))
+
+                for index, key in enumerate(keys):
+                    if results[index] is None and found.get(key) is not None:
+                        results[index] = found[key]
+                        self._put_memory(key, found[key])
+
+        # Duplicated inputs are only embedded once
+        missing: Dict[bytes, str] = {}
+        for key, sentence, result in zip(keys, sentences, results, strict=True):
+            if result is None:
+                missing.setdefault(key, sentence)
+
+        usage = 0
+        if missing:
+            embeddings, usage = await embed_func(list(missing.values()))
+            new_items = [
+                (key, np.asarray(embedding, dtype=np.float32))
+                for key, embedding in zip(missing.keys(), embeddings, strict=True)
+            ]
+
+            for key, vector in new_items:
+                self._put_memory(key, vector)
+
+            if self.disk:
+                await asyncio.to_thread(self.disk.put_many, new_items)
+
+            computed = dict(new_items)
+            results = [
+                computed[key] if result is None else result
+                for key, result in zip(keys, results, strict=True)
+            ]
+
+        cached = len(sentences) - len(missing)
+        bytes_saved = sum(len(sentence.encode()) for sentence in sentences) - sum(
+            len(sentence.encode()) for sentence in missing.values()
+        )
+
+        return {
+            "embeddings": results,
+            "usage": usage,
+            "cached": cached,
+            "hit_rate": cached / len(sentences) if sentences else 0.0,
+            "bytes_saved": bytes_saved,
+        }
+
+    def _get_memory(self, key: bytes):
+        vector = self._entries.get(key)
+        if vector is not None:
+            self._entries.move_to_end(key)
+
+        return vector
+
+    def _put_memory(self, key: bytes, vector: np.ndarray):
+        if key in self._entries:
+            return
+
+        self._entries[key] = vector
+        self._memory_bytes += vector.nbytes
+
+        while self._memory_bytes > self.max_memory_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
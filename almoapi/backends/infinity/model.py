@@ -1,26 +1,37 @@
+import asyncio
 import gc
+import numpy as np
 import pathlib
 import torch
 from loguru import logger
-from typing import List, Optional
+from typing import List, Optional, Union
 
+from backends.infinity.batching import EmbeddingBatcher
+from backends.infinity.chunking import DocumentChunker, get_max_length, pool_chunks
+from backends.infinity.embedding_cache import EmbeddingCache
+from backends.infinity.worker import EmbeddingWorkerPool
 from common.utils import unwrap
 from common.optional_dependencies import dependencies
+from config.config import config
 
 # Conditionally import infinity to sidestep its logger
 if dependencies.extras:
     from infinity_emb import EngineArgs, AsyncEmbeddingEngine
+    from transformers import AutoTokenizer
 
 
 class InfinityContainer:
     model_dir: pathlib.Path
     model_is_loading: bool = False
     model_loaded: bool = False
+    batcher: Optional[EmbeddingBatcher] = None
+    cache: Optional[EmbeddingCache] = None
+    chunker: Optional[DocumentChunker] = None
 
     # Conditionally set the type hint based on importablity
     # TODO: Clean this up
     if dependencies.extras:
-        engine: Optional[AsyncEmbeddingEngine] = None
+        engine: Optional[Union[AsyncEmbeddingEngine, EmbeddingWorkerPool]] = None
     else:
         engine = None
 
@@ -33,30 +44,129 @@ class InfinityContainer:
         # Use cpu by default
         device = unwrap(kwargs.get("embeddings_device"), "cpu")
 
-        engine_args = EngineArgs(
-            model_name_or_path=str(self.model_dir),
-            engine="torch",
-            device=device,
-            bettertransformer=False,
-            model_warmup=False,
-        )
+        engine_kwargs = {
+            "model_name_or_path": str(self.model_dir),
+            "engine": "torch",
+            "device": device,
+            "bettertransformer": False,
+            "model_warmup": False,
+        }
+
+        # Workers keep embedding batches off the server's event loop and GIL
+        if config.embeddings.embeddings_workers > 0:
+            self.engine = EmbeddingWorkerPool(
+                engine_kwargs, config.embeddings.embeddings_workers
+            )
+        else:
+            self.engine = AsyncEmbeddingEngine.from_args(EngineArgs(**engine_kwargs))
 
-        self.engine = AsyncEmbeddingEngine.from_args(engine_args)
         await self.engine.astart()
 
+        # Requests share engine batches unless batching is disabled
+        if config.embeddings.embeddings_batch_size > 1:
+            self.batcher = EmbeddingBatcher(
+                self.engine.embed,
+                max_batch_size=config.embeddings.embeddings_batch_size,
+                max_wait=config.embeddings.embeddings_batch_wait_ms / 1000,
+            )
+
+        if config.embeddings.embeddings_cache:
+            self.cache = EmbeddingCache(
+                self.model_dir.name,
+                max_memory_bytes=int(config.embeddings.embeddings_cache_mb * 1024**2),
+                disk_dir=config.embeddings.embeddings_cache_dir,
+                disk_dtype=config.embeddings.embeddings_cache_dtype,
+                max_disk_bytes=int(
+                    config.embeddings.embeddings_cache_max_disk_mb * 1024**2
+                ),
+            )
+
+        # Chunking needs the tokenizer in this process, even with workers
+        try:
+            tokenizer = await asyncio.to_thread(
+                AutoTokenizer.from_pretrained, str(self.model_dir)
+            )
+            self.chunker = DocumentChunker(
+                tokenizer, get_max_length(self.model_dir, tokenizer)
+            )
+        except Exception as exc:
+            logger.warning(f"Chunking of long embedding inputs is unavailable: {exc}")
+
         self.model_loaded = True
         logger.info("Embedding model successfully loaded.")
 
     async def unload(self):
         await self.engine.astop()
         self.engine = None
+        self.batcher = None
+        self.cache = None
+        self.chunker = None
 
         gc.collect()
         torch.cuda.empty_cache()
 
         logger.info("Embedding model unloaded.")
 
-    async def generate(self, sentence_input: List[str]):
-        result_embeddings, usage = await self.engine.embed(sentence_input)
+    async def generate(
+        self,
+        sentence_input: List[str],
+        chunk_pooling: Optional[str] = None,
+        chunk_overlap: int = 0,
+    ):
+        if chunk_pooling is None:
+            return await self.generate_unchunked(sentence_input)
+
+        if self.chunker is None:
+            raise ValueError(
+                "Chunking is unavailable since the tokenizer of the "
+                "embedding model couldn't be loaded."
+            )
+
+        splits = await asyncio.to_thread(
+            lambda: [self.chunker.split(text, chunk_overlap) for text in sentence_input]
+        )
+
+        # Embed the chunks of every input at once so they share batches
+        chunks = [chunk for input_chunks, _ in splits for chunk in input_chunks]
+        result = await self.generate_unchunked(chunks)
+        embeddings = np.asarray(result["embeddings"], dtype=np.float32)
+
+        if chunk_pooling == "none":
+            result["embeddings"] = embeddings
+            result["chunk_indices"] = [
+                (input_index, chunk_index)
+                for input_index, (input_chunks, _) in enumerate(splits)
+                for chunk_index in range(len(input_chunks))
+            ]
+
+            return result
+
+        pooled = []
+        start = 0
+        for input_chunks, token_counts in splits:
+            end = start + len(input_chunks)
+            pooled.append(
+                pool_chunks(embeddings[start:end], token_counts, chunk_pooling)
+            )
+            start = end
+
+        result["embeddings"] = pooled
+        return result
+
+    async def generate_unchunked(self, sentence_input: List[str]):
+        """Embeds inputs as they are, letting the engine truncate them."""
+
+        if self.cache:
+            return await self.cache.embed(sentence_input, self.embed)
+
+        result_embeddings, usage = await self.embed(sentence_input)
 
         return {"embeddings": result_embeddings, "usage": usage}
+
+    async def embed(self, sentence_input: List[str]):
+        """Runs inputs through the engine, sharing batches if enabled."""
+
+        if self.batcher:
+            return await self.batcher.embed(sentence_input)
+
+        return await self.engine.embed(sentence_input)
@@ -0,0 +1,124 @@
+"""Cross-encoder reranking on the infinity backend."""
+
+import asyncio
+import gc
+import pathlib
+from typing import List, Optional
+
+import numpy as np
+import torch
+from loguru import logger
+
+from common.optional_dependencies import dependencies
+from common.utils import unwrap
+from config.config import config
+
+# Conditionally import infinity to sidestep its logger
+if dependencies.extras:
+    from infinity_emb import AsyncEmbeddingEngine, EngineArgs
+
+
+def length_buckets(documents: List[str], bucket_size: int):
+    """
+    Groups document indexes into buckets of similar length.
+    Each bucket becomes one batch, so short documents aren't padded to
+    the length of long ones.
+    """
+
+    order = np.argsort([len(document) for document in documents], kind="stable")
+    return [
+        order[start : start + bucket_size]
+        for start in range(0, len(order), bucket_size)
+    ]
+
+
+class RerankerContainer:
+    model_dir: pathlib.Path
+    model_is_loading: bool = False
+    model_loaded: bool = False
+
+    # Conditionally set the type hint based on importablity
+    if dependencies.extras:
+        engine: Optional[AsyncEmbeddingEngine] = None
+    else:
+        engine = None
+
+    def __init__(self, model_directory: pathlib.Path):
+        self.model_dir = model_directory
+
+    async def load(self, **kwargs):
+        self.model_is_loading = True
+
+        # Use cpu by default
+        device = unwrap(kwargs.get("embeddings_device"), "cpu")
+
+        engine_args = EngineArgs(
+            model_name_or_path=str(self.model_dir),
+            engine="torch",
+            device=device,
+            bettertransformer=False,
+            model_warmup=False,
+            batch_size=config.embeddings.reranker_batch_size,
+        )
+
+        self.engine = AsyncEmbeddingEngine.from_args(engine_args)
+        await self.engine.astart()
+
+        if "rerank" not in self.engine.capabilities:
+            await self.engine.astop()
+            self.engine = None
+            self.model_is_loading = False
+
+            raise ValueError(f"{self.model_dir.name} is not a reranker model.")
+
+        self.model_loaded = True
+        logger.info("Reranker model successfully loaded.")
+
+    async def unload(self):
+        await self.engine.astop()
+        self.engine = None
+
+        gc.collect()
+        torch.cuda.empty_cache()
+
+        logger.info("Reranker model unloaded.")
+
+    async def rerank(self, query: str, documents: List[str], top_n: Optional[int]):
+        """
+        Scores documents against a query.
+        Returns the indexes and scores of the top_n documents, best first,
+        and the token usage.
+        """
+
+        if not documents:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32), 0
+
+        # Buckets are submitted together, and the engine batches them in order
+        buckets = length_buckets(documents, config.embeddings.reranker_batch_size)
+        results = await asyncio.gather(
+            *[
+                self.engine.rerank(
+                    query=query, docs=[documents[index] for index in bucket]
+                )
+                for bucket in buckets
+            ]
+        )
+
+        scores = np.empty(len(documents), dtype=np.float32)
+        usage = 0
+        for bucket, (bucket_scores, bucket_usage) in zip(buckets, results, strict=True):
+            usage += bucket_usage
+
+            # Newer infinity versions return sorted results with their index
+            if bucket_scores and hasattr(bucket_scores[0], "relevance_score"):
+                for result in bucket_scores:
+                    scores[bucket[result.index]] = result.relevance_score
+            else:
+                scores[bucket] = bucket_scores
+
+        # Only sort the documents that are returned
+        top_n = min(unwrap(top_n, len(documents)), len(documents))
+        best = np.argpartition(-scores, top_n - 1)[:top_n]
+        best = best[np.argsort(-scores[best], kind="stable")]
+
+        return best, scores[best], usage
@@ -0,0 +1,298 @@
+"""
+Embedding engines hosted in worker processes.
+
+Workers pull requests from a shared IPC queue and hold a bounded number at
+a time, so busy workers leave work to idle ones. Results are written to
+memory-mapped files in a shared memory directory, and the server maps them
+without copying.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import pathlib
+import queue
+import shutil
+import tempfile
+import threading
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+import numpy as np
+from loguru import logger
+
+# tmpfs keeps the result files in memory where available
+SHARED_MEMORY_DIR = pathlib.Path("/dev/shm")
+
+# Seconds between checks that the workers are alive
+WORKER_POLL_INTERVAL = 1.0
+
+# Seconds to wait for workers to exit before terminating them
+WORKER_STOP_TIMEOUT = 10.0
+
+# Requests a worker embeds at once. A few concurrent requests still share
+# the engine's batches, and the rest wait in the queue for a free worker.
+MAX_WORKER_REQUESTS = 4
+
+
+def run_worker(
+    engine_kwargs: dict,
+    request_queue: multiprocessing.Queue,
+    response_queue: multiprocessing.Queue,
+    results_dir: str,
+):
+    """Entrypoint of a worker process."""
+
+    asyncio.run(_serve(engine_kwargs, request_queue, response_queue, results_dir))
+
+
+async def _serve(
+    engine_kwargs: dict,
+    request_queue: multiprocessing.Queue,
+    response_queue: multiprocessing.Queue,
+    results_dir: str,
+):
+    # Only workers import infinity
+    from infinity_emb import AsyncEmbeddingEngine, EngineArgs
+
+    try:
+        engine = AsyncEmbeddingEngine.from_args(EngineArgs(**engine_kwargs))
+        await engine.astart()
+    except Exception as exc:
+        response_queue.put((None, None, None, 0, str(exc)))
+        return
+
+    # A request ID of None tells the server this worker is ready
+    response_queue.put((None, None, None, 0, None))
+
+    slots = asyncio.Semaphore(MAX_WORKER_REQUESTS)
+    tasks = set()
+    while True:
+        # Only take a request once there's room for it
+        await slots.acquire()
+
+        message = await asyncio.to_thread(request_queue.get)
+        if message is None:
+            break
+
+        task = asyncio.create_task(
+            _embed(engine, slots, response_queue, results_dir, *message)
+        )
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    await asyncio.gather(*tasks)
+    await engine.astop()
+
+
+async def _embed(
+    engine,
+    slots: asyncio.Semaphore,
+    response_queue: multiprocessing.Queue,
+    results_dir: str,
+    request_id: str,
+    sentences: List[str],
+):
+    try:
+        embeddings, usage = await engine.embed(sentences)
+        matrix = np.asarray(embeddings, dtype=np.float32)
+
+        path = None
+        if matrix.size:
+            path = os.path.join(results_dir, f"{request_id}.bin")
+            matrix.tofile(path)
+
+        response_queue.put((request_id, path, matrix.shape, usage, None))
+    except Exception as exc:
+        response_queue.put((request_id, None, None, 0, str(exc)))
+    finally:
+        slots.release()
+
+
+def map_result(path: Optional[str], shape: tuple):
+    """Maps a result file as a read-only array and removes the file."""
+
+    if path is None:
+        return np.zeros(shape, dtype=np.float32)
+
+    embeddings = np.memmap(path, dtype=np.float32, mode="r", shape=shape)
+
+    # Windows can't remove mapped files, so copy the result out first
+    if os.name == "nt":
+        embeddings = np.array(embeddings)
+
+    os.unlink(path)
+    return embeddings
+
+
+class EmbeddingWorkerPool:
+    """
+    Embedding engines in worker processes.
+
+    Mirrors the astart, astop and embed methods of AsyncEmbeddingEngine
+    so the container can use either one.
+    """
+
+    def __init__(self, engine_kwargs: dict, num_workers: int):
+        self.engine_kwargs = engine_kwargs
+        self.num_workers = num_workers
+
+        self._processes: List[multiprocessing.Process] = []
+        self._futures: Dict[str, asyncio.Future] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reader: Optional[threading.Thread] = None
+        self._results_dir: Optional[str] = None
+
+        # Spawn instead of fork since the server may hold CUDA state
+        context = multiprocessing.get_context("spawn")
+        self._context = context
+        self._request_queue = context.Queue()
+        self._response_queue = context.Queue()
+
+    async def astart(self):
+        """Starts the workers and waits for their models to load."""
+
+        self._loop = asyncio.get_running_loop()
+        self._results_dir = tempfile.mkdtemp(
+            prefix="almoapi-embeddings-",
+            dir=SHARED_MEMORY_DIR if SHARED_MEMORY_DIR.is_dir() else None,
+        )
+
+        for _ in range(self.num_workers):
+            process = self._context.Process(
+                target=run_worker,
+                args=(
+                    self.engine_kwargs,
+                    self._request_queue,
+                    self._response_queue,
+                    self._results_dir,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+
+        try:
+            await asyncio.to_thread(self._wait_ready)
+        except Exception:
+            await self.astop()
+            raise
+
+        self._reader = threading.Thread(target=self._read_responses, daemon=True)
+        self._reader.start()
+
+        logger.info(f"Started {self.num_workers} embedding worker process(es).")
+
+    async def astop(self):
+        """Stops the workers and fails requests that are still pending."""
+
+        for _ in self._processes:
+            self._request_queue.put(None)
+
+        await asyncio.to_thread(self._join_processes)
+
+        if self._reader:
+            self._response_queue.put(None)
+            await asyncio.to_thread(self._reader.join)
+            self._reader = None
+
+        self._fail_pending(RuntimeError("The embedding workers were stopped."))
+
+        if self._results_dir:
+            shutil.rmtree(self._results_dir, ignore_errors=True)
+            self._results_dir = None
+
+    async def embed(self, sentences: List[str]):
+        """Embeds inputs in the first free worker."""
+
+        if not self._processes:
+            raise RuntimeError("No embedding workers are running.")
+
+        request_id = uuid4().hex
+        future = self._loop.create_future()
+        self._futures[request_id] = future
+
+        try:
+            self._request_queue.put((request_id, sentences))
+            return await future
+        finally:
+            self._futures.pop(request_id, None)
+
+    def _wait_ready(self):
+        ready = 0
+        while ready < self.num_workers:
+            try:
+                _, _, _, _, error = self._response_queue.get(
+                    timeout=WORKER_POLL_INTERVAL
+                )
+            except queue.Empty:
+                if not all(process.is_alive() for process in self._processes):
+                    raise RuntimeError(
+                        "An embedding worker exited while loading the model."
+                    ) from None
+
+                continue
+
+            if error:
+                raise RuntimeError(f"An embedding worker failed to load: {error}")
+
+            ready += 1
+
+    def _join_processes(self):
+        for process in self._processes:
+            process.join(WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+
+        self._processes = []
+
+    def _read_responses(self):
+        """Hands worker results to the event loop until told to stop."""
+
+        while True:
+            try:
+                message = self._response_queue.get(timeout=WORKER_POLL_INTERVAL)
+            except queue.Empty:
+                alive = [process for process in self._processes if process.is_alive()]
+
+                # Requests of a dead worker are lost, so fail everything pending
+                if len(alive) < len(self._processes):
+                    self._processes = alive
+                    logger.error("An embedding worker exited unexpectedly.")
+                    self._loop.call_soon_threadsafe(
+                        self._fail_pending,
+                        RuntimeError("An embedding worker exited unexpectedly."),
+                    )
+
+                continue
+
+            if message is None:
+                return
+
+            self._loop.call_soon_threadsafe(self._resolve, *message)
+
+    def _resolve(
+        self,
+        request_id: str,
+        path: Optional[str],
+        shape: Optional[tuple],
+        usage: int,
+        error: Optional[str],
+    ):
+        future = self._futures.get(request_id)
+
+        if error:
+            if future and not future.done():
+                future.set_exception(RuntimeError(error))
+
+            return
+
+        # Map the result even if the request was cancelled to remove the file
+        embeddings = map_result(path, shape)
+        if future and not future.done():
+            future.set_result((embeddings, usage))
+
+    def _fail_pending(self, exc: Exception):
+        for future in self._futures.values():
+            if not future.done():
+                future.set_exception(exc)
@@ -0,0 +1,252 @@
+"""
+Nearest neighbour search over a contiguous float32 matrix.
+
+Small collections are scanned exactly with one matrix-vector product.
+Larger ones are clustered into an inverted file (IVF) index, so a search
+only scores the vectors of the clusters closest to the query.
+"""
+
+import math
+from typing import Optional
+
+import numpy as np
+
+# Rows reserved up front when a matrix has to grow
+MIN_CAPACITY = 1024
+
+# Bounds for the number of IVF clusters
+MIN_CLUSTERS = 16
+MAX_CLUSTERS = 4096
+
+# Training samples per IVF cluster
+SAMPLES_PER_CLUSTER = 64
+
+KMEANS_ITERATIONS = 10
+
+# Rows assigned to clusters per matrix product, to bound memory use
+ASSIGN_CHUNK_SIZE = 65536
+
+# Retrain the clusters once a collection outgrows them by this factor
+RETRAIN_GROWTH = 4
+
+
+class VectorIndex:
+    """
+    Vectors of a collection in insertion order with swap removal.
+
+    Scores are the inner product for dot, the cosine similarity for cosine
+    (vectors are normalized on insert) and the negated squared distance
+    for l2, so higher is always closer.
+    """
+
+    def __init__(
+        self,
+        dimensions: int,
+        metric: str,
+        ivf_threshold: Optional[int],
+        nprobe: int,
+        vectors: Optional[np.ndarray] = None,
+    ):
+        self.dimensions = dimensions
+        self.metric = metric
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+
+        # May be a read-only memory map until the first write
+        self.vectors = (
+            vectors
+            if vectors is not None
+            else np.empty((0, dimensions), dtype=np.float32)
+        )
+        self.count = len(self.vectors)
+
+        self.centroids: Optional[np.ndarray] = None
+        self.assignments: Optional[np.ndarray] = None
+        self.trained_count = 0
+        self._list_order: Optional[np.ndarray] = None
+        self._list_bounds: Optional[np.ndarray] = None
+
+    def add(self, vectors: np.ndarray):
+        """Appends vectors and returns the first of their rows."""
+
+        vectors = self._prepare(vectors)
+        self._reserve(self.count + len(vectors))
+
+        start = self.count
+        self.vectors[start : start + len(vectors)] = vectors
+        self.count += len(vectors)
+
+        if self.centroids is not None:
+            self.assignments[start : self.count] = self._assign(vectors)
+            self._list_order = None
+
+        return start
+
+    def set(self, rows: np.ndarray, vectors: np.ndarray):
+        """Replaces the vectors of existing rows."""
+
+        vectors = self._prepare(vectors)
+        self._reserve(self.count)
+        self.vectors[rows] = vectors
+
+        if self.centroids is not None:
+            self.assignments[rows] = self._assign(vectors)
+            self._list_order = None
+
+    def remove(self, row: int):
+        """Removes a row by moving the last row into it."""
+
+        self._reserve(self.count)
+        last = self.count - 1
+
+        self.vectors[row] = self.vectors[last]
+        if self.centroids is not None:
+            self.assignments[row] = self.assignments[last]
+            self._list_order = None
+
+        self.count = last
+
+    def search(self, query: np.ndarray, top_k: int):
+        """Returns the rows and scores of the closest vectors."""
+
+        query = self._prepare(query[np.newaxis])[0]
+
+        if self._use_ivf():
+            candidates = self._probe(query)
+            scores = self._score(self.vectors[candidates], query)
+        else:
+            candidates = None
+            scores = self._score(self.vectors[: self.count], query)
+
+        top_k = min(top_k, len(scores))
+        if top_k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+
+        rows = candidates[best] if candidates is not None else best
+        return rows, scores[best]
+
+    def _prepare(self, vectors: np.ndarray):
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        if self.metric == "cosine":
+            norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+            norms[norms == 0] = 1
+            vectors = vectors / norms
+
+        return vectors
+
+    def _score(self, vectors: np.ndarray, query: np.ndarray):
+        # One BLAS matrix-vector product over contiguous rows
+        scores = vectors @ query
+
+        if self.metric == "l2":
+            scores = 2 * scores - np.einsum("ij,ij->i", vectors, vectors)
+            scores -= query @ query
+
+        return scores
+
+    def _reserve(self, rows: int):
+        """Makes the matrix writable with room for the given rows."""
+
+        writable = self.vectors.flags.writeable and not isinstance(
+            self.vectors, np.memmap
+        )
+        if writable and len(self.vectors) >= rows:
+            return
+
+        capacity = max(rows, MIN_CAPACITY, 2 * len(self.vectors))
+        vectors = np.empty((capacity, self.dimensions), dtype=np.float32)
+        vectors[: self.count] = self.vectors[: self.count]
+        self.vectors = vectors
+
+        if self.assignments is not None:
+            assignments = np.empty(capacity, dtype=np.int32)
+            assignments[: self.count] = self.assignments[: self.count]
+            self.assignments = assignments
+
+    def _use_ivf(self):
+        if self.ivf_threshold is None or self.count < self.ivf_threshold:
+            return False
+
+        if self.centroids is None or self.count > RETRAIN_GROWTH * self.trained_count:
+            self._train()
+
+        return True
+
+    def _train(self):
+        """Clusters the vectors with k-means and assigns every row."""
+
+        data = self.vectors[: self.count]
+        num_clusters = int(np.clip(math.isqrt(self.count), MIN_CLUSTERS, MAX_CLUSTERS))
+        num_clusters = min(num_clusters, self.count)
+
+        rng = np.random.default_rng(0)
+        sample_size = min(self.count, num_clusters * SAMPLES_PER_CLUSTER)
+        sample = data[rng.choice(self.count, sample_size, replace=False)]
+
+        centroids = sample[rng.choice(sample_size, num_clusters, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            labels = _nearest(sample, centroids)
+            counts = np.bincount(labels, minlength=num_clusters)
+
+            # Sum each cluster over a contiguous run of the sorted sample
+            filled = counts > 0
+            starts = np.cumsum(counts) - counts
+            sums = np.add.reduceat(sample[np.argsort(labels)], starts[filled], axis=0)
+
+            # Empty clusters keep their previous centroid
+            centroids[filled] = sums / counts[filled, np.newaxis]
+
+        self.centroids = centroids
+        self.assignments = np.empty(len(self.vectors), dtype=np.int32)
+        self.assignments[: self.count] = self._assign(data)
+        self.trained_count = self.count
+        self._list_order = None
+
+    def _assign(self, vectors: np.ndarray):
+        return np.concatenate(
+            [
+                _nearest(vectors[start : start + ASSIGN_CHUNK_SIZE], self.centroids)
+                for start in range(0, len(vectors), ASSIGN_CHUNK_SIZE)
+            ]
+            or [np.empty(0, dtype=np.int32)]
+        )
+
+    def _probe(self, query: np.ndarray):
+        """Returns the rows of the clusters closest to the query."""
+
+        if self._list_order is None:
+            assignments = self.assignments[: self.count]
+            self._list_order = np.argsort(assignments, kind="stable")
+            self._list_bounds = np.searchsorted(
+                assignments[self._list_order], np.arange(len(self.centroids) + 1)
+            )
+
+        nprobe = min(self.nprobe, len(self.centroids))
+        probed = _nearest_many(query, self.centroids, nprobe)
+
+        return np.concatenate(
+            [
+                self._list_order[
+                    self._list_bounds[cluster] : self._list_bounds[cluster + 1]
+                ]
+                for cluster in probed
+            ]
+        )
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray):
+    """Index of the closest centroid to each vector by L2 distance."""
+
+    distances = (centroids * centroids).sum(axis=1) - 2 * vectors @ centroids.T
+    return distances.argmin(axis=1).astype(np.int32)
+
+
+def _nearest_many(query: np.ndarray, centroids: np.ndarray, count: int):
+    """Indexes of the closest centroids to a query by L2 distance."""
+
+    distances = (centroids * centroids).sum(axis=1) - 2 * centroids @ query
+    return np.argpartition(distances, count - 1)[:count]
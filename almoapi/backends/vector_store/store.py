@@ -0,0 +1,400 @@
+"""
+Named collections of vectors with optional memory-mapped persistence.
+
+Each persisted collection is a directory with a vectors.npy matrix, mapped
+read-only on startup, and a collection.json file with its settings, IDs
+and metadata.
+"""
+
+import asyncio
+import json
+import pathlib
+import re
+import shutil
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+from fastapi import HTTPException
+from loguru import logger
+
+from backends.vector_store.index import VectorIndex
+from common.networking import handle_request_error
+from config.config import config
+
+# Collection names double as directory names
+COLLECTION_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# Suffixes of the directories used while saving, which names can't contain
+TEMP_SUFFIX = ".tmp"
+OLD_SUFFIX = ".old"
+
+
+def save_dirs(directory: pathlib.Path):
+    """Returns the temporary and old directories used to save a collection."""
+
+    return (
+        directory.with_name(directory.name + TEMP_SUFFIX),
+        directory.with_name(directory.name + OLD_SUFFIX),
+    )
+
+
+def recover_saves(persist_dir: pathlib.Path):
+    """Finishes the directory swaps of saves that were interrupted."""
+
+    for temp_dir in persist_dir.glob(f"*{TEMP_SUFFIX}"):
+        directory = temp_dir.with_suffix("")
+        old_dir = temp_dir.with_suffix(OLD_SUFFIX)
+
+        # The old directory is only moved once the new one is fully written
+        if old_dir.exists() and not directory.exists():
+            temp_dir.replace(directory)
+        else:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    for old_dir in persist_dir.glob(f"*{OLD_SUFFIX}"):
+        directory = old_dir.with_suffix("")
+        if directory.exists():
+            shutil.rmtree(old_dir, ignore_errors=True)
+        else:
+            old_dir.replace(directory)
+
+
+class Collection:
+    """A named set of vectors with string IDs and metadata"""
+
+    def __init__(
+        self,
+        name: str,
+        metric: str,
+        index_type: str,
+        dimensions: Optional[int] = None,
+    ):
+        self.name = name
+        self.metric = metric
+        self.index_type = index_type
+        self.dimensions = dimensions
+
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.metadata: List[Optional[dict]] = []
+
+        self.index: Optional[VectorIndex] = None
+        if dimensions:
+            self.index = self._create_index(dimensions)
+
+        # Searches and writes run in threads
+        self.lock = threading.Lock()
+        self.dirty = False
+
+        # Set once the collection is dropped, so pending saves don't
+        # write it back
+        self.dropped = False
+
+    @property
+    def count(self):
+        return len(self.ids)
+
+    def upsert(
+        self, ids: List[str], vectors: np.ndarray, metadata: List[Optional[dict]]
+    ):
+        """Inserts new IDs and replaces the vectors of existing ones."""
+
+        with self.lock:
+            if self.index is None:
+                self.dimensions = vectors.shape[-1]
+                self.index = self._create_index(self.dimensions)
+
+            if vectors.shape[-1] != self.dimensions:
+                raise ValueError(
+                    f"Vectors have {vectors.shape[-1]} dimensions, but collection "
+                    f"{self.name} holds {self.dimensions}."
+                )
+
+            # The last occurrence of a duplicated ID wins
+            positions = {item_id: position for position, item_id in enumerate(ids)}
+
+            existing = [item_id for item_id in positions if item_id in self.rows]
+            if existing:
+                self.index.set(
+                    np.array([self.rows[item_id] for item_id in existing]),
+                    vectors[[positions[item_id] for item_id in existing]],
+                )
+
+                for item_id in existing:
+                    self.metadata[self.rows[item_id]] = metadata[positions[item_id]]
+
+            new = [item_id for item_id in positions if item_id not in self.rows]
+            if new:
+                start = self.index.add(vectors[[positions[item_id] for item_id in new]])
+
+                for row, item_id in enumerate(new, start):
+                    self.rows[item_id] = row
+                    self.ids.append(item_id)
+                    self.metadata.append(metadata[positions[item_id]])
+
+            self.dirty = True
+
+    def delete(self, ids: List[str]):
+        """Removes IDs and returns how many existed."""
+
+        deleted = 0
+
+        with self.lock:
+            for item_id in ids:
+                row = self.rows.pop(item_id, None)
+                if row is None:
+                    continue
+
+                # Mirror the swap removal of the index
+                self.index.remove(row)
+                last_id = self.ids.pop()
+                last_metadata = self.metadata.pop()
+
+                if last_id != item_id:
+                    self.ids[row] = last_id
+                    self.metadata[row] = last_metadata
+                    self.rows[last_id] = row
+
+                deleted += 1
+
+            self.dirty = self.dirty or deleted > 0
+
+        return deleted
+
+    def search(self, query: np.ndarray, top_k: int):
+        """Returns (id, score, metadata) tuples of the closest vectors."""
+
+        with self.lock:
+            if self.index is None or not self.ids:
+                return []
+
+            if len(query) != self.dimensions:
+                raise ValueError(
+                    f"The query has {len(query)} dimensions, but collection "
+                    f"{self.name} holds {self.dimensions}."
+                )
+
+            rows, scores = self.index.search(query, top_k)
+
+            return [
+                (self.ids[row], float(score), self.metadata[row])
+                for row, score in zip(rows, scores, strict=True)
+            ]
+
+    def save(self, directory: pathlib.Path):
+        """
+        Writes the collection to a directory.
+
+        The files are written to a temporary directory that replaces the old
+        one, so the vectors and IDs on disk always belong together.
+        """
+
+        temp_dir, old_dir = save_dirs(directory)
+
+        with self.lock:
+            if self.dropped:
+                return
+
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            temp_dir.mkdir(parents=True)
+
+            settings = {
+                "metric": self.metric,
+                "index": self.index_type,
+                "dimensions": self.dimensions,
+                "ids": self.ids,
+                "metadata": self.metadata,
+            }
+
+            (temp_dir / "collection.json").write_text(json.dumps(settings))
+
+            if self.index is not None:
+                np.save(
+                    temp_dir / "vectors.npy", self.index.vectors[: self.index.count]
+                )
+
+            # Swap the directories. recover_saves finishes an interrupted swap.
+            if directory.exists():
+                shutil.rmtree(old_dir, ignore_errors=True)
+                directory.replace(old_dir)
+
+            temp_dir.replace(directory)
+            shutil.rmtree(old_dir, ignore_errors=True)
+            self.dirty = False
+
+    def remove(self, directory: pathlib.Path):
+        """Deletes the saved files of a dropped collection."""
+
+        # Waits for a save in progress, and stops the ones after it
+        with self.lock:
+            self.dropped = True
+
+            for path in (directory, *save_dirs(directory)):
+                shutil.rmtree(path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory: pathlib.Path):
+        """Opens a saved collection with its vectors mapped read-only."""
+
+        settings = json.loads((directory / "collection.json").read_text())
+        collection = cls(directory.name, settings["metric"], settings["index"])
+        collection.dimensions = settings["dimensions"]
+
+        collection.ids = settings["ids"]
+        collection.metadata = settings["metadata"]
+        collection.rows = {item_id: row for row, item_id in enumerate(collection.ids)}
+
+        if collection.dimensions:
+            vectors = np.load(directory / "vectors.npy", mmap_mode="r")
+            if len(vectors) != len(collection.ids):
+                raise ValueError(
+                    f"vectors.npy has {len(vectors)} rows for {len(collection.ids)} IDs"
+                )
+
+            collection.index = collection._create_index(collection.dimensions, vectors)
+
+        return collection
+
+    def _create_index(self, dimensions: int, vectors: Optional[np.ndarray] = None):
+        ivf_threshold = {
+            "flat": None,
+            "ivf": 0,
+            "auto": config.vector_store.ivf_threshold,
+        }[self.index_type]
+
+        return VectorIndex(
+            dimensions,
+            self.metric,
+            ivf_threshold,
+            config.vector_store.ivf_nprobe,
+            vectors,
+        )
+
+
+class VectorStoreClass:
+    """Class to manage the vector store global state"""
+
+    def __init__(self):
+        self.collections: Dict[str, Collection] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    @property
+    def persist_dir(self):
+        persist_dir = config.vector_store.persist_dir
+        return pathlib.Path(persist_dir) if persist_dir else None
+
+    async def load(self):
+        """Opens persisted collections and starts saving changes."""
+
+        if self.persist_dir and self.persist_dir.is_dir():
+            await asyncio.to_thread(recover_saves, self.persist_dir)
+
+            for directory in sorted(self.persist_dir.iterdir()):
+                if not (directory / "collection.json").exists():
+                    continue
+
+                try:
+                    collection = await asyncio.to_thread(Collection.load, directory)
+                    self.collections[collection.name] = collection
+                except Exception as exc:
+                    logger.error(
+                        f"Skipping unreadable vector collection {directory}: {exc}"
+                    )
+
+            logger.info(f"Loaded {len(self.collections)} vector collection(s).")
+
+        if self.persist_dir and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def shutdown(self):
+        """Stops the flush loop and saves pending changes."""
+
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        await self.flush()
+
+    def get(self, name: str):
+        """Returns a collection or raises a 404 error."""
+
+        collection = self.collections.get(name)
+        if collection is None:
+            error_message = handle_request_error(
+                f"Vector collection {name} does not exist.",
+                exc_info=False,
+            ).error.message
+
+            raise HTTPException(404, error_message)
+
+        return collection
+
+    def create(
+        self, name: str, metric: str, index_type: str, dimensions: Optional[int]
+    ):
+        """Creates an empty collection."""
+
+        if not COLLECTION_NAME_PATTERN.match(name):
+            raise ValueError(
+                "Collection names can only contain letters, digits, "
+                "underscores and dashes."
+            )
+
+        if name in self.collections:
+            raise ValueError(f"Vector collection {name} already exists.")
+
+        collection = Collection(name, metric, index_type, dimensions)
+        collection.dirty = True
+        self.collections[name] = collection
+
+        return collection
+
+    async def drop(self, name: str):
+        """Deletes a collection and its saved files."""
+
+        collection = self.get(name)
+        del self.collections[name]
+
+        if self.persist_dir:
+            await asyncio.to_thread(collection.remove, self.persist_dir / name)
+
+    async def flush(self):
+        """Saves collections with unsaved changes."""
+
+        if not self.persist_dir:
+            return
+
+        for collection in list(self.collections.values()):
+            if not collection.dirty:
+                continue
+
+            try:
+                await asyncio.to_thread(
+                    collection.save, self.persist_dir / collection.name
+                )
+            except OSError as exc:
+                logger.error(
+                    f"Couldn't save vector collection {collection.name}: {exc}"
+                )
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(config.vector_store.persist_interval)
+            await self.flush()
+
+
+async def check_vector_store():
+    """FastAPI depends that checks if the vector store is enabled."""
+
+    if not config.vector_store.enable:
+        error_message = handle_request_error(
+            "The vector store is disabled. Enable it in the vector_store config.",
+            exc_info=False,
+        ).error.message
+
+        raise HTTPException(400, error_message)
+
+
+# Create an instance of the global vector store
+VectorStore = VectorStoreClass()
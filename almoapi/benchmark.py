@@ -0,0 +1,454 @@
+"""
+Load testing tool that replays a JSONL workload against a running server.
+
+Each workload line is either a request in the batch API format, such as
+{"url": "/v1/chat/completions", "body": {...}}, or a bare request body whose
+endpoint is inferred from its fields. Files written by the server's traffic
+capture (capture.enable) can be replayed as they are.
+
+Usage:
+    python benchmark.py run workload.jsonl --concurrency 8 --output a.json
+    python benchmark.py run workload.jsonl --rate 4 --output b.json
+    python benchmark.py compare a.json b.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+
+import aiohttp
+
+# Endpoints that stream tokens, so TTFT and inter-token latency apply
+STREAMING_ENDPOINTS = {"/v1/completions", "/v1/chat/completions"}
+
+PERCENTILES = (50, 90, 95, 99)
+
+# Metrics where a lower value is better. The rest are throughputs.
+LOWER_IS_BETTER = ("ttft", "itl", "e2e", "error_rate")
+
+
+@dataclass
+class RequestResult:
+    endpoint: str
+    ok: bool = False
+    status: Optional[int] = None
+    error: Optional[str] = None
+    ttft: Optional[float] = None
+    e2e: Optional[float] = None
+    output_tokens: int = 0
+    chunk_gaps: List[float] = field(default_factory=list)
+
+
+def infer_endpoint(body: dict):
+    """Guesses the endpoint of a bare request body."""
+
+    if "messages" in body:
+        return "/v1/chat/completions"
+    if "prompt" in body:
+        return "/v1/completions"
+    if "query" in body and "documents" in body:
+        return "/v1/rerank"
+    if "input" in body:
+        return "/v1/embeddings"
+
+    raise ValueError(f"Can't infer the endpoint of request {body}")
+
+
+def load_workload(path: str):
+    """Reads (endpoint, body) pairs from a JSONL file."""
+
+    workload = []
+
+    with open(path, "r", encoding="utf8") as workload_file:
+        for line in workload_file:
+            if not line.strip():
+                continue
+
+            item = json.loads(line)
+            if "body" in item:
+                body = item["body"]
+                endpoint = item.get("url") or infer_endpoint(body)
+            else:
+                body = item
+                endpoint = infer_endpoint(body)
+
+            workload.append((endpoint, body))
+
+    return workload
+
+
+def percentiles(values: List[float]):
+    """Summarizes latencies in milliseconds."""
+
+    if not values:
+        return None
+
+    values = sorted(values)
+    summary = {"mean": 1000 * sum(values) / len(values), "max": 1000 * values[-1]}
+
+    for percentile in PERCENTILES:
+        # Nearest rank, so every reported value was observed
+        rank = max(math.ceil(percentile / 100 * len(values)) - 1, 0)
+        summary[f"p{percentile}"] = 1000 * values[rank]
+
+    return summary
+
+
+def summarize(results: List[RequestResult], duration: float):
+    """Aggregates request results into the metrics of a run."""
+
+    succeeded = [result for result in results if result.ok]
+    output_tokens = sum(result.output_tokens for result in succeeded)
+
+    errors = {}
+    for result in results:
+        if not result.ok:
+            errors[result.error] = errors.get(result.error, 0) + 1
+
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(succeeded),
+        "error_rate": (len(results) - len(succeeded)) / max(len(results), 1),
+        "duration": duration,
+        "requests_per_second": len(succeeded) / duration,
+        "output_tokens": output_tokens,
+        "tokens_per_second": output_tokens / duration,
+        "ttft": percentiles(
+            [result.ttft for result in succeeded if result.ttft is not None]
+        ),
+        "itl": percentiles([gap for result in succeeded for gap in result.chunk_gaps]),
+        "e2e": percentiles([result.e2e for result in succeeded]),
+        "error_messages": errors,
+    }
+
+
+async def send_request(
+    session: aiohttp.ClientSession,
+    base_url: str,
+    endpoint: str,
+    body: dict,
+    stream: bool,
+    start: float,
+):
+    """
+    Sends one request and times it from its start time.
+    Open-loop runs pass the scheduled time, so queueing delay counts too.
+    """
+
+    result = RequestResult(endpoint=endpoint)
+    body = dict(body)
+
+    streaming = stream and endpoint in STREAMING_ENDPOINTS
+    if streaming:
+        body["stream"] = True
+        if endpoint == "/v1/chat/completions":
+            body["stream_options"] = {"include_usage": True}
+    elif endpoint in STREAMING_ENDPOINTS:
+        body["stream"] = False
+
+    try:
+        async with session.post(base_url + endpoint, json=body) as response:
+            result.status = response.status
+
+            if response.status != 200:
+                result.error = f"HTTP {response.status}"
+                await response.read()
+                return result
+
+            if streaming:
+                await read_stream(response, result, start)
+            else:
+                data = await response.json()
+                usage = data.get("usage") or {}
+                result.output_tokens = usage.get("completion_tokens") or 0
+
+            result.e2e = time.perf_counter() - start
+            result.ok = result.error is None
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as exc:
+        result.error = type(exc).__name__
+
+    return result
+
+
+async def read_stream(
+    response: aiohttp.ClientResponse, result: RequestResult, start: float
+):
+    """Times the chunks of an SSE stream."""
+
+    last_chunk = None
+    chunks = 0
+
+    async for line in response.content:
+        line = line.strip()
+        if not line.startswith(b"data:"):
+            continue
+
+        payload = line[5:].strip()
+        if payload == b"[DONE]":
+            break
+
+        data = json.loads(payload)
+        if "error" in data:
+            result.error = "stream error"
+            break
+
+        usage = data.get("usage") or {}
+        if usage.get("completion_tokens"):
+            result.output_tokens = usage["completion_tokens"]
+
+        # Usage-only chunks don't carry tokens
+        if not data.get("choices"):
+            continue
+
+        now = time.perf_counter()
+        if last_chunk is None:
+            result.ttft = now - start
+        else:
+            result.chunk_gaps.append(now - last_chunk)
+
+        last_chunk = now
+        chunks += 1
+
+    # Chunks usually hold one token each when the server doesn't report usage
+    result.output_tokens = result.output_tokens or chunks
+
+
+async def run(args):
+    workload = load_workload(args.workload)
+    num_requests = args.num_requests or len(workload)
+
+    # Cycle through the workload if more requests are asked for
+    requests = [workload[index % len(workload)] for index in range(num_requests)]
+    if args.shuffle:
+        random.Random(args.seed).shuffle(requests)
+
+    headers = {"Authorization": f"Bearer {args.api_key}"} if args.api_key else {}
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    stream = not args.no_stream
+    base_url = args.url.rstrip("/")
+
+    results: List[RequestResult] = []
+
+    async with aiohttp.ClientSession(
+        headers=headers, timeout=timeout, connector=connector
+    ) as session:
+        run_start = time.perf_counter()
+
+        if args.rate:
+            # Open loop: Poisson arrivals that don't wait for responses
+            rng = random.Random(args.seed)
+            tasks = []
+            scheduled = run_start
+
+            for endpoint, body in requests:
+                scheduled += rng.expovariate(args.rate)
+                await asyncio.sleep(max(scheduled - time.perf_counter(), 0))
+                tasks.append(
+                    asyncio.create_task(
+                        send_request(
+                            session, base_url, endpoint, body, stream, scheduled
+                        )
+                    )
+                )
+
+            results = await asyncio.gather(*tasks)
+        else:
+            # Closed loop: each client sends its next request once one finishes
+            pending = iter(requests)
+
+            async def client():
+                for endpoint, body in pending:
+                    results.append(
+                        await send_request(
+                            session,
+                            base_url,
+                            endpoint,
+                            body,
+                            stream,
+                            time.perf_counter(),
+                        )
+                    )
+
+            await asyncio.gather(*[client() for _ in range(args.concurrency)])
+
+        duration = time.perf_counter() - run_start
+
+    report = {
+        "config": {
+            "workload": args.workload,
+            "url": base_url,
+            "mode": "open" if args.rate else "closed",
+            "rate": args.rate,
+            "concurrency": None if args.rate else args.concurrency,
+            "num_requests": num_requests,
+            "stream": stream,
+        },
+        "summary": summarize(results, duration),
+    }
+
+    if args.per_request:
+        report["requests"] = [asdict(result) for result in results]
+
+    print_summary(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+def print_summary(report: dict):
+    summary = report["summary"]
+    run_config = report["config"]
+
+    mode = (
+        f"open loop at {run_config['rate']} req/s"
+        if run_config["mode"] == "open"
+        else f"closed loop with {run_config['concurrency']} clients"
+    )
+    print(f"{summary['requests']} requests, {mode}, in {summary['duration']:.2f}s")
+    print(
+        f"errors: {summary['errors']} ({100 * summary['error_rate']:.1f}%), "
+        f"requests/s: {summary['requests_per_second']:.2f}, "
+        f"tokens/s: {summary['tokens_per_second']:.1f}"
+    )
+
+    columns = ("mean", "p50", "p90", "p95", "p99", "max")
+    print(f"{'ms':<6}" + "".join(f"{name:>10}" for name in columns))
+    for metric in ("ttft", "itl", "e2e"):
+        values = summary[metric]
+        if values:
+            row = "".join(f"{values[name]:>10.1f}" for name in columns)
+            print(f"{metric:<6}{row}")
+
+    for message, count in summary["error_messages"].items():
+        print(f"  {count} x {message}")
+
+
+def compare(args):
+    """Flags metrics of a candidate run that regressed against a baseline."""
+
+    with open(args.baseline, "r", encoding="utf8") as baseline_file:
+        baseline = json.load(baseline_file)["summary"]
+    with open(args.candidate, "r", encoding="utf8") as candidate_file:
+        candidate = json.load(candidate_file)["summary"]
+
+    metrics = [("requests_per_second", None), ("tokens_per_second", None)]
+    metrics += [
+        (metric, statistic)
+        for metric in ("ttft", "itl", "e2e")
+        for statistic in ("p50", "p90", "p99")
+    ]
+
+    regressions = []
+    print(f"{'metric':<24}{'baseline':>12}{'candidate':>12}{'change':>10}")
+
+    for metric, statistic in metrics:
+        before = baseline.get(metric)
+        after = candidate.get(metric)
+        if statistic:
+            before = before.get(statistic) if before else None
+            after = after.get(statistic) if after else None
+
+        if not before or after is None:
+            continue
+
+        change = (after - before) / before
+        if metric in LOWER_IS_BETTER:
+            worse = change > args.threshold
+        else:
+            worse = change < -args.threshold
+
+        name = f"{metric} {statistic}" if statistic else metric
+        flag = "  REGRESSION" if worse else ""
+        print(f"{name:<24}{before:>12.2f}{after:>12.2f}{100 * change:>9.1f}%{flag}")
+
+        if worse:
+            regressions.append(name)
+
+    # Any new errors count as a regression
+    if candidate["error_rate"] > baseline["error_rate"]:
+        print(
+            f"error rate rose from {100 * baseline['error_rate']:.1f}% "
+            f"to {100 * candidate['error_rate']:.1f}%  REGRESSION"
+        )
+        regressions.append("error_rate")
+
+    return 1 if regressions else 0
+
+
+def init_argparser():
+    parser = argparse.ArgumentParser(description="ALMoAPI load testing tool")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Replay a workload")
+    run_parser.add_argument("workload", help="JSONL file of requests")
+    run_parser.add_argument(
+        "--url", default="http://127.0.0.1:5000", help="Base URL of the server"
+    )
+    run_parser.add_argument("--api-key", help="API key sent as a bearer token")
+    run_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Clients of a closed-loop run (default: 1)",
+    )
+    run_parser.add_argument(
+        "--rate",
+        type=float,
+        help="Mean requests per second of an open-loop run with Poisson arrivals",
+    )
+    run_parser.add_argument(
+        "--num-requests",
+        type=int,
+        help="Requests to send, cycling through the workload (default: one pass)",
+    )
+    run_parser.add_argument(
+        "--shuffle", action="store_true", help="Shuffle the request order"
+    )
+    run_parser.add_argument(
+        "--seed", type=int, default=0, help="Seed for arrivals and shuffling"
+    )
+    run_parser.add_argument(
+        "--no-stream",
+        action="store_true",
+        help="Don't stream responses. TTFT and inter-token latency are skipped.",
+    )
+    run_parser.add_argument(
+        "--timeout", type=float, default=600, help="Seconds per request"
+    )
+    run_parser.add_argument("--output", help="File to write the JSON results to")
+    run_parser.add_argument(
+        "--per-request",
+        action="store_true",
+        help="Include the timings of every request in the results",
+    )
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare two runs and flag regressions"
+    )
+    compare_parser.add_argument("baseline", help="Results of the baseline run")
+    compare_parser.add_argument("candidate", help="Results of the candidate run")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative change that counts as a regression (default: 0.1)",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = init_argparser().parse_args()
+
+    if args.command == "run":
+        asyncio.run(run(args))
+    else:
+        sys.exit(compare(args))
@@ -0,0 +1,656 @@
+"""
+Offline batches of API requests read from uploaded JSONL files.
+
+Batches run one at a time in the background. Their requests are sorted by
+prompt, so requests with a shared prefix run together and reuse the
+model's cache, and are sent to the model in parallel up to its batch size.
+Results are appended to JSONL files as they finish, which lets an
+interrupted batch resume where it stopped after a restart.
+"""
+
+import asyncio
+import json
+import pathlib
+import shutil
+import time
+from collections import deque
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+from fastapi import HTTPException, Request
+from loguru import logger
+from pydantic import ValidationError
+
+from auth import AuthManager
+from auth.types import AuthPermission
+from auth.utils import get_key_id
+from common import model
+from common.networking import handle_request_error
+from config.config import config
+from endpoints.OAI.types.batch import (
+    BatchCreateRequest,
+    BatchError,
+    BatchErrors,
+    BatchObject,
+    FileObject,
+)
+from endpoints.OAI.utils.batch import (
+    get_batch_prompt,
+    parse_batch_request,
+    run_batch_request,
+)
+
+# Seconds until an unfinished batch expires, matching the 24h window
+COMPLETION_WINDOW = 24 * 60 * 60
+
+# Validation errors listed on a failed batch
+MAX_REPORTED_ERRORS = 100
+
+# Statuses of batches that still have to be run
+UNFINISHED_STATUSES = {"validating", "in_progress", "finalizing", "cancelling"}
+
+
+def _write_json(path: pathlib.Path, content: str):
+    """Replaces a file only once the new content is fully written."""
+
+    temp_path = path.with_suffix(".tmp")
+    temp_path.write_text(content, encoding="utf8")
+    temp_path.replace(path)
+
+
+def _result_line(custom_id: str, request_id: str, body: str):
+    # Splice the response JSON in as is instead of parsing it again
+    return (
+        f'{{"id":"batch_req_{request_id}","custom_id":{json.dumps(custom_id)},'
+        f'"response":{{"status_code":200,"request_id":"{request_id}",'
+        f'"body":{body}}},"error":null}}\n'
+    )
+
+
+def _error_line(custom_id: str, request_id: str, code: str, message: str):
+    return (
+        json.dumps(
+            {
+                "id": f"batch_req_{request_id}",
+                "custom_id": custom_id,
+                "response": None,
+                "error": {"code": code, "message": message},
+            }
+        )
+        + "\n"
+    )
+
+
+def _is_visible(resource_owner: Optional[str], owner: Optional[str]):
+    """Checks if a file or batch belongs to an owner. None matches every owner."""
+
+    return owner is None or resource_owner == owner
+
+
+class FilesClass:
+    """Class to manage the uploaded and generated files"""
+
+    def __init__(self):
+        self.files: Dict[str, FileObject] = {}
+
+    @property
+    def files_dir(self):
+        return pathlib.Path(config.batches.storage_dir) / "files"
+
+    def load(self):
+        """Reads the metadata of stored files."""
+
+        self.files_dir.mkdir(parents=True, exist_ok=True)
+
+        for meta_path in self.files_dir.glob("*.json"):
+            try:
+                file = FileObject.model_validate_json(meta_path.read_text("utf8"))
+                self.files[file.id] = file
+            except (OSError, ValidationError) as exc:
+                logger.error(f"Skipping unreadable file metadata {meta_path}: {exc}")
+
+    def path(self, file_id: str):
+        return self.files_dir / f"{file_id}.jsonl"
+
+    def get(self, file_id: str, owner: Optional[str] = None):
+        """Returns a file or raises a 404 error."""
+
+        file = self.files.get(file_id)
+        if file is None or not _is_visible(file.owner, owner):
+            error_message = handle_request_error(
+                f"File {file_id} does not exist.",
+                exc_info=False,
+            ).error.message
+
+            raise HTTPException(404, error_message)
+
+        return file
+
+    def list(self, owner: Optional[str] = None):
+        """Returns the files an owner can access."""
+
+        return [file for file in self.files.values() if _is_visible(file.owner, owner)]
+
+    async def create(self, source, filename: str, purpose: str, owner: str):
+        """Stores an uploaded file object."""
+
+        file_id = f"file-{uuid4().hex}"
+
+        def copy():
+            with open(self.path(file_id), "wb") as destination:
+                shutil.copyfileobj(source, destination)
+
+        await asyncio.to_thread(copy)
+
+        return await asyncio.to_thread(self.register, file_id, filename, purpose, owner)
+
+    def register(self, file_id: str, filename: str, purpose: str, owner: str):
+        """Adds metadata for a file that was written to its path."""
+
+        file = FileObject(
+            id=file_id,
+            bytes=self.path(file_id).stat().st_size,
+            created_at=int(time.time()),
+            filename=filename,
+            purpose=purpose,
+            owner=owner,
+        )
+
+        _write_json(self.files_dir / f"{file_id}.json", file.model_dump_json())
+        self.files[file_id] = file
+
+        return file
+
+    async def delete(self, file_id: str, owner: Optional[str] = None):
+        """Removes a file and its metadata."""
+
+        self.get(file_id, owner)
+        del self.files[file_id]
+
+        def remove():
+            self.path(file_id).unlink(missing_ok=True)
+            (self.files_dir / f"{file_id}.json").unlink(missing_ok=True)
+
+        await asyncio.to_thread(remove)
+
+
+class BatchesClass:
+    """Class to manage the batch queue global state"""
+
+    def __init__(self):
+        self.batches: Dict[str, BatchObject] = {}
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._cancel_events: Dict[str, asyncio.Event] = {}
+
+    @property
+    def batches_dir(self):
+        return pathlib.Path(config.batches.storage_dir) / "batches"
+
+    async def load(self):
+        """Reads stored batches and resumes the unfinished ones."""
+
+        await asyncio.to_thread(Files.load)
+        self.batches_dir.mkdir(parents=True, exist_ok=True)
+
+        meta_paths = sorted(self.batches_dir.glob("*.json"))
+        for meta_path in meta_paths:
+            try:
+                batch = BatchObject.model_validate_json(meta_path.read_text("utf8"))
+            except (OSError, ValidationError) as exc:
+                logger.error(f"Skipping unreadable batch {meta_path}: {exc}")
+                continue
+
+            self.batches[batch.id] = batch
+
+        # Resume in order of creation
+        unfinished = [
+            batch
+            for batch in self.batches.values()
+            if batch.status in UNFINISHED_STATUSES
+        ]
+        for batch in sorted(unfinished, key=lambda batch: batch.created_at):
+            self._enqueue(batch)
+
+        if unfinished:
+            logger.info(f"Resuming {len(unfinished)} unfinished batch(es).")
+
+        self._task = asyncio.create_task(self._run_queue())
+
+    async def shutdown(self):
+        """Stops the running batch. Its progress is kept on disk."""
+
+        if self._task:
+            self._task.cancel()
+
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+            self._task = None
+
+        for batch in self.batches.values():
+            self._save(batch)
+
+    def get(self, batch_id: str, owner: Optional[str] = None):
+        """Returns a batch or raises a 404 error."""
+
+        batch = self.batches.get(batch_id)
+        if batch is None or not _is_visible(batch.owner, owner):
+            error_message = handle_request_error(
+                f"Batch {batch_id} does not exist.",
+                exc_info=False,
+            ).error.message
+
+            raise HTTPException(404, error_message)
+
+        return batch
+
+    def list(self, after: Optional[str], limit: int, owner: Optional[str] = None):
+        """Returns batches from newest to oldest, starting after an ID."""
+
+        batches = sorted(
+            (
+                batch
+                for batch in self.batches.values()
+                if _is_visible(batch.owner, owner)
+            ),
+            key=lambda batch: batch.created_at,
+            reverse=True,
+        )
+
+        if after:
+            ids = [batch.id for batch in batches]
+            start = ids.index(after) + 1 if after in ids else 0
+            batches = batches[start:]
+
+        return batches[:limit], len(batches) > limit
+
+    def create(self, data: BatchCreateRequest, owner: str, owner_permission: str):
+        """
+        Queues a batch for an uploaded file.
+
+        Its requests are accounted to the owner's key as they finish.
+        """
+
+        input_file = Files.get(
+            data.input_file_id, _owner_scope(owner, owner_permission)
+        )
+        if input_file.purpose != "batch":
+            error_message = handle_request_error(
+                f"File {input_file.id} wasn't uploaded for the batch purpose.",
+                exc_info=False,
+            ).error.message
+
+            raise HTTPException(400, error_message)
+
+        created_at = int(time.time())
+        batch = BatchObject(
+            id=f"batch_{uuid4().hex}",
+            endpoint=data.endpoint,
+            input_file_id=data.input_file_id,
+            completion_window=data.completion_window,
+            created_at=created_at,
+            expires_at=created_at + COMPLETION_WINDOW,
+            metadata=data.metadata,
+            owner=owner,
+            owner_permission=owner_permission,
+        )
+
+        self.batches[batch.id] = batch
+        self._save(batch)
+        self._enqueue(batch)
+
+        return batch
+
+    def cancel(self, batch_id: str, owner: Optional[str] = None):
+        """Stops a batch. Finished results are kept."""
+
+        batch = self.get(batch_id, owner)
+        if batch.status not in ("validating", "in_progress"):
+            error_message = handle_request_error(
+                f"Batch {batch_id} can't be cancelled since it's {batch.status}.",
+                exc_info=False,
+            ).error.message
+
+            raise HTTPException(400, error_message)
+
+        batch.status = "cancelling"
+        batch.cancelling_at = int(time.time())
+        self._cancel_events[batch.id].set()
+        self._save(batch)
+
+        return batch
+
+    def _enqueue(self, batch: BatchObject):
+        cancel_event = asyncio.Event()
+        if batch.status == "cancelling":
+            cancel_event.set()
+
+        self._cancel_events[batch.id] = cancel_event
+        self._queue.put_nowait(batch.id)
+
+    def _save(self, batch: BatchObject):
+        _write_json(self.batches_dir / f"{batch.id}.json", batch.model_dump_json())
+
+    def _output_path(self, batch: BatchObject):
+        return self.batches_dir / f"{batch.id}.output.jsonl"
+
+    def _error_path(self, batch: BatchObject):
+        return self.batches_dir / f"{batch.id}.errors.jsonl"
+
+    async def _run_queue(self):
+        while True:
+            batch = self.batches[await self._queue.get()]
+
+            try:
+                await self._run(batch)
+            except Exception as exc:
+                logger.error(f"Batch {batch.id} failed: {exc}")
+                self._fail(batch, [BatchError(code="server_error", message=str(exc))])
+            finally:
+                self._cancel_events.pop(batch.id, None)
+
+    async def _run(self, batch: BatchObject):
+        cancel_event = self._cancel_events[batch.id]
+
+        if batch.status == "validating":
+            logger.info(f"Validating batch {batch.id}")
+
+        requests, errors = await asyncio.to_thread(self._read_requests, batch)
+        if errors or not requests:
+            self._fail(
+                batch,
+                errors or [BatchError(code="empty_file", message="No requests found.")],
+            )
+            return
+
+        # Results of an interrupted run are kept
+        finished = await asyncio.to_thread(self._read_finished, batch)
+        batch.request_counts.total = len(requests)
+        batch.request_counts.completed = sum(finished.values())
+        batch.request_counts.failed = len(finished) - batch.request_counts.completed
+
+        if batch.status == "validating":
+            batch.status = "in_progress"
+            batch.in_progress_at = int(time.time())
+
+        self._save(batch)
+
+        with (
+            open(self._output_path(batch), "a", encoding="utf8") as output_file,
+            open(self._error_path(batch), "a", encoding="utf8") as error_file,
+        ):
+
+            def write_error(custom_id: str, request_id: str, code: str, message: str):
+                error_file.write(_error_line(custom_id, request_id, code, message))
+                batch.request_counts.failed += 1
+
+            # Render every prompt up front to order requests by shared prefix
+            pending = []
+            for custom_id, data in requests:
+                if custom_id in finished or cancel_event.is_set():
+                    continue
+
+                try:
+                    prompt = await get_batch_prompt(data)
+                except HTTPException as exc:
+                    write_error(custom_id, uuid4().hex, "invalid_request", exc.detail)
+                    continue
+
+                pending.append((prompt, custom_id, data))
+
+            pending.sort(key=lambda request: request[0])
+            pending = deque(pending)
+
+            async def run_requests():
+                while pending and not cancel_event.is_set():
+                    if time.time() > batch.expires_at:
+                        return
+
+                    prompt, custom_id, data = pending.popleft()
+                    request_id = uuid4().hex
+
+                    try:
+                        body = await run_batch_request(
+                            data,
+                            prompt,
+                            request_id,
+                            cancel_event,
+                            batch.owner,
+                            batch.owner_permission,
+                        )
+                    except HTTPException as exc:
+                        code = (
+                            "invalid_request"
+                            if exc.status_code < 500
+                            else "server_error"
+                        )
+                        write_error(custom_id, request_id, code, exc.detail)
+                        continue
+                    except Exception as exc:
+                        write_error(custom_id, request_id, "server_error", str(exc))
+                        continue
+
+                    # Generations stop early once cancelled, so drop them
+                    if cancel_event.is_set():
+                        return
+
+                    output_file.write(_result_line(custom_id, request_id, body))
+                    batch.request_counts.completed += 1
+
+            async def checkpoint():
+                while True:
+                    await asyncio.sleep(config.batches.checkpoint_interval)
+
+                    # Results go to disk before the counts that include them
+                    output_file.flush()
+                    error_file.flush()
+                    await asyncio.to_thread(self._save, batch)
+
+            checkpoint_task = asyncio.create_task(checkpoint())
+            try:
+                await asyncio.gather(
+                    *[run_requests() for _ in range(self._concurrency(batch))]
+                )
+            finally:
+                checkpoint_task.cancel()
+
+            # Unfinished requests of an expired batch are reported as errors
+            if pending and not cancel_event.is_set():
+                for _, custom_id, _ in pending:
+                    write_error(
+                        custom_id,
+                        uuid4().hex,
+                        "batch_expired",
+                        "The batch expired before this request ran.",
+                    )
+
+        self._finish(batch, cancelled=cancel_event.is_set(), expired=bool(pending))
+
+    def _concurrency(self, batch: BatchObject):
+        if config.batches.concurrency:
+            return config.batches.concurrency
+
+        if batch.endpoint == "/v1/embeddings":
+            return config.embeddings.embeddings_batch_size
+
+        if model.container and model.container.max_batch_size:
+            return model.container.max_batch_size
+
+        return 1
+
+    def _read_requests(self, batch: BatchObject):
+        """Parses the input file into (custom_id, request) pairs."""
+
+        requests = []
+        errors: List[BatchError] = []
+        custom_ids = set()
+
+        def add_error(code: str, message: str, line: int):
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append(BatchError(code=code, message=message, line=line))
+
+        with open(Files.path(batch.input_file_id), "r", encoding="utf8") as file:
+            for line_number, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError as exc:
+                    add_error("invalid_json", str(exc), line_number)
+                    continue
+
+                if not isinstance(item, dict):
+                    add_error("invalid_json", "Expected a JSON object.", line_number)
+                    continue
+
+                custom_id = item.get("custom_id")
+                if not isinstance(custom_id, str):
+                    add_error(
+                        "missing_custom_id", "custom_id must be a string.", line_number
+                    )
+                    continue
+
+                if custom_id in custom_ids:
+                    add_error(
+                        "duplicate_custom_id",
+                        f"custom_id {custom_id} is used more than once.",
+                        line_number,
+                    )
+                    continue
+
+                if item.get("url") != batch.endpoint:
+                    add_error(
+                        "invalid_url",
+                        f"Every request must target {batch.endpoint}.",
+                        line_number,
+                    )
+                    continue
+
+                if item.get("method", "POST") != "POST":
+                    add_error("invalid_method", "Only POST is supported.", line_number)
+                    continue
+
+                try:
+                    data = parse_batch_request(batch.endpoint, item.get("body") or {})
+                except ValidationError as exc:
+                    add_error("invalid_request", str(exc), line_number)
+                    continue
+
+                custom_ids.add(custom_id)
+                requests.append((custom_id, data))
+
+        return requests, errors
+
+    def _read_finished(self, batch: BatchObject):
+        """Maps the custom IDs of finished requests to whether they succeeded."""
+
+        finished = {}
+
+        for path, succeeded in (
+            (self._output_path(batch), True),
+            (self._error_path(batch), False),
+        ):
+            if not path.exists():
+                continue
+
+            lines = path.read_text("utf8").splitlines(keepends=True)
+
+            # Drop a torn last line so its request runs again
+            if lines and not lines[-1].endswith("\n"):
+                lines.pop()
+                path.write_text("".join(lines), encoding="utf8")
+
+            for line in lines:
+                finished[json.loads(line)["custom_id"]] = succeeded
+
+        return finished
+
+    def _fail(self, batch: BatchObject, errors: List[BatchError]):
+        batch.status = "failed"
+        batch.failed_at = int(time.time())
+        batch.errors = BatchErrors(data=errors)
+        self._save(batch)
+
+        logger.warning(f"Batch {batch.id} failed.")
+
+    def _finish(self, batch: BatchObject, cancelled: bool, expired: bool):
+        batch.status = "finalizing"
+        batch.finalizing_at = int(time.time())
+
+        # Hand the results over as regular files
+        for path, purpose in (
+            (self._output_path(batch), "batch_output"),
+            (self._error_path(batch), "batch_error"),
+        ):
+            if not path.exists() or path.stat().st_size == 0:
+                path.unlink(missing_ok=True)
+                continue
+
+            file_id = f"file-{uuid4().hex}"
+            path.replace(Files.path(file_id))
+            file = Files.register(
+                file_id, f"{batch.id}_{purpose}.jsonl", purpose, batch.owner
+            )
+
+            if purpose == "batch_output":
+                batch.output_file_id = file.id
+            else:
+                batch.error_file_id = file.id
+
+        finished_at = int(time.time())
+        if cancelled:
+            batch.status = "cancelled"
+            batch.cancelled_at = finished_at
+        elif expired:
+            batch.status = "expired"
+            batch.expired_at = finished_at
+        else:
+            batch.status = "completed"
+            batch.completed_at = finished_at
+
+        self._save(batch)
+
+        logger.info(
+            f"Batch {batch.id} {batch.status}: "
+            f"{batch.request_counts.completed} completed, "
+            f"{batch.request_counts.failed} failed."
+        )
+
+
+def _owner_scope(key_id: str, permission: str):
+    # Admin keys can access every file and batch
+    return None if permission == AuthPermission.admin else key_id
+
+
+async def get_owner(request: Request):
+    """Returns the key ID and permission of a request's API key."""
+
+    permission = await AuthManager.get_key_permission(request)
+    return get_key_id(request), getattr(permission, "value", permission)
+
+
+async def get_owner_scope(request: Request):
+    """Returns the key ID whose files and batches a request can access."""
+
+    return _owner_scope(*await get_owner(request))
+
+
+async def check_batches():
+    """FastAPI depends that checks if the batch API is enabled."""
+
+    if not config.batches.enable:
+        error_message = handle_request_error(
+            "The batch API is disabled. Enable it in the batches config.",
+            exc_info=False,
+        ).error.message
+
+        raise HTTPException(400, error_message)
+
+
+# Create instances of the global file store and batch queue
+Files = FilesClass()
+Batches = BatchesClass()
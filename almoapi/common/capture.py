@@ -0,0 +1,297 @@
+"""
+Traffic capture for building replay workloads.
+
+Sampled requests are recorded by an ASGI middleware and written to rotating
+JSONL files by a background thread, so parsing, redaction and disk writes
+never run on the event loop. Each line has the "url" and "body" keys that
+benchmark.py replays, plus the observed timings and output length.
+"""
+
+import json
+import pathlib
+import queue
+import random
+import re
+import threading
+import time
+from typing import List, Optional
+
+from loguru import logger
+
+from config.config import config
+
+# Endpoints that benchmark.py knows how to replay
+CAPTURE_PATHS = {
+    "/v1/completions",
+    "/v1/chat/completions",
+    "/v1/embeddings",
+    "/v1/rerank",
+}
+
+# Records waiting to be written. Further records are dropped.
+MAX_QUEUED_RECORDS = 10000
+
+# Usage is sent at the end of responses, so only the tail is kept
+RESPONSE_TAIL_BYTES = 4096
+
+PII_PATTERNS = [
+    # Emails
+    r"[\w.+-]+@[\w-]+\.[\w.-]+",
+    # Card numbers
+    r"\b(?:\d[ -]?){13,16}\b",
+    # Phone numbers
+    r"\+?\(?\d{1,4}\)?[ .-]?\(?\d{2,4}\)?[ .-]\d{3,4}[ .-]?\d{3,4}\b",
+    # IPv4 addresses
+    r"\b(?:\d{1,3}\.){3}\d{1,3}\b",
+]
+
+# Request fields that identify the end user
+PII_FIELDS = {"user"}
+
+REDACTED = "[REDACTED]"
+
+USAGE_PATTERN = re.compile(rb'"usage"\s*:\s*(\{[^{}]*\})')
+
+
+def redact(value, patterns: List[re.Pattern], drop_fields: set):
+    """Replaces matches of the patterns in every string of a JSON value."""
+
+    if isinstance(value, str):
+        for pattern in patterns:
+            value = pattern.sub(REDACTED, value)
+
+        return value
+
+    if isinstance(value, list):
+        return [redact(item, patterns, drop_fields) for item in value]
+
+    if isinstance(value, dict):
+        return {
+            key: redact(item, patterns, drop_fields)
+            for key, item in value.items()
+            if key not in drop_fields
+        }
+
+    return value
+
+
+def parse_output_tokens(tail: bytes) -> Optional[int]:
+    """Reads the completion tokens from the last usage object of a response."""
+
+    matches = USAGE_PATTERN.findall(tail)
+    if not matches:
+        return None
+
+    try:
+        usage = json.loads(matches[-1])
+    except ValueError:
+        return None
+
+    return usage.get("completion_tokens")
+
+
+class RotatingJsonlWriter:
+    """Appends lines to JSONL files, starting a new file after max_bytes."""
+
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        max_bytes: int,
+        max_files: int,
+        prefix: str = "capture",
+    ):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self._file = None
+        self._size = 0
+
+    def write(self, line: str):
+        data = (line + "\n").encode("utf8")
+
+        if self._file is None or self._size + len(data) > self.max_bytes:
+            self._rotate()
+
+        self._file.write(data)
+        self._size += len(data)
+
+    def flush(self):
+        if self._file:
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _rotate(self):
+        self.close()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        # Names sort by creation time, so the oldest files come first
+        now = time.time()
+        timestamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+        milliseconds = int(now * 1000) % 1000
+        path = self.directory / f"{self.prefix}-{timestamp}-{milliseconds:03d}.jsonl"
+        self._file = open(path, "ab")
+        self._size = 0
+
+        old_files = sorted(self.directory.glob(f"{self.prefix}-*.jsonl"))
+        for old_file in old_files[: -self.max_files]:
+            old_file.unlink(missing_ok=True)
+
+
+class TrafficCaptureClass:
+    """Class to manage the traffic capture global state"""
+
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue(MAX_QUEUED_RECORDS)
+        self._thread: Optional[threading.Thread] = None
+        self.dropped = 0
+
+    def start(self):
+        """Starts the writer thread."""
+
+        patterns = list(PII_PATTERNS) if config.capture.redact_pii else []
+        patterns += config.capture.redact_patterns
+        self._patterns = [re.compile(pattern) for pattern in patterns]
+        self._drop_fields = PII_FIELDS if config.capture.redact_pii else set()
+
+        writer = RotatingJsonlWriter(
+            pathlib.Path(config.capture.capture_dir),
+            config.capture.max_file_size * 1024**2,
+            config.capture.max_files,
+        )
+
+        self._thread = threading.Thread(
+            target=self._write_loop, args=(writer,), name="capture", daemon=True
+        )
+        self._thread.start()
+
+        logger.info(f"Capturing traffic to {config.capture.capture_dir}")
+
+    def stop(self):
+        """Writes the queued records and stops the writer thread."""
+
+        if not self._thread:
+            return
+
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+        if self.dropped:
+            logger.warning(f"Capture dropped {self.dropped} records")
+
+    def should_capture(self, scope: dict):
+        return (
+            self._thread is not None
+            and scope["type"] == "http"
+            and scope["method"] == "POST"
+            and scope["path"] in CAPTURE_PATHS
+            and random.random() < config.capture.sample_rate
+        )
+
+    def submit(self, record: dict):
+        """Queues a raw record without blocking the event loop."""
+
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self, writer: RotatingJsonlWriter):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+
+            try:
+                writer.write(self._format(record))
+            except Exception as exc:
+                logger.error(f"Couldn't write a capture record: {exc}")
+
+            # Flush once the queue drains so files are readable while running
+            if self._queue.empty():
+                writer.flush()
+
+        writer.close()
+
+    def _format(self, record: dict):
+        body = json.loads(record.pop("body"))
+        tail = record.pop("tail")
+
+        record["body"] = redact(body, self._patterns, self._drop_fields)
+        record["output_tokens"] = parse_output_tokens(tail)
+
+        return json.dumps(record, ensure_ascii=False)
+
+
+TrafficCapture = TrafficCaptureClass()
+
+
+class CaptureMiddleware:
+    """ASGI middleware that records sampled requests and their responses."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not TrafficCapture.should_capture(scope):
+            await self.app(scope, receive, send)
+            return
+
+        arrival = time.time()
+        start = time.perf_counter()
+        body_parts = []
+        tail = b""
+        state = {"status": None, "ttft": None, "chunks": 0, "stream": False}
+
+        async def capture_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                body_parts.append(message.get("body", b""))
+
+            return message
+
+        async def capture_send(message):
+            nonlocal tail
+
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+                headers = dict(message.get("headers", []))
+                content_type = headers.get(b"content-type", b"")
+                state["stream"] = content_type.startswith(b"text/event-stream")
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                if chunk:
+                    if state["ttft"] is None:
+                        state["ttft"] = time.perf_counter() - start
+
+                    if state["stream"]:
+                        state["chunks"] += chunk.count(b"data: {")
+
+                    tail = (tail + chunk)[-RESPONSE_TAIL_BYTES:]
+
+            await send(message)
+
+        try:
+            await self.app(scope, capture_receive, capture_send)
+        finally:
+            body = b"".join(body_parts)
+            if body:
+                TrafficCapture.submit(
+                    {
+                        "timestamp": arrival,
+                        "url": scope["path"],
+                        "request_id": scope.get("state", {}).get("id"),
+                        "status": state["status"],
+                        "stream": state["stream"],
+                        "ttft": state["ttft"] if state["stream"] else None,
+                        "e2e": time.perf_counter() - start,
+                        "output_chunks": state["chunks"] if state["stream"] else None,
+                        "body": body,
+                        "tail": tail,
+                    }
+                )
@@ -1,12 +1,27 @@
 """
 Functions for logging generation events.
+
+Events are queued with their raw values and formatted by a background thread,
+so long prompts and responses are never formatted or written on the event
+loop. They're printed to the console, or written to rotating JSONL files if
+log_to_file is enabled.
 """
 
+import json
+import pathlib
+import queue
+import threading
+import time
 from loguru import logger
 from typing import Optional
 
+from common.capture import RotatingJsonlWriter
+from common.utils import unwrap
 from config.config import config
 
+# Events waiting to be written. Further events are dropped.
+MAX_QUEUED_EVENTS = 10000
+
 
 def broadcast_status():
     """Broadcasts the current logging status"""
@@ -18,54 +33,58 @@ def broadcast_status():
         enabled.append("generation params")
 
     if len(enabled) > 0:
-        logger.info("Generation logging is enabled for: " + ", ".join(enabled))
+        destination = (
+            f" (writing to {config.logging.log_dir})"
+            if config.logging.log_to_file
+            else ""
+        )
+        logger.info(
+            "Generation logging is enabled for: " + ", ".join(enabled) + destination
+        )
     else:
         logger.info("Generation logging is disabled")
 
 
-def log_generation_params(**kwargs):
-    """Logs generation parameters to console."""
-    if config.logging.log_generation_params:
-        logger.info(f"Generation options: {kwargs}\n")
+def format_generation_params(record: dict):
+    return f"Generation options: {record['params']}\n"
 
 
-def log_prompt(prompt: str, request_id: str, negative_prompt: Optional[str]):
-    """Logs the prompt to console."""
-    if config.logging.log_prompt:
-        formatted_prompt = "\n" + prompt
-        logger.info(
-            f"Prompt (ID: {request_id}): {formatted_prompt if prompt else 'Empty'}\n"
-        )
+def format_prompt(record: dict):
+    prompt = record["prompt"]
+    formatted_prompt = "\n" + unwrap(record["bos_token"], "") + prompt
+    message = (
+        f"Prompt (ID: {record['request_id']}): "
+        f"{formatted_prompt if prompt else 'Empty'}\n"
+    )
 
-        if negative_prompt:
-            formatted_negative_prompt = "\n" + negative_prompt
-            logger.info(f"Negative Prompt: {formatted_negative_prompt}\n")
+    negative_prompt = record["negative_prompt"]
+    if negative_prompt:
+        message += f"Negative Prompt: \n{negative_prompt}\n"
 
+    return message
 
-def log_response(request_id: str, response: str):
-    """Logs the response to console."""
-    if config.logging.log_prompt:
-        formatted_response = "\n" + response
-        logger.info(
-            f"Response (ID: {request_id}): "
-            f"{formatted_response if response else 'Empty'}\n"
-        )
 
+def format_response(record: dict):
+    response = record["response"]
+    formatted_response = "\n" + response
+    return (
+        f"Response (ID: {record['request_id']}): "
+        f"{formatted_response if response else 'Empty'}\n"
+    )
+
+
+def format_metrics(record: dict):
+    queue_time = record["queue_time"]
+    prompt_tokens = record["prompt_tokens"]
+    cached_tokens = record["cached_tokens"]
+    prompt_time = record["prompt_time"]
+    generated_tokens = record["generated_tokens"]
+    generate_time = record["generate_time"]
+    context_len = record["context_len"]
 
-def log_metrics(
-    request_id: str,
-    queue_time: float,
-    prompt_tokens: int,
-    cached_tokens: int,
-    prompt_time: float,
-    generated_tokens: int,
-    generate_time: float,
-    context_len: Optional[int],
-    max_seq_len: int,
-):
     initial_response = (
-        f"Metrics (ID: {request_id}): {generated_tokens} tokens generated in "
-        f"{round(queue_time + prompt_time + generate_time, 2)} seconds"
+        f"Metrics (ID: {record['request_id']}): {generated_tokens} tokens generated "
+        f"in {round(queue_time + prompt_time + generate_time, 2)} seconds"
     )
     itemization = []
     extra_parts = []
@@ -93,10 +112,159 @@ def log_metrics(
     if context_len:
         itemization.append(f"Context: {context_len} tokens")
 
-        if context_len > max_seq_len:
+        if context_len > record["max_seq_len"]:
             extra_parts.append("<-- Not accurate (truncated)")
 
-    # Print output
-    logger.info(
+    return (
         initial_response + " (" + ", ".join(itemization) + ") " + " ".join(extra_parts)
     )
+
+
+FORMATTERS = {
+    "generation_params": format_generation_params,
+    "prompt": format_prompt,
+    "response": format_response,
+    "metrics": format_metrics,
+}
+
+
+class GenerationLoggerClass:
+    """Class to manage the generation logging global state"""
+
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue(MAX_QUEUED_EVENTS)
+        self._thread: Optional[threading.Thread] = None
+        self._writer: Optional[RotatingJsonlWriter] = None
+        self.dropped = 0
+
+    def start(self):
+        """Starts the logging thread."""
+
+        if config.logging.log_to_file:
+            self._writer = RotatingJsonlWriter(
+                pathlib.Path(config.logging.log_dir),
+                config.logging.log_max_file_size * 1024**2,
+                config.logging.log_max_files,
+                prefix="generation",
+            )
+
+        self._thread = threading.Thread(
+            target=self._write_loop, name="gen_logging", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Writes the queued events and stops the logging thread."""
+
+        if not self._thread:
+            return
+
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+        if self.dropped:
+            logger.warning(f"Generation logging dropped {self.dropped} events")
+
+    def submit(self, event: str, **fields):
+        """Queues an event without blocking the event loop."""
+
+        record = {"timestamp": time.time(), "event": event, **fields}
+
+        # Write directly if the thread isn't running, such as in scripts
+        if self._thread is None:
+            self._write(record)
+            return
+
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+
+            try:
+                self._write(record)
+            except Exception as exc:
+                logger.error(f"Couldn't log a generation event: {exc}")
+
+            # Flush once the queue drains so files are readable while running
+            if self._writer and self._queue.empty():
+                self._writer.flush()
+
+    def _write(self, record: dict):
+        if self._writer:
+            self._writer.write(json.dumps(record, ensure_ascii=False, default=str))
+
+            # Metrics are still shown in the console
+            if record["event"] != "metrics":
+                return
+
+        logger.info(FORMATTERS[record["event"]](record))
+
+
+GenerationLogger = GenerationLoggerClass()
+
+
+def log_generation_params(**kwargs):
+    """Logs generation parameters."""
+    if config.logging.log_generation_params:
+        GenerationLogger.submit(
+            "generation_params", request_id=kwargs.get("request_id"), params=kwargs
+        )
+
+
+def log_prompt(
+    prompt: str,
+    request_id: str,
+    negative_prompt: Optional[str],
+    bos_token: Optional[str] = None,
+):
+    """Logs the prompt with the BOS token if it's added."""
+    if config.logging.log_prompt:
+        GenerationLogger.submit(
+            "prompt",
+            request_id=request_id,
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            bos_token=bos_token,
+        )
+
+
+def log_response(request_id: str, response: str):
+    """Logs the response."""
+    if config.logging.log_prompt:
+        GenerationLogger.submit("response", request_id=request_id, response=response)
+
+
+def log_metrics(
+    request_id: str,
+    queue_time: float,
+    prompt_tokens: int,
+    cached_tokens: int,
+    prompt_time: float,
+    generated_tokens: int,
+    generate_time: float,
+    context_len: Optional[int],
+    max_seq_len: int,
+):
+    GenerationLogger.submit(
+        "metrics",
+        request_id=request_id,
+        queue_time=queue_time,
+        prompt_tokens=prompt_tokens,
+        cached_tokens=cached_tokens,
+        prompt_time=prompt_time,
+        generated_tokens=generated_tokens,
+        generate_time=generate_time,
+        context_len=context_len,
+        max_seq_len=max_seq_len,
+    )
@@ -0,0 +1,202 @@
+"""
+Event loop lag monitor.
+
+A task sleeps for a fixed interval and records how late it wakes up, which is
+the scheduling delay every other coroutine sees. A watchdog thread checks
+when that task last ran. If the loop is blocked for longer than the stall
+threshold, the thread captures the loop thread's stack while it's still
+blocked, so the blocking code shows up in the stall. Neither relies on asyncio
+internals, so this works with uvloop.
+"""
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import List, Optional
+
+from fastapi import HTTPException
+from loguru import logger
+from pydantic import BaseModel, Field
+
+from common.networking import handle_request_error
+from config.config import config
+
+# Lag samples used for the percentiles
+MAX_RECENT_LAGS = 1000
+
+
+def percentile(sorted_values: List[float], fraction: float):
+    """Nearest-rank percentile of sorted values."""
+
+    if not sorted_values:
+        return 0.0
+
+    return sorted_values[
+        min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    ]
+
+
+class LoopStall(BaseModel):
+    """A time the event loop was blocked past the stall threshold"""
+
+    timestamp: float = Field(description="Unix time the stall was detected")
+    duration_ms: Optional[float] = Field(
+        None, description="How long the loop was blocked, unset while it still is"
+    )
+    stack: List[str] = Field(
+        default_factory=list, description="Stack of the loop thread while blocked"
+    )
+
+
+class LoopLagStats(BaseModel):
+    """Event loop lag since startup"""
+
+    samples: int = Field(0, description="Lag measurements taken")
+    lag_ms: float = Field(0.0, description="Latest lag")
+    mean_lag_ms: float = Field(0.0, description="Mean lag of all samples")
+    p50_lag_ms: float = Field(0.0, description="Median lag of recent samples")
+    p99_lag_ms: float = Field(0.0, description="99th percentile of recent samples")
+    max_lag_ms: float = Field(0.0, description="Highest lag")
+    stalls: int = Field(0, description="Times the loop was blocked past the threshold")
+    recent_stalls: List[LoopStall] = Field(
+        default_factory=list, description="Latest stalls, oldest first"
+    )
+
+
+class LoopMonitorClass:
+    """Class to manage the event loop monitor global state"""
+
+    def __init__(self):
+        self.stats = LoopLagStats()
+        self._total_lag = 0.0
+        self._recent_lags = deque(maxlen=MAX_RECENT_LAGS)
+        self._stalls = deque()
+        self._open_stall: Optional[LoopStall] = None
+
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """Starts measuring the running loop."""
+
+        self._stalls = deque(maxlen=config.loop_monitor.max_stalls)
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop_event.clear()
+
+        self._task = asyncio.create_task(self._measure_loop())
+        self._thread = threading.Thread(
+            target=self._watch_loop, name="loop_monitor", daemon=True
+        )
+        self._thread.start()
+
+        logger.info(
+            "Monitoring event loop lag, stalls over "
+            f"{config.loop_monitor.stall_threshold} ms are logged"
+        )
+
+    def stop(self):
+        """Stops the measuring task and the watchdog thread."""
+
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+        if self._thread:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def get_stats(self):
+        """Returns a snapshot of the lag statistics."""
+
+        recent_lags = sorted(self._recent_lags)
+
+        return self.stats.model_copy(
+            update={
+                "mean_lag_ms": (
+                    self._total_lag / self.stats.samples if self.stats.samples else 0.0
+                ),
+                "p50_lag_ms": percentile(recent_lags, 0.5),
+                "p99_lag_ms": percentile(recent_lags, 0.99),
+                "recent_stalls": list(self._stalls),
+            }
+        )
+
+    async def _measure_loop(self):
+        interval = config.loop_monitor.interval / 1000
+
+        while True:
+            expected = time.monotonic() + interval
+            await asyncio.sleep(interval)
+
+            now = time.monotonic()
+            self._heartbeat = now
+
+            lag = max(now - expected, 0.0) * 1000
+            self._record(lag)
+
+    def _record(self, lag: float):
+        self.stats.samples += 1
+        self.stats.lag_ms = lag
+        self.stats.max_lag_ms = max(self.stats.max_lag_ms, lag)
+        self._total_lag += lag
+        self._recent_lags.append(lag)
+
+        # The loop is running again, so the last stall is over
+        stall = self._open_stall
+        if stall is not None:
+            self._open_stall = None
+            stall.duration_ms = lag
+
+            logger.warning(
+                f"Event loop was blocked for {round(lag)} ms in:\n"
+                + "".join(stall.stack)
+            )
+
+    def _watch_loop(self):
+        interval = config.loop_monitor.interval / 1000
+        threshold = config.loop_monitor.stall_threshold / 1000
+        stalled_heartbeat = None
+
+        while not self._stop_event.wait(min(interval, threshold) / 2):
+            heartbeat = self._heartbeat
+
+            # The loop is expected to tick once per interval
+            blocked = time.monotonic() - heartbeat - interval
+            if blocked < threshold or heartbeat == stalled_heartbeat:
+                continue
+
+            # Only capture the first stack of each stall
+            stalled_heartbeat = heartbeat
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stall = LoopStall(
+                timestamp=time.time(),
+                stack=traceback.format_stack(frame) if frame else [],
+            )
+
+            self._stalls.append(stall)
+            self.stats.stalls += 1
+            self._open_stall = stall
+
+
+LoopMonitor = LoopMonitorClass()
+
+
+async def check_loop_monitor():
+    """FastAPI depends that checks if the loop monitor is enabled."""
+
+    if not config.loop_monitor.enable:
+        error_message = handle_request_error(
+            "The loop monitor is disabled. Enable it in the loop_monitor config.",
+            exc_info=False,
+        ).error.message
+
+        raise HTTPException(400, error_message)
@@ -22,12 +22,15 @@ if dependencies.exllamav2:
     # Global model container
     container: Optional[ExllamaV2Container] = None
     embeddings_container = None
+    rerank_container = None
 
 
 if dependencies.extras:
     from backends.infinity.model import InfinityContainer
+    from backends.infinity.reranker import RerankerContainer
 
     embeddings_container: Optional[InfinityContainer] = None
+    rerank_container: Optional[RerankerContainer] = None
 
 
 class ModelType(Enum):
@@ -160,6 +163,39 @@ async def unload_embedding_model():
     embeddings_container = None
 
 
+async def load_rerank_model(model_path: pathlib.Path, **kwargs):
+    global rerank_container
+
+    # Break out if infinity isn't installed
+    if not dependencies.extras:
+        raise ImportError(
+            "Skipping reranking because infinity-emb is not installed.\n"
+            "Please run the following command in your environment "
+            "to install extra packages:\n"
+            "pip install -U .[extras]"
+        )
+
+    if rerank_container and rerank_container.engine:
+        logger.info("Unloading existing reranker model.")
+        await unload_rerank_model()
+
+    rerank_container = RerankerContainer(model_path)
+
+    try:
+        await rerank_container.load(**kwargs)
+    except Exception:
+        # Don't leave a container without an engine behind
+        rerank_container = None
+        raise
+
+
+async def unload_rerank_model():
+    global rerank_container
+
+    await rerank_container.unload()
+    rerank_container = None
+
+
 async def check_model_container():
     """FastAPI depends that checks if a model isn't loaded or currently loading."""
 
@@ -188,3 +224,17 @@ async def check_embeddings_container():
         ).error.message
 
         raise HTTPException(400, error_message)
+
+
+async def check_rerank_container():
+    """FastAPI depends that checks if a reranker model is loaded."""
+
+    if rerank_container is None or not (
+        rerank_container.model_is_loading or rerank_container.model_loaded
+    ):
+        error_message = handle_request_error(
+            "No reranker models are currently loaded.",
+            exc_info=False,
+        ).error.message
+
+        raise HTTPException(400, error_message)
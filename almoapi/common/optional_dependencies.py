@@ -18,6 +18,7 @@ class DependenciesModel(BaseModel):
     infinity_emb: bool
     sentence_transformers: bool
     redis: bool
+    fastparquet: bool
 
     @computed_field
     @property
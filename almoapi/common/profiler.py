@@ -0,0 +1,112 @@
+"""
+Sampling profiler for the running server.
+
+A thread records the stack of every other thread at a fixed rate, which
+covers the event loop and the worker threads without tracing each call, so
+it's safe to run under load. Samples are counted as collapsed stacks, the
+input format of flamegraph.pl, inferno and speedscope.
+"""
+
+import asyncio
+import pathlib
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict
+
+from fastapi import HTTPException
+
+from common.networking import handle_request_error
+
+# Longest profile that can be requested
+MAX_PROFILE_SECONDS = 300
+
+# Highest sampling rate in samples per second
+MAX_SAMPLE_RATE = 1000
+
+
+def frame_label(code):
+    """Names a function like py-spy, by its file and first line."""
+
+    path = pathlib.Path(code.co_filename)
+    label = f"{code.co_name} ({path.parent.name}/{path.name}:{code.co_firstlineno})"
+
+    # Semicolons separate frames in collapsed stacks
+    return label.replace(";", ":")
+
+
+class ProfilerClass:
+    """Class to manage the sampling profiler global state"""
+
+    def __init__(self):
+        # Only one profile runs at a time
+        self._lock = asyncio.Lock()
+
+    async def profile(self, seconds: float, rate: int):
+        """
+        Samples every thread for a number of seconds.
+
+        Fails with a 409 instead of waiting if a profile is already running.
+        """
+
+        # Acquiring a free lock doesn't yield, so nothing can take it between
+        # the check and the acquire
+        if self._lock.locked():
+            error_message = handle_request_error(
+                "A profile is already running. Please wait for it to finish.",
+                exc_info=False,
+            ).error.message
+
+            raise HTTPException(409, error_message)
+
+        stop_event = threading.Event()
+
+        async with self._lock:
+            try:
+                samples = await asyncio.to_thread(
+                    self._sample, seconds, 1 / rate, stop_event
+                )
+            finally:
+                # Stop sampling if the request is cancelled
+                stop_event.set()
+
+        return "".join(f"{stack} {count}\n" for stack, count in samples.items())
+
+    def _sample(self, seconds: float, interval: float, stop_event: threading.Event):
+        samples = Counter()
+        labels: Dict[object, str] = {}
+        sampler_id = threading.get_ident()
+
+        deadline = time.perf_counter() + seconds
+        next_sample = time.perf_counter()
+        while not stop_event.is_set() and next_sample < deadline:
+            thread_names = {
+                thread.ident: thread.name for thread in threading.enumerate()
+            }
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = frame_label(code)
+
+                    stack.append(label)
+                    frame = frame.f_back
+
+                stack.append(thread_names.get(thread_id, f"Thread-{thread_id}"))
+                samples[";".join(reversed(stack))] += 1
+
+            # Keep the rate steady regardless of how long a sample takes
+            next_sample += interval
+            stop_event.wait(max(next_sample - time.perf_counter(), 0))
+
+        return samples
+
+
+Profiler = ProfilerClass()
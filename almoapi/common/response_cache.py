@@ -0,0 +1,285 @@
+"""
+Exact-match cache for responses of deterministic generation requests.
+
+Responses are stored as their stream of generation chunks, so a cached result
+can be replayed to streaming requests or joined for non-streaming ones.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import pathlib
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, List, Optional, Tuple
+
+from fastapi import Request
+from loguru import logger
+from pydantic import BaseModel, Field
+
+from common import model
+from common.utils import GENERATION_TIMING_KEYS
+from config.config import config
+from samplers.sampling import BaseSamplerRequest
+
+# Request fields that only change how a response is delivered
+DELIVERY_FIELDS = {"stream", "stream_options", "n", "model", "user"}
+
+# Start pruning the disk tier down to this share of its budget
+DISK_PRUNE_RATIO = 0.9
+
+
+class ResponseCacheStats(BaseModel):
+    """Response cache counters since startup"""
+
+    hits: int = Field(0, description="Lookups served from the cache")
+    disk_hits: int = Field(0, description="Hits served from the on-disk tier")
+    misses: int = Field(0, description="Lookups without a valid entry")
+    bypasses: int = Field(0, description="Requests that skipped the cache")
+    stores: int = Field(0, description="Responses added to the cache")
+    evictions: int = Field(0, description="Entries evicted from memory")
+    expirations: int = Field(0, description="Entries dropped after their TTL")
+    entries: int = Field(0, description="Entries held in memory")
+    memory_bytes: int = Field(0, description="Size of the entries held in memory")
+    hit_rate: float = Field(0.0, description="Hits divided by lookups")
+
+
+def is_deterministic(gen_params: BaseSamplerRequest):
+    """Whether sampler parameters always produce the same tokens."""
+
+    return gen_params.temperature == 0 or gen_params.top_k == 1
+
+
+def _cache_control(request: Request):
+    header = request.headers.get("cache-control", "")
+    return {directive.strip().lower() for directive in header.split(",")}
+
+
+class ResponseCacheClass:
+    """Class to manage the response cache global state"""
+
+    def __init__(self):
+        # Key -> (expiry time, serialized chunks)
+        self._entries: OrderedDict[str, Tuple[Optional[float], bytes]] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes: Optional[int] = None
+        self._disk_lock = threading.Lock()
+        self.stats = ResponseCacheStats()
+
+    def make_key(self, prompt: str, gen_params: BaseSamplerRequest):
+        """Canonical hash of everything that determines a generation."""
+
+        loras = [
+            (str(lora.lora_path), lora.lora_scaling)
+            for lora in model.container.get_loras()
+        ]
+
+        payload = {
+            "model": model.container.model_dir.name,
+            "cache_mode": model.container.cache_mode,
+            "loras": loras,
+            "prompt": prompt,
+            "params": gen_params.model_dump(mode="json", exclude=DELIVERY_FIELDS),
+        }
+
+        serialized = json.dumps(payload, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode()).hexdigest()
+
+    async def lookup(
+        self, request: Request, prompt: str, gen_params: BaseSamplerRequest
+    ) -> Tuple[Optional[str], Optional[List[dict]]]:
+        """
+        Looks up the cached chunks of a request.
+
+        Returns the key to store the response under, which is None if the
+        request can't be cached, and the cached chunks on a hit.
+        """
+
+        if not config.response_cache.enable or not is_deterministic(gen_params):
+            return None, None
+
+        directives = _cache_control(request)
+        if "no-store" in directives:
+            self.stats.bypasses += 1
+            return None, None
+
+        key = self.make_key(prompt, gen_params)
+
+        # Regenerate, but refresh the entry with the new response
+        if "no-cache" in directives:
+            self.stats.bypasses += 1
+            return key, None
+
+        payload = self._get_memory(key)
+        if payload is None and config.response_cache.disk_dir:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None:
+                # Promote the entry so repeated hits skip the disk
+                self._put_memory(key, *entry)
+                payload = entry[1]
+                self.stats.disk_hits += 1
+
+        if payload is None:
+            self.stats.misses += 1
+            return key, None
+
+        self.stats.hits += 1
+        return key, json.loads(payload)
+
+    async def store(self, key: str, chunks: List[dict]):
+        """Adds the chunks of a finished generation to the cache."""
+
+        ttl = config.response_cache.ttl
+        expires = time.time() + ttl if ttl else None
+        payload = json.dumps(chunks).encode()
+
+        self._put_memory(key, expires, payload)
+        self.stats.stores += 1
+
+        if config.response_cache.disk_dir:
+            await asyncio.to_thread(self._write_disk, key, expires, payload)
+
+    async def replay(self, chunks: List[dict]) -> AsyncIterator[dict]:
+        """Yields copies of cached chunks in the same shape as a generation."""
+
+        for chunk in chunks:
+            chunk = dict(chunk)
+
+            # Replays don't spend the time of the original generation
+            for key in GENERATION_TIMING_KEYS:
+                chunk.pop(key, None)
+
+            yield chunk
+
+    async def clear(self):
+        """Drops every entry from memory and disk."""
+
+        self._entries.clear()
+        self._memory_bytes = 0
+
+        if config.response_cache.disk_dir:
+            await asyncio.to_thread(self._clear_disk)
+
+    def get_stats(self):
+        """Returns a snapshot of the cache counters."""
+
+        lookups = self.stats.hits + self.stats.misses
+        return self.stats.model_copy(
+            update={
+                "entries": len(self._entries),
+                "memory_bytes": self._memory_bytes,
+                "hit_rate": self.stats.hits / lookups if lookups else 0.0,
+            }
+        )
+
+    def _get_memory(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires, payload = entry
+        if expires is not None and expires < time.time():
+            self._drop(key)
+            self.stats.expirations += 1
+            return None
+
+        self._entries.move_to_end(key)
+        return payload
+
+    def _put_memory(self, key: str, expires: Optional[float], payload: bytes):
+        max_bytes = int(config.response_cache.max_memory_mb * 1024**2)
+        if len(payload) > max_bytes:
+            return
+
+        self._drop(key)
+        self._entries[key] = (expires, payload)
+        self._memory_bytes += len(payload)
+
+        while self._memory_bytes > max_bytes:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.stats.evictions += 1
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= len(entry[1])
+
+    def _clear_disk(self):
+        with self._disk_lock:
+            for path in pathlib.Path(config.response_cache.disk_dir).glob("*.json"):
+                path.unlink(missing_ok=True)
+
+            self._disk_bytes = 0
+
+    def _disk_path(self, key: str):
+        return pathlib.Path(config.response_cache.disk_dir) / f"{key}.json"
+
+    def _read_disk(self, key: str):
+        path = self._disk_path(key)
+
+        try:
+            with self._disk_lock:
+                header, payload = path.read_bytes().split(b"\n", 1)
+                expires = json.loads(header)["expires"]
+
+                if expires is not None and expires < time.time():
+                    self._disk_bytes = None
+                    path.unlink(missing_ok=True)
+                    self.stats.expirations += 1
+                    return None
+
+                # Recently used files are pruned last
+                os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as exc:
+            logger.warning(f"Skipping unreadable response cache entry {path}: {exc}")
+            return None
+
+        return expires, payload
+
+    def _write_disk(self, key: str, expires: Optional[float], payload: bytes):
+        path = self._disk_path(key)
+        header = json.dumps({"expires": expires}).encode()
+
+        try:
+            with self._disk_lock:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                if self._disk_bytes is None:
+                    self._disk_bytes = sum(
+                        entry.stat().st_size for entry in path.parent.glob("*.json")
+                    )
+
+                temp_path = path.with_suffix(".tmp")
+                temp_path.write_bytes(header + b"\n" + payload)
+                replaced_size = path.stat().st_size if path.exists() else 0
+                temp_path.replace(path)
+
+                self._disk_bytes += len(header) + 1 + len(payload) - replaced_size
+                self._prune_disk(path.parent)
+        except OSError as exc:
+            logger.warning(f"Couldn't write the response cache entry {path}: {exc}")
+
+    def _prune_disk(self, disk_dir: pathlib.Path):
+        max_bytes = config.response_cache.max_disk_mb * 1024**2
+        if self._disk_bytes <= max_bytes:
+            return
+
+        entries = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry)
+            for entry in disk_dir.glob("*.json")
+        )
+
+        for _, size, entry in entries:
+            if self._disk_bytes <= max_bytes * DISK_PRUNE_RATIO:
+                break
+
+            entry.unlink(missing_ok=True)
+            self._disk_bytes -= size
+
+
+# Create an instance of the global response cache
+ResponseCache = ResponseCacheClass()
@@ -0,0 +1,159 @@
+"""
+Single-flight coalescing of identical in-flight generations.
+
+Deterministic requests with the same key share one generation job. Its chunks
+are fanned out to every subscriber, and the job is only cancelled once all of
+its subscribers are gone.
+"""
+
+import asyncio
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set
+
+from loguru import logger
+
+from common.response_cache import ResponseCache, is_deterministic
+from config.config import config
+from samplers.sampling import BaseSamplerRequest
+
+# Marks the end of a flight in the subscriber queues
+FLIGHT_END = None
+
+
+class Flight:
+    """A running generation and the queues of its subscribers"""
+
+    def __init__(self):
+        # Chunks so far, replayed to subscribers that attach late
+        self.chunks: List[dict] = []
+        self.subscribers: Set[asyncio.Queue] = set()
+        self.abort_event = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+
+class SingleFlightClass:
+    """Class to manage the in-flight generations global state"""
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+
+    def get_key(self, prompt: str, gen_params: BaseSamplerRequest):
+        """Returns the key to coalesce a request under, if it can be shared."""
+
+        if not config.response_cache.coalesce_requests:
+            return None
+
+        if not is_deterministic(gen_params):
+            return None
+
+        return ResponseCache.make_key(prompt, gen_params)
+
+    async def subscribe(
+        self,
+        key: str,
+        request_id: str,
+        start: Callable[[asyncio.Event], AsyncIterator[dict]],
+        abort_event: Optional[asyncio.Event] = None,
+    ) -> AsyncIterator[dict]:
+        """
+        Yields the chunks of the in-flight generation for a key.
+
+        A new generation is started with start(flight_abort_event) if no
+        generation for the key is running. Setting abort_event or closing
+        the iterator only detaches this subscriber.
+        """
+
+        flight = self._flights.get(key)
+        if flight is None or flight.abort_event.is_set():
+            flight = Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(
+                self._run(key, flight, start(flight.abort_event))
+            )
+        else:
+            logger.info(
+                f"Attaching request {request_id} to an identical in-flight generation"
+            )
+
+        queue = asyncio.Queue()
+        for chunk in flight.chunks:
+            queue.put_nowait(chunk)
+
+        flight.subscribers.add(queue)
+
+        # Wakes the subscriber up if it aborts while waiting for a chunk
+        abort_task = asyncio.create_task(abort_event.wait()) if abort_event else None
+
+        try:
+            while True:
+                chunk = await self._next_chunk(queue, abort_task)
+                if chunk is FLIGHT_END:
+                    break
+
+                # The shared generation failed
+                if isinstance(chunk, Exception):
+                    raise chunk
+
+                yield dict(chunk)
+
+                if abort_event and abort_event.is_set():
+                    break
+        finally:
+            if abort_task:
+                abort_task.cancel()
+
+            flight.subscribers.discard(queue)
+
+            # Nobody is listening anymore, so cancel the job right away
+            # instead of when its next chunk arrives
+            if not flight.subscribers:
+                flight.abort_event.set()
+                flight.task.cancel()
+
+    async def _next_chunk(
+        self, queue: asyncio.Queue, abort_task: Optional[asyncio.Task]
+    ):
+        """Waits for a chunk, or returns FLIGHT_END if the subscriber aborts first."""
+
+        if abort_task is None or not queue.empty():
+            return await queue.get()
+
+        get_task = asyncio.create_task(queue.get())
+        try:
+            await asyncio.wait(
+                (get_task, abort_task), return_when=asyncio.FIRST_COMPLETED
+            )
+        except asyncio.CancelledError:
+            get_task.cancel()
+            raise
+
+        if not get_task.done():
+            get_task.cancel()
+            return FLIGHT_END
+
+        return get_task.result()
+
+    async def _run(self, key: str, flight: Flight, generation: AsyncIterator[dict]):
+        """Runs a generation and fans its chunks out to the subscribers."""
+
+        end = FLIGHT_END
+
+        try:
+            async for chunk in generation:
+                flight.chunks.append(chunk)
+                for queue in flight.subscribers:
+                    queue.put_nowait(chunk)
+
+                if "finish_reason" in chunk:
+                    break
+        except Exception as exc:
+            end = exc
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+            for queue in flight.subscribers:
+                queue.put_nowait(end)
+
+
+# Create an instance of the global in-flight generations
+SingleFlight = SingleFlightClass()
@@ -0,0 +1,493 @@
+"""
+Request tracing with OpenTelemetry compatible spans.
+
+A middleware starts a span for each sampled request, joining the trace of an
+incoming traceparent header. Stages of the request add child spans through a
+context variable. Finished spans are converted to OTLP/JSON by a background
+thread, which appends them to rotating files or posts them to an OTLP/HTTP
+collector.
+
+Outside of a traced request, start_span returns a shared no-op span, so
+instrumented code only pays for a context variable lookup when tracing is
+disabled or a request isn't sampled.
+"""
+
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import pathlib
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager, nullcontext
+from typing import List, Optional
+
+from loguru import logger
+
+from common.capture import RotatingJsonlWriter
+from config.config import config
+
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+# Span kinds and status codes of the OTLP protocol
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_CODE_ERROR = 2
+
+# Spans waiting to be exported. Further spans are dropped.
+MAX_QUEUED_SPANS = 10000
+
+# Spans are exported in batches of up to this size, at least every interval
+MAX_BATCH_SPANS = 512
+EXPORT_INTERVAL = 1.0
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+def otlp_attributes(attributes: dict):
+    """Converts attributes to OTLP key values."""
+
+    key_values = []
+    for key, value in attributes.items():
+        if value is None:
+            continue
+
+        # Check bool first since it's a subclass of int
+        if isinstance(value, bool):
+            otlp_value = {"boolValue": value}
+        elif isinstance(value, int):
+            otlp_value = {"intValue": str(value)}
+        elif isinstance(value, float):
+            otlp_value = {"doubleValue": value}
+        else:
+            otlp_value = {"stringValue": str(value)}
+
+        key_values.append({"key": key, "value": otlp_value})
+
+    return key_values
+
+
+class Span:
+    """A timed operation of a trace"""
+
+    __slots__ = (
+        "name",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "kind",
+        "start_time",
+        "end_time",
+        "attributes",
+        "error",
+        "_token",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str],
+        kind: int = SPAN_KIND_INTERNAL,
+        start_time: Optional[int] = None,
+        attributes: Optional[dict] = None,
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_time = start_time or time.time_ns()
+        self.end_time = None
+        self.attributes = attributes or {}
+        self.error = None
+        self._token = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_error(self, message: str):
+        self.error = message
+
+    @contextmanager
+    def timer(self, attribute: str):
+        """Adds the milliseconds spent in the block to an attribute."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.attributes[attribute] = self.attributes.get(attribute, 0) + elapsed
+
+    def end(self, end_time: Optional[int] = None):
+        if self.end_time is None:
+            self.end_time = end_time or time.time_ns()
+            Tracer.export(self)
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_otlp(self):
+        otlp_span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_time),
+            "endTimeUnixNano": str(self.end_time),
+            "attributes": otlp_attributes(self.attributes),
+        }
+
+        if self.parent_id:
+            otlp_span["parentSpanId"] = self.parent_id
+
+        if self.error:
+            otlp_span["status"] = {"code": STATUS_CODE_ERROR, "message": self.error}
+
+        return otlp_span
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # Generators can be closed from another context
+            pass
+
+        if exc_value is not None and not isinstance(
+            exc_value, (GeneratorExit, asyncio.CancelledError)
+        ):
+            self.set_error(f"{exc_type.__name__}: {exc_value}")
+
+        self.end()
+
+
+class NoopSpan:
+    """Span that records nothing, used when a request isn't traced"""
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def set_error(self, message: str):
+        pass
+
+    def timer(self, attribute: str):
+        return NOOP_CONTEXT
+
+    def end(self, end_time: Optional[int] = None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+NOOP_CONTEXT = nullcontext()
+
+
+def current_span():
+    """Returns the active span, or the no-op span outside of a trace."""
+
+    return _current_span.get() or NOOP_SPAN
+
+
+def start_span(
+    name: str,
+    parent: Optional[Span] = None,
+    start_time: Optional[int] = None,
+    **attributes,
+):
+    """
+    Starts a child of the parent or active span.
+
+    Use it as a context manager to make it the active span, or call end.
+    """
+
+    if parent is None:
+        parent = _current_span.get()
+
+    if parent is None or parent is NOOP_SPAN:
+        return NOOP_SPAN
+
+    return Span(
+        name,
+        parent.trace_id,
+        parent.span_id,
+        start_time=start_time,
+        attributes=attributes,
+    )
+
+
+def record_stages(parent: Span, **durations: Optional[float]):
+    """Adds consecutive child spans from the start of the parent, in seconds."""
+
+    if parent is NOOP_SPAN:
+        return
+
+    start_time = parent.start_time
+    for name, duration in durations.items():
+        end_time = start_time + int((duration or 0) * 1e9)
+        start_span(name, parent, start_time).end(end_time)
+        start_time = end_time
+
+
+async def _traced_stream(span: Span, stream):
+    with span:
+        try:
+            async for item in stream:
+                yield item
+        finally:
+            await stream.aclose()
+
+
+def traced(name: str):
+    """Decorator that runs an async function or generator in a span."""
+
+    def decorator(func):
+        if inspect.isasyncgenfunction(func):
+
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                if _current_span.get() is None:
+                    return func(*args, **kwargs)
+
+                return _traced_stream(start_span(name), func(*args, **kwargs))
+
+            return generator_wrapper
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return await func(*args, **kwargs)
+
+            with start_span(name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def parse_traceparent(headers: List[tuple]):
+    """Returns the trace ID, parent span ID and sampled flag of a request."""
+
+    for key, value in headers:
+        if key == b"traceparent":
+            match = TRACEPARENT_PATTERN.match(value.decode("latin-1").strip())
+            if match and match[1] != "0" * 32 and match[2] != "0" * 16:
+                return match[1], match[2], bool(int(match[3], 16) & 1)
+
+            break
+
+    return None, None, None
+
+
+class OtlpFileExporter:
+    """Appends each batch as an OTLP/JSON line to rotating files"""
+
+    def __init__(self):
+        self.writer = RotatingJsonlWriter(
+            pathlib.Path(config.tracing.trace_dir),
+            config.tracing.max_file_size * 1024**2,
+            config.tracing.max_files,
+            prefix="traces",
+        )
+
+    def export(self, payload: str):
+        self.writer.write(payload)
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+class OtlpHttpExporter:
+    """Posts each batch to an OTLP/HTTP collector"""
+
+    def __init__(self):
+        self.endpoint = config.tracing.otlp_endpoint
+
+    def export(self, payload: str):
+        request = urllib.request.Request(
+            self.endpoint,
+            data=payload.encode("utf8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+
+        with urllib.request.urlopen(request, timeout=10):
+            pass
+
+    def close(self):
+        pass
+
+
+class TracerClass:
+    """Class to manage the tracing global state"""
+
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue(MAX_QUEUED_SPANS)
+        self._thread: Optional[threading.Thread] = None
+        self.dropped = 0
+
+    def start(self):
+        """Starts the exporter thread."""
+
+        if config.tracing.exporter == "otlp":
+            exporter = OtlpHttpExporter()
+            destination = config.tracing.otlp_endpoint
+        else:
+            exporter = OtlpFileExporter()
+            destination = config.tracing.trace_dir
+
+        self._thread = threading.Thread(
+            target=self._export_loop, args=(exporter,), name="tracing", daemon=True
+        )
+        self._thread.start()
+
+        logger.info(f"Exporting traces to {destination}")
+
+    def stop(self):
+        """Exports the queued spans and stops the exporter thread."""
+
+        if not self._thread:
+            return
+
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+        if self.dropped:
+            logger.warning(f"Tracing dropped {self.dropped} spans")
+
+    def should_trace(self, sampled: Optional[bool]):
+        """Follows the caller's sampling decision, or samples a new trace."""
+
+        if self._thread is None:
+            return False
+
+        if sampled is not None:
+            return sampled
+
+        return random.random() < config.tracing.sample_rate
+
+    def export(self, span: Span):
+        """Queues a finished span without blocking the event loop."""
+
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _export_loop(self, exporter):
+        stopping = False
+        while not stopping:
+            spans = []
+            deadline = time.monotonic() + EXPORT_INTERVAL
+
+            while len(spans) < MAX_BATCH_SPANS:
+                try:
+                    span = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+
+                if span is None:
+                    stopping = True
+                    break
+
+                spans.append(span)
+
+            if not spans:
+                continue
+
+            try:
+                exporter.export(json.dumps(self._format(spans)))
+            except Exception as exc:
+                logger.error(f"Couldn't export {len(spans)} spans: {exc}")
+
+        exporter.close()
+
+    def _format(self, spans: List[Span]):
+        resource = {"service.name": config.tracing.service_name}
+
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": otlp_attributes(resource)},
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "almoapi"},
+                            "spans": [span.to_otlp() for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+
+
+Tracer = TracerClass()
+
+
+class TracingMiddleware:
+    """ASGI middleware that starts a span for each sampled request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace_id, parent_id, sampled = parse_traceparent(scope["headers"])
+        if not Tracer.should_trace(sampled):
+            await self.app(scope, receive, send)
+            return
+
+        span = Span(
+            f"{scope['method']} {scope['path']}",
+            trace_id or f"{random.getrandbits(128):032x}",
+            parent_id,
+            kind=SPAN_KIND_SERVER,
+            attributes={
+                "http.request.method": scope["method"],
+                "url.path": scope["path"],
+            },
+        )
+
+        # Return the trace so callers can find it
+        traceparent = span.traceparent().encode("latin-1")
+
+        async def traced_send(message):
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                span.set_attribute("http.response.status_code", status)
+                if status >= 500:
+                    span.set_error(f"HTTP {status}")
+
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"traceparent", traceparent),
+                ]
+
+            await send(message)
+
+        with span:
+            try:
+                await self.app(scope, receive, traced_send)
+            finally:
+                span.set_attribute("request_id", scope.get("state", {}).get("id"))
@@ -0,0 +1,372 @@
+"""
+Usage ledger of tokens and GPU time per API key and model.
+
+Requests only add to totals in memory. A background task writes the totals
+to SQLite or Parquet every flush interval on a worker thread, so accounting
+never does I/O on the request path.
+"""
+
+import asyncio
+import datetime
+import pathlib
+import sqlite3
+import time
+from collections import defaultdict
+from typing import Dict, List, Literal, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from loguru import logger
+from pydantic import BaseModel, Field
+
+from auth import AuthManager
+from auth.rate_limit import RateLimiter
+from auth.utils import get_key_id
+from common.networking import handle_request_error
+from common.optional_dependencies import dependencies
+from common.utils import unwrap
+from config.config import config
+
+if dependencies.fastparquet:
+    import fastparquet
+    import pandas
+
+# Usage is totalled per hour, key and model
+UsageKey = Tuple[int, str, str]
+
+COUNTERS = (
+    "requests",
+    "prompt_tokens",
+    "completion_tokens",
+    "cached_tokens",
+    "gpu_seconds",
+)
+
+GROUP_COLUMNS = {"hour": "hour", "key": "key_id", "model": "model"}
+
+UsageGroup = Literal["hour", "key", "model"]
+
+
+class UsageEntry(BaseModel):
+    """Usage totals of a group"""
+
+    hour: Optional[int] = Field(None, description="Unix time the hour starts at")
+    key_id: Optional[str] = Field(
+        None, description="First 16 hex digits of the SHA-256 of the API key"
+    )
+    model: Optional[str] = Field(None, description="Name of the model")
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = Field(0, description="Prompt tokens reused from the cache")
+    gpu_seconds: float = Field(0.0, description="Time spent on prompts and generation")
+
+
+class UsageReport(BaseModel):
+    object: str = "list"
+    data: List[UsageEntry] = Field(default_factory=list)
+
+
+class SqliteUsageStore:
+    """Ledger rows in a SQLite table, merged on their hour, key and model"""
+
+    def __init__(self, directory: pathlib.Path):
+        self.path = directory / "usage.db"
+
+        with self._connect() as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS usage (
+                    hour INTEGER NOT NULL,
+                    key_id TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    requests INTEGER NOT NULL,
+                    prompt_tokens INTEGER NOT NULL,
+                    completion_tokens INTEGER NOT NULL,
+                    cached_tokens INTEGER NOT NULL,
+                    gpu_seconds REAL NOT NULL,
+                    PRIMARY KEY (hour, key_id, model)
+                )
+                """
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path)
+
+    def write(self, rows: List[tuple]):
+        updates = ", ".join(
+            f"{counter} = {counter} + excluded.{counter}" for counter in COUNTERS
+        )
+
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                f"ON CONFLICT (hour, key_id, model) DO UPDATE SET {updates}",
+                rows,
+            )
+
+    def read(self, start: Optional[int], end: Optional[int]) -> List[tuple]:
+        with self._connect() as connection:
+            return connection.execute(
+                "SELECT * FROM usage WHERE hour >= ? AND hour < ?",
+                (unwrap(start, 0), unwrap(end, 2**62)),
+            ).fetchall()
+
+
+class ParquetUsageStore:
+    """Ledger rows appended to a Parquet file per day"""
+
+    columns = ["hour", "key_id", "model", *COUNTERS]
+
+    def __init__(self, directory: pathlib.Path):
+        self.directory = directory
+
+    def write(self, rows: List[tuple]):
+        frame = pandas.DataFrame(rows, columns=self.columns)
+
+        day = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d")
+        path = self.directory / f"usage-{day}.parquet"
+
+        fastparquet.write(str(path), frame, append=path.exists())
+
+    def read(self, start: Optional[int], end: Optional[int]) -> List[tuple]:
+        rows = []
+
+        for path in sorted(self.directory.glob("usage-*.parquet")):
+            frame = fastparquet.ParquetFile(str(path)).to_pandas()
+
+            if start is not None:
+                frame = frame[frame["hour"] >= start]
+            if end is not None:
+                frame = frame[frame["hour"] < end]
+
+            rows += frame.itertuples(index=False, name=None)
+
+        return rows
+
+
+class UsageLedgerClass:
+    """Class to manage the usage ledger global state"""
+
+    def __init__(self):
+        self._pending: Dict[UsageKey, List[float]] = defaultdict(
+            lambda: [0] * len(COUNTERS)
+        )
+
+        # Rows that are being written, still counted by queries
+        self._flushing: List[tuple] = []
+        self._store = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def load(self):
+        """Opens the store and starts the flush task."""
+
+        storage_dir = pathlib.Path(config.usage.storage_dir)
+        storage_dir.mkdir(parents=True, exist_ok=True)
+
+        if config.usage.backend == "parquet" and not dependencies.fastparquet:
+            logger.error(
+                "The parquet usage backend requires fastparquet. "
+                "Please install it via `pip install fastparquet`. "
+                "Falling back to sqlite."
+            )
+            config.usage.backend = "sqlite"
+
+        if config.usage.backend == "parquet":
+            self._store = ParquetUsageStore(storage_dir)
+        else:
+            self._store = await asyncio.to_thread(SqliteUsageStore, storage_dir)
+
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+        logger.info(f"Recording usage to {storage_dir}")
+
+    async def shutdown(self):
+        """Writes the remaining usage."""
+
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        await self.flush()
+
+    def record(
+        self,
+        key_id: str,
+        model_name: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        cached_tokens: int,
+        gpu_seconds: float,
+    ):
+        """Adds the usage of a request to the in-memory totals."""
+
+        hour = int(time.time()) // 3600 * 3600
+        counters = self._pending[(hour, key_id, model_name)]
+
+        counters[0] += 1
+        counters[1] += prompt_tokens
+        counters[2] += completion_tokens
+        counters[3] += cached_tokens
+        counters[4] += gpu_seconds
+
+    def _pending_rows(self):
+        return [(*key, *counters) for key, counters in self._pending.items()]
+
+    async def flush(self):
+        """Writes the in-memory totals to the store."""
+
+        if not self._pending or self._store is None:
+            return
+
+        self._flushing = self._pending_rows()
+        self._pending.clear()
+
+        try:
+            await asyncio.to_thread(self._store.write, self._flushing)
+        except Exception as exc:
+            # Keep the usage for the next flush
+            logger.error(f"Couldn't write the usage ledger: {exc}")
+            for hour, key_id, model_name, *counters in self._flushing:
+                pending = self._pending[(hour, key_id, model_name)]
+                for index, value in enumerate(counters):
+                    pending[index] += value
+        finally:
+            self._flushing = []
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(config.usage.flush_interval)
+            await self.flush()
+
+    async def query(
+        self,
+        key_id: Optional[str] = None,
+        model_name: Optional[str] = None,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        group_by: Optional[List[UsageGroup]] = None,
+    ):
+        """Totals the usage that matches the filters for each group."""
+
+        group_by = unwrap(group_by, ["key", "model"])
+
+        # Copy the unwritten rows before yielding to the flush task
+        unwritten = self._flushing + self._pending_rows()
+        stored = await asyncio.to_thread(self._store.read, start, end)
+
+        totals: Dict[tuple, List[float]] = defaultdict(lambda: [0] * len(COUNTERS))
+        for hour, row_key_id, row_model, *counters in stored + unwritten:
+            if start is not None and hour < start:
+                continue
+            if end is not None and hour >= end:
+                continue
+            if key_id is not None and row_key_id != key_id:
+                continue
+            if model_name is not None and row_model != model_name:
+                continue
+
+            row = {"hour": hour, "key_id": row_key_id, "model": row_model}
+            group = tuple(row[GROUP_COLUMNS[name]] for name in group_by)
+
+            group_totals = totals[group]
+            for index, value in enumerate(counters):
+                group_totals[index] += value
+
+        entries = []
+        for group, counters in sorted(totals.items()):
+            fields = {
+                GROUP_COLUMNS[name]: value
+                for name, value in zip(group_by, group, strict=True)
+            }
+            fields.update(zip(COUNTERS, counters, strict=True))
+            entries.append(UsageEntry(**fields))
+
+        return UsageReport(data=entries)
+
+
+UsageLedger = UsageLedgerClass()
+
+
+async def record_usage(
+    request: Request,
+    model_name: str,
+    prompt_tokens: int,
+    completion_tokens: int = 0,
+    cached_tokens: int = 0,
+    gpu_seconds: float = 0.0,
+):
+    """Accounts the usage of a finished request to its API key."""
+
+    permission = await AuthManager.get_key_permission(request)
+    await record_key_usage(
+        get_key_id(request),
+        permission,
+        model_name,
+        prompt_tokens,
+        completion_tokens,
+        cached_tokens,
+        gpu_seconds,
+    )
+
+
+async def record_key_usage(
+    key_id: str,
+    permission: str,
+    model_name: str,
+    prompt_tokens: int,
+    completion_tokens: int = 0,
+    cached_tokens: int = 0,
+    gpu_seconds: float = 0.0,
+):
+    """Accounts the usage of a finished request to an API key."""
+
+    if config.usage.enable:
+        UsageLedger.record(
+            key_id,
+            model_name,
+            prompt_tokens,
+            completion_tokens,
+            cached_tokens,
+            gpu_seconds,
+        )
+
+    await RateLimiter.charge(key_id, permission, prompt_tokens, completion_tokens)
+
+
+def generation_usage(generations: List[dict]):
+    """Totals the usage of a request's generations."""
+
+    # Every generation shares the prompt, so it's counted once
+    last = generations[-1]
+    return {
+        "prompt_tokens": unwrap(last.get("prompt_tokens"), 0),
+        "completion_tokens": sum(
+            unwrap(generation.get("generated_tokens"), 0) for generation in generations
+        ),
+        "cached_tokens": unwrap(last.get("cached_tokens"), 0),
+        "gpu_seconds": sum(
+            unwrap(generation.get("prompt_time"), 0)
+            + unwrap(generation.get("generate_time"), 0)
+            for generation in generations
+        ),
+    }
+
+
+async def record_generation_usage(
+    request: Request, model_name: str, generations: List[dict]
+):
+    """Accounts the finished generations of a request."""
+
+    await record_usage(request, model_name, **generation_usage(generations))
+
+
+async def check_usage_ledger():
+    """FastAPI depends that checks if the usage ledger is enabled."""
+
+    if not config.usage.enable:
+        error_message = handle_request_error(
+            "The usage ledger is disabled. Enable it in the usage config.",
+            exc_info=False,
+        ).error.message
+
+        raise HTTPException(400, error_message)
@@ -1,7 +1,7 @@
 """Common utility functions"""
 
 from types import NoneType
-from typing import Dict, Optional, Type, Union, get_args, get_origin, TypeVar
+from typing import Dict, List, Optional, Type, Union, get_args, get_origin, TypeVar
 from pydantic import BaseModel
 
 T = TypeVar("T")
@@ -94,3 +94,60 @@ def unwrap_optional_type(type_hint) -> Type:
 
 def cast_model(model: BaseModel, new: Type[M]) -> M:
     return new(**model.model_dump())
+
+
+# Timings in seconds that the last chunk of a generation reports
+GENERATION_TIMING_KEYS = (
+    "queue_time",
+    "first_token_time",
+    "prompt_time",
+    "generate_time",
+)
+
+
+def join_generations(generations: List[dict]) -> dict:
+    """Joins streamed generation chunks into a single generation."""
+
+    joined_generation = {
+        "text": "",
+        "prompt_tokens": 0,
+        "generation_tokens": 0,
+        "tool_calls": None,
+        "offset": [],
+        "token_probs": {},
+        "logprobs": [],
+    }
+
+    if generations:
+        # Get finish_reason first and then shift where -1 points to
+        if "finish_reason" in generations[-1]:
+            finish_reason_gen = generations[-1]
+            generations = generations[:-1]
+            joined_generation["finish_reason"] = finish_reason_gen.get("finish_reason")
+            joined_generation["stop_str"] = finish_reason_gen.get("stop_str")
+
+            for key in ("cached_tokens", *GENERATION_TIMING_KEYS):
+                if key in finish_reason_gen:
+                    joined_generation[key] = finish_reason_gen[key]
+        else:
+            joined_generation["finish_reason"] = "stop"
+
+    if len(generations) > 0:
+        for generation in generations:
+            joined_generation["text"] += unwrap(generation.get("text"), "")
+            joined_generation["offset"].append(unwrap(generation.get("offset"), -1))
+            joined_generation["token_probs"].update(
+                unwrap(generation.get("token_probs"), {})
+            )
+
+            # Include empty logprob dicts for index preservation
+            joined_generation["logprobs"].append(unwrap(generation.get("logprobs"), {}))
+
+        joined_generation["prompt_tokens"] = unwrap(
+            generations[-1].get("prompt_tokens"), 0
+        )
+        joined_generation["generated_tokens"] = unwrap(
+            generations[-1].get("generated_tokens"), 0
+        )
+
+    return joined_generation
@@ -51,6 +51,24 @@ class RedisAuthProviderConfig(BaseAuthConfig):
         description="Path to SSL CA certificates file for Redis",
     )
     prefix: str = Field("AlmoAPI-", description="Redis key prefix")
+    cache_ttl: int = Field(
+        60,
+        ge=0,
+        description=(
+            "Seconds to cache the permission of a key in memory, 0 to disable"
+        ),
+    )
+    negative_cache_ttl: int = Field(
+        5, ge=0, description="Seconds to cache keys that aren't in Redis"
+    )
+    cache_size: int = Field(10000, gt=0, description="Max keys held in the cache")
+    invalidation_channel: Optional[str] = Field(
+        None,
+        description=(
+            "Redis pub/sub channel to listen on for revoked keys. "
+            "Publish the SHA-512 hash of a key, or * to clear the cache"
+        ),
+    )
 
 
 class AuthProviderConfig(BaseConfigModel):
@@ -70,3 +88,40 @@ class AuthProviderConfig(BaseConfigModel):
         default_factory=NoAuthProviderConfig,
         description="No authentication provider config",
     )
+
+
+class PermissionRateLimits(BaseModel):
+    """Model for the rate limits of a permission level"""
+
+    requests_per_minute: Optional[int] = Field(
+        None, gt=0, description="Requests per minute for each key"
+    )
+    prompt_tokens_per_minute: Optional[int] = Field(
+        None, gt=0, description="Prompt tokens per minute for each key"
+    )
+    generated_tokens_per_minute: Optional[int] = Field(
+        None, gt=0, description="Generated tokens per minute for each key"
+    )
+
+
+class RateLimitConfig(BaseConfigModel):
+    """Rate Limit Config
+    Limits are token buckets per API key, set for each permission level.
+    Unset limits are unlimited"""
+
+    enable: bool = Field(False, description="Enable per-key rate limits")
+    shared: bool = Field(
+        False,
+        description=(
+            "Keep the buckets in the Redis server of the redis auth provider, "
+            "so limits apply across servers"
+        ),
+    )
+    api: PermissionRateLimits = Field(
+        default_factory=PermissionRateLimits,
+        description="Limits for keys with the api permission",
+    )
+    admin: PermissionRateLimits = Field(
+        default_factory=PermissionRateLimits,
+        description="Limits for keys with the admin permission",
+    )
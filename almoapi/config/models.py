@@ -10,7 +10,7 @@ from typing import List, Literal, Optional
 from pathlib import Path
 
 from auth.types import AuthPermission
-from config.auth import AuthProviderConfig
+from config.auth import AuthProviderConfig, RateLimitConfig
 from backends.exllamav2.types import DraftModelInstanceConfig, ModelInstanceConfig
 from config.generics import BaseConfigModel, Metadata
 
@@ -101,6 +101,33 @@ class LoggingConfig(BaseConfigModel):
             "NOTE: Only use this for debugging!"
         ),
     )
+    log_to_file: bool = Field(
+        False,
+        description=(
+            "Write prompts, responses, generation params and metrics "
+            "as JSONL files instead of the console (default: False).\n"
+            "Metrics are still printed to the console."
+        ),
+    )
+    log_dir: Path = Field(
+        "logs",
+        description=("Directory for the generation log files (default: logs)."),
+    )
+    log_max_file_size: int = Field(
+        100,
+        gt=0,
+        description=(
+            "Size in MB after which a new log file is started (default: 100)."
+        ),
+    )
+    log_max_files: int = Field(
+        10,
+        gt=0,
+        description=(
+            "Log files to keep (default: 10).\n"
+            "The oldest file is deleted when a new one is started."
+        ),
+    )
 
 
 class ModelConfig(BaseConfigModel, ModelInstanceConfig):
@@ -206,6 +233,411 @@ class EmbeddingsConfig(BaseConfigModel):
         None,
         description=("An initial embedding model to load on the infinity backend."),
     )
+    embeddings_workers: int = Field(
+        0,
+        ge=0,
+        description=(
+            "Worker processes that host the embedding model (default: 0).\n"
+            "Use 0 to run the model inside the server process.\n"
+            "NOTE: Each worker loads its own copy of the model."
+        ),
+    )
+    embeddings_batch_size: int = Field(
+        1,
+        ge=1,
+        description=(
+            "Max inputs per batch shared across embedding requests (default: 1).\n"
+            "The default sends each request to the model on its own. Set above 1 "
+            "to batch concurrent requests, e.g. 32."
+        ),
+    )
+    embeddings_batch_wait_ms: float = Field(
+        5,
+        ge=0,
+        description=(
+            "Milliseconds to wait for more requests before sending a batch "
+            "(default: 5)."
+        ),
+    )
+    embeddings_chunk_overlap: int = Field(
+        32,
+        ge=0,
+        description=(
+            "Tokens shared by neighbouring chunks when long embedding inputs "
+            "are chunked (default: 32)."
+        ),
+    )
+    embeddings_cache: bool = Field(
+        False,
+        description=(
+            "Cache embeddings by model and input text (default: False).\n"
+            "Only inputs that miss the cache are sent to the model."
+        ),
+    )
+    embeddings_cache_mb: float = Field(
+        256,
+        gt=0,
+        description=("Memory budget of the embedding cache in MB (default: 256)."),
+    )
+    embeddings_cache_dir: Optional[Path] = Field(
+        None,
+        description=(
+            "Directory for the on-disk tier of the embedding cache (default: None).\n"
+            "Disk entries are memory-mapped and survive restarts."
+        ),
+    )
+    embeddings_cache_dtype: Literal["float32", "float16"] = Field(
+        "float32",
+        description=(
+            "Precision of embeddings in the on-disk tier (default: float32).\n"
+            "float16 halves the disk usage at a small precision cost."
+        ),
+    )
+    embeddings_cache_max_disk_mb: float = Field(
+        4096,
+        gt=0,
+        description=(
+            "Size budget of the on-disk tier in MB (default: 4096).\n"
+            "New embeddings are only cached in memory once it's full."
+        ),
+    )
+    reranker_model_name: Optional[str] = Field(
+        None,
+        description=(
+            "An initial reranker (cross-encoder) model to load on the infinity "
+            "backend.\n"
+            "Loaded from embedding_model_dir onto embeddings_device."
+        ),
+    )
+    reranker_batch_size: int = Field(
+        32,
+        ge=1,
+        description=(
+            "Documents per reranker batch (default: 32).\n"
+            "Documents are grouped by length so each batch pads as little as "
+            "possible."
+        ),
+    )
+
+
+class ResponseCacheConfig(BaseConfigModel):
+    """
+    Options for the response cache
+    Only deterministic requests (temperature 0) are cached
+    """
+
+    enable: bool = Field(
+        False,
+        description=(
+            "Cache responses of deterministic requests (default: False).\n"
+            'Clients can bypass the cache with a "Cache-Control: no-cache" '
+            'or "no-store" header.'
+        ),
+    )
+    ttl: int = Field(
+        3600,
+        ge=0,
+        description=(
+            "Seconds before a cached response expires (default: 3600).\n"
+            "Set to 0 to never expire responses."
+        ),
+    )
+    max_memory_mb: float = Field(
+        256,
+        gt=0,
+        description=("Memory budget of the cache in MB (default: 256)."),
+    )
+    disk_dir: Optional[Path] = Field(
+        None,
+        description=(
+            "Directory for the on-disk tier of the cache (default: None).\n"
+            "Disk entries survive restarts and backfill the memory tier."
+        ),
+    )
+    max_disk_mb: float = Field(
+        2048,
+        gt=0,
+        description=("Size budget of the on-disk tier in MB (default: 2048)."),
+    )
+    coalesce_requests: bool = Field(
+        False,
+        description=(
+            "Share one generation between identical deterministic requests "
+            "that are in flight at the same time (default: False).\n"
+            "Works independently of the cache being enabled."
+        ),
+    )
+
+
+class VectorStoreConfig(BaseConfigModel):
+    """
+    Options for the built-in vector store
+    Collections are searched in the same process that embeds the queries
+    """
+
+    enable: bool = Field(
+        False,
+        description=("Enable the vector store endpoints (default: False)."),
+    )
+    persist_dir: Optional[Path] = Field(
+        None,
+        description=(
+            "Directory to save collections to (default: None).\n"
+            "Saved vectors are memory-mapped on startup.\n"
+            "If unset, collections only live in memory."
+        ),
+    )
+    persist_interval: int = Field(
+        60,
+        gt=0,
+        description=(
+            "Seconds between saves of changed collections (default: 60).\n"
+            "Collections are also saved on shutdown."
+        ),
+    )
+    ivf_threshold: int = Field(
+        50000,
+        ge=0,
+        description=(
+            "Vectors before an auto-indexed collection switches from exact "
+            "search to an IVF index (default: 50000)."
+        ),
+    )
+    ivf_nprobe: int = Field(
+        16,
+        gt=0,
+        description=(
+            "Clusters of an IVF index searched per query (default: 16).\n"
+            "Higher values improve recall at the cost of speed."
+        ),
+    )
+
+
+class BatchesConfig(BaseConfigModel):
+    """
+    Options for the offline batch API
+    Batches are read from uploaded JSONL files and run one at a time
+    """
+
+    enable: bool = Field(
+        False,
+        description=(
+            "Enable the /v1/files and /v1/batches endpoints (default: False)."
+        ),
+    )
+    storage_dir: Path = Field(
+        "batches",
+        description=(
+            "Directory for uploaded files, results and batch state "
+            "(default: batches).\n"
+            "Unfinished batches resume from their results after a restart."
+        ),
+    )
+    max_file_size: int = Field(
+        100,
+        gt=0,
+        description=("Largest file that can be uploaded in MB (default: 100)."),
+    )
+    concurrency: Optional[int] = Field(
+        None,
+        gt=0,
+        description=(
+            "Requests of a batch sent to the model at once (default: None).\n"
+            "If unset, this matches the max batch size of the loaded model.\n"
+            "Lower it to leave room for interactive requests."
+        ),
+    )
+    checkpoint_interval: int = Field(
+        10,
+        gt=0,
+        description=(
+            "Seconds between saves of a running batch's progress (default: 10)."
+        ),
+    )
+
+
+class CaptureConfig(BaseConfigModel):
+    """
+    Options for traffic capture
+    Captured requests are written as a workload for benchmark.py
+    """
+
+    enable: bool = Field(
+        False,
+        description=(
+            "Capture generation, embedding and rerank requests (default: False).\n"
+            "Bodies are saved with their arrival time, status, timings and "
+            "output length."
+        ),
+    )
+    capture_dir: Path = Field(
+        "captures",
+        description=("Directory for the capture JSONL files (default: captures)."),
+    )
+    sample_rate: float = Field(
+        1.0,
+        ge=0.0,
+        le=1.0,
+        description=(
+            "Share of requests that are captured (default: 1.0).\n"
+            "Lower this to capture production traffic."
+        ),
+    )
+    max_file_size: int = Field(
+        100,
+        gt=0,
+        description=(
+            "Size in MB after which a new capture file is started (default: 100)."
+        ),
+    )
+    max_files: int = Field(
+        10,
+        gt=0,
+        description=(
+            "Capture files to keep (default: 10).\n"
+            "The oldest file is deleted when a new one is started."
+        ),
+    )
+    redact_pii: bool = Field(
+        True,
+        description=(
+            "Replace emails, phone numbers, card numbers and IP addresses "
+            "in request bodies (default: True).\n"
+            "Also drops the user field of requests."
+        ),
+    )
+    redact_patterns: List[str] = Field(
+        default_factory=list,
+        description=(
+            "Extra regexes to replace in request bodies (default: []).\n"
+            "Applied even if redact_pii is disabled."
+        ),
+    )
+
+
+class UsageConfig(BaseConfigModel):
+    """
+    Options for the usage ledger
+    Token counts and GPU time are totalled per key, model and hour
+    """
+
+    enable: bool = Field(
+        False,
+        description=(
+            "Record the usage of each API key and the /v1/usage endpoint "
+            "(default: False)."
+        ),
+    )
+    backend: Literal["sqlite", "parquet"] = Field(
+        "sqlite",
+        description=(
+            "Storage format of the ledger (default: sqlite).\n"
+            "Parquet writes a file per day and requires fastparquet."
+        ),
+    )
+    storage_dir: Path = Field(
+        "usage",
+        description=("Directory for the ledger files (default: usage)."),
+    )
+    flush_interval: int = Field(
+        60,
+        gt=0,
+        description=(
+            "Seconds between writes of the totals to disk (default: 60).\n"
+            "Usage that isn't written yet is still included in queries."
+        ),
+    )
+
+
+class TracingConfig(BaseConfigModel):
+    """
+    Options for request tracing
+    Spans are exported as OTLP/JSON and join the trace of a traceparent header
+    """
+
+    enable: bool = Field(
+        False,
+        description=(
+            "Trace the stages of requests (default: False).\n"
+            "Responses of traced requests have a traceparent header."
+        ),
+    )
+    sample_rate: float = Field(
+        1.0,
+        ge=0.0,
+        le=1.0,
+        description=(
+            "Share of requests without a traceparent that are traced "
+            "(default: 1.0).\n"
+            "Requests with a traceparent follow its sampled flag."
+        ),
+    )
+    exporter: Literal["file", "otlp"] = Field(
+        "file",
+        description=(
+            "Where spans are exported (default: file).\n"
+            "file appends to rotating JSONL files, otlp posts to a collector."
+        ),
+    )
+    trace_dir: Path = Field(
+        "traces",
+        description=("Directory for the trace files (default: traces)."),
+    )
+    max_file_size: int = Field(
+        100,
+        gt=0,
+        description=(
+            "Size in MB after which a new trace file is started (default: 100)."
+        ),
+    )
+    max_files: int = Field(
+        10,
+        gt=0,
+        description=("Trace files to keep (default: 10)."),
+    )
+    otlp_endpoint: str = Field(
+        "http://localhost:4318/v1/traces",
+        description=(
+            "OTLP/HTTP traces endpoint of the collector "
+            "(default: http://localhost:4318/v1/traces)."
+        ),
+    )
+    service_name: str = Field(
+        "almoapi",
+        description=("Service name of the exported spans (default: almoapi)."),
+    )
+
+
+class LoopMonitorConfig(BaseConfigModel):
+    """
+    Options for the event loop monitor
+    Lag is served at /v1/loop/stats and stalls are logged with their stack
+    """
+
+    enable: bool = Field(
+        False,
+        description=(
+            "Measure the scheduling delay of the event loop (default: False)."
+        ),
+    )
+    interval: int = Field(
+        100,
+        gt=0,
+        description=("Milliseconds between lag measurements (default: 100)."),
+    )
+    stall_threshold: int = Field(
+        250,
+        gt=0,
+        description=(
+            "Milliseconds the loop can be blocked before its stack is captured "
+            "(default: 250)."
+        ),
+    )
+    max_stalls: int = Field(
+        20,
+        gt=0,
+        description=("Recent stalls kept for the stats endpoint (default: 20)."),
+    )
 
 
 class DeveloperConfig(BaseConfigModel):
@@ -245,10 +677,20 @@ class TabbyConfigModel(BaseModel):
     draft_model: DraftModelConfig = Field(default_factory=DraftModelConfig)
     lora: LoraConfig = Field(default_factory=LoraConfig)
     embeddings: EmbeddingsConfig = Field(default_factory=EmbeddingsConfig)
+    response_cache: ResponseCacheConfig = Field(default_factory=ResponseCacheConfig)
+    vector_store: VectorStoreConfig = Field(default_factory=VectorStoreConfig)
+    batches: BatchesConfig = Field(default_factory=BatchesConfig)
+    capture: CaptureConfig = Field(default_factory=CaptureConfig)
+    usage: UsageConfig = Field(default_factory=UsageConfig)
+    tracing: TracingConfig = Field(default_factory=TracingConfig)
+    loop_monitor: LoopMonitorConfig = Field(default_factory=LoopMonitorConfig)
     developer: DeveloperConfig = Field(default_factory=DeveloperConfig)
     actions: UtilityActions = Field(default_factory=UtilityActions)
     auth: AuthProviderConfig = Field(
         default_factory=AuthProviderConfig, description="The auth provider config"
     )
+    rate_limits: RateLimitConfig = Field(
+        default_factory=RateLimitConfig, description="Per-key rate limits"
+    )
 
     model_config = ConfigDict(validate_assignment=True, protected_namespaces=())
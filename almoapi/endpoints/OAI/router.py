@@ -1,19 +1,45 @@
 import asyncio
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import FileResponse, JSONResponse
 from sse_starlette import EventSourceResponse
+from starlette.datastructures import UploadFile
 from sys import maxsize
+from typing import Optional
 
 from common import model
 from auth import check_api_key
-from common.model import check_embeddings_container, check_model_container
+from auth.rate_limit import check_rate_limit
+from auth.utils import get_key_id
+from common.batches import (
+    Batches,
+    Files,
+    check_batches,
+    get_owner,
+    get_owner_scope,
+)
+from common.model import (
+    check_embeddings_container,
+    check_model_container,
+    check_rerank_container,
+)
 from common.networking import handle_request_error, run_with_request_disconnect
+from common.tracing import start_span
 from config.config import config
+from endpoints.OAI.types.batch import (
+    BatchCreateRequest,
+    BatchList,
+    BatchObject,
+    FileDeleteResponse,
+    FileList,
+    FileObject,
+)
 from endpoints.OAI.types.completion import CompletionRequest, CompletionResponse
 from endpoints.OAI.types.chat_completion import (
     ChatCompletionRequest,
     ChatCompletionResponse,
 )
 from endpoints.OAI.types.embedding import EmbeddingsRequest, EmbeddingsResponse
+from endpoints.OAI.types.rerank import RerankRequest, RerankResponse
 from endpoints.OAI.utils.chat_completion import (
     format_prompt_with_template,
     generate_chat_completion,
@@ -25,6 +51,7 @@ from endpoints.OAI.utils.completion import (
     stream_generate_completion,
 )
 from endpoints.OAI.utils.embeddings import get_embeddings
+from endpoints.OAI.utils.rerank import get_rerank
 from endpoints.core.types.tags import Tags
 
 
@@ -35,6 +62,9 @@ urls = {
     "Chat completions": "http://{host}:{port}/v1/chat/completions",
 }
 
+# Room for the multipart headers and form fields around an uploaded file
+FORM_OVERHEAD = 64 * 1024
+
 
 def setup():
     return router
@@ -42,7 +72,9 @@ def setup():
 
 # Completions endpoint
 @router.post(
-    "/v1/completions", dependencies=[Depends(check_api_key)], tags=[Tags.OpenAI]
+    "/v1/completions",
+    dependencies=[Depends(check_api_key), Depends(check_rate_limit)],
+    tags=[Tags.OpenAI],
 )
 async def completion_request(
     request: Request, data: CompletionRequest
@@ -53,17 +85,20 @@ async def completion_request(
     If stream = true, this returns an SSE stream.
     """
 
-    if data.model:
-        inline_load_task = asyncio.create_task(load_inline_model(data.model, request))
+    with start_span("model_check", model=data.model):
+        if data.model:
+            inline_load_task = asyncio.create_task(
+                load_inline_model(data.model, request)
+            )
 
-        await run_with_request_disconnect(
-            request,
-            inline_load_task,
-            disconnect_message=f"Model switch for generation {request.state.id} "
-            + "cancelled by user.",
-        )
-    else:
-        await check_model_container()
+            await run_with_request_disconnect(
+                request,
+                inline_load_task,
+                disconnect_message=f"Model switch for generation {request.state.id} "
+                + "cancelled by user.",
+            )
+        else:
+            await check_model_container()
 
     model_path = model.container.model_dir
 
@@ -94,7 +129,9 @@ async def completion_request(
 
 # Chat completions endpoint
 @router.post(
-    "/v1/chat/completions", dependencies=[Depends(check_api_key)], tags=[Tags.OpenAI]
+    "/v1/chat/completions",
+    dependencies=[Depends(check_api_key), Depends(check_rate_limit)],
+    tags=[Tags.OpenAI],
 )
 async def chat_completion_request(
     request: Request, data: ChatCompletionRequest
@@ -106,10 +143,11 @@ async def chat_completion_request(
     """
 
     # check if model is loaded or not
-    if data.model:
-        await load_inline_model(data.model, request)
-    else:
-        await check_model_container()
+    with start_span("model_check", model=data.model):
+        if data.model:
+            await load_inline_model(data.model, request)
+        else:
+            await check_model_container()
 
     # check if prompt template is set
     if model.container.prompt_template is None:
@@ -155,10 +193,17 @@ async def chat_completion_request(
 # Embeddings endpoint
 @router.post(
     "/v1/embeddings",
-    dependencies=[Depends(check_api_key), Depends(check_embeddings_container)],
+    dependencies=[
+        Depends(check_api_key),
+        Depends(check_rate_limit),
+        Depends(check_embeddings_container),
+    ],
     tags=[Tags.OpenAI],
+    # The response JSON is written directly, so only document its model
+    response_model=EmbeddingsResponse,
+    response_class=JSONResponse,
 )
-async def embeddings(request: Request, data: EmbeddingsRequest) -> EmbeddingsResponse:
+async def embeddings(request: Request, data: EmbeddingsRequest) -> Response:
     """Generate Text embeddings for a given text input.
 
     Requires Infinity embed to be installed and an embedding model to be loaded.
@@ -171,3 +216,198 @@ async def embeddings(request: Request, data: EmbeddingsRequest) -> EmbeddingsRes
     )
 
     return response
+
+
+# Rerank endpoint
+@router.post(
+    "/v1/rerank",
+    dependencies=[
+        Depends(check_api_key),
+        Depends(check_rate_limit),
+        Depends(check_rerank_container),
+    ],
+    tags=[Tags.OpenAI],
+)
+async def rerank(request: Request, data: RerankRequest) -> RerankResponse:
+    """Scores documents by relevance to a query with a cross-encoder.
+
+    Requires Infinity embed to be installed and a reranker model to be loaded.
+    """
+    rerank_task = asyncio.create_task(get_rerank(data, request))
+    response = await run_with_request_disconnect(
+        request,
+        rerank_task,
+        f"Rerank request {request.state.id} cancelled by user.",
+    )
+
+    return response
+
+
+# Files endpoints
+@router.post(
+    "/v1/files",
+    dependencies=[Depends(check_api_key), Depends(check_batches)],
+    tags=[Tags.OpenAI],
+)
+async def upload_file(request: Request) -> FileObject:
+    """Uploads a JSONL file of batch requests as multipart form data."""
+
+    max_bytes = config.batches.max_file_size * 1024**2
+    too_large_message = f"Files can't be larger than {config.batches.max_file_size} MB."
+
+    # Reject oversized uploads before the form is spooled to disk
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > max_bytes + FORM_OVERHEAD:
+        error_message = handle_request_error(
+            too_large_message,
+            exc_info=False,
+        ).error.message
+
+        raise HTTPException(413, error_message)
+
+    form = await request.form()
+    upload = form.get("file")
+    purpose = form.get("purpose")
+
+    if not isinstance(upload, UploadFile):
+        error_message = handle_request_error(
+            "A file is required.",
+            exc_info=False,
+        ).error.message
+
+        raise HTTPException(400, error_message)
+
+    if purpose != "batch":
+        error_message = handle_request_error(
+            "Only files with the batch purpose can be uploaded.",
+            exc_info=False,
+        ).error.message
+
+        raise HTTPException(400, error_message)
+
+    try:
+        if upload.size is not None and upload.size > max_bytes:
+            error_message = handle_request_error(
+                too_large_message,
+                exc_info=False,
+            ).error.message
+
+            raise HTTPException(413, error_message)
+
+        return await Files.create(
+            upload.file,
+            upload.filename or "upload",
+            purpose,
+            get_key_id(request),
+        )
+    finally:
+        await form.close()
+
+
+@router.get(
+    "/v1/files",
+    dependencies=[Depends(check_api_key), Depends(check_batches)],
+    tags=[Tags.OpenAI],
+)
+async def list_files(request: Request) -> FileList:
+    """Lists uploaded files and batch results."""
+
+    return FileList(data=Files.list(await get_owner_scope(request)))
+
+
+@router.get(
+    "/v1/files/{file_id}",
+    dependencies=[Depends(check_api_key), Depends(check_batches)],
+    tags=[Tags.OpenAI],
+)
+async def get_file(request: Request, file_id: str) -> FileObject:
+    """Returns the metadata of a file."""
+
+    return Files.get(file_id, await get_owner_scope(request))
+
+
+@router.get(
+    "/v1/files/{file_id}/content",
+    dependencies=[Depends(check_api_key), Depends(check_batches)],
+    tags=[Tags.OpenAI],
+)
+async def get_file_content(request: Request, file_id: str):
+    """Downloads the contents of a file."""
+
+    file = Files.get(file_id, await get_owner_scope(request))
+    return FileResponse(
+        Files.path(file_id), media_type="application/jsonl", filename=file.filename
+    )
+
+
+@router.delete(
+    "/v1/files/{file_id}",
+    dependencies=[Depends(check_api_key), Depends(check_batches)],
+    tags=[Tags.OpenAI],
+)
+async def delete_file(request: Request, file_id: str) -> FileDeleteResponse:
+    """Deletes a file."""
+
+    await Files.delete(file_id, await get_owner_scope(request))
+    return FileDeleteResponse(id=file_id)
+
+
+# Batches endpoints
+@router.post(
+    "/v1/batches",
+    dependencies=[
+        Depends(check_api_key),
+        Depends(check_rate_limit),
+        Depends(check_batches),
+    ],
+    tags=[Tags.OpenAI],
+)
+async def create_batch(request: Request, data: BatchCreateRequest) -> BatchObject:
+    """
+    Queues the requests of an uploaded JSONL file.
+
+    Batches run in the background, one at a time.
+    """
+
+    return Batches.create(data, *await get_owner(request))
+
+
+@router.get(
+    "/v1/batches",
+    dependencies=[Depends(check_api_key), Depends(check_batches)],
+    tags=[Tags.OpenAI],
+)
+async def list_batches(
+    request: Request, after: Optional[str] = None, limit: int = 20
+) -> BatchList:
+    """Lists batches from newest to oldest."""
+
+    batches, has_more = Batches.list(after, limit, await get_owner_scope(request))
+    return BatchList(
+        data=batches,
+        first_id=batches[0].id if batches else None,
+        last_id=batches[-1].id if batches else None,
+        has_more=has_more,
+    )
+
+
+@router.get(
+    "/v1/batches/{batch_id}",
+    dependencies=[Depends(check_api_key), Depends(check_batches)],
+    tags=[Tags.OpenAI],
+)
+async def get_batch(request: Request, batch_id: str) -> BatchObject:
+    """Returns the status of a batch."""
+
+    return Batches.get(batch_id, await get_owner_scope(request))
+
+
+@router.post(
+    "/v1/batches/{batch_id}/cancel",
+    dependencies=[Depends(check_api_key), Depends(check_batches)],
+    tags=[Tags.OpenAI],
+)
+async def cancel_batch(request: Request, batch_id: str) -> BatchObject:
+    """Cancels a batch. Results that already finished are kept."""
+
+    return Batches.cancel(batch_id, await get_owner_scope(request))
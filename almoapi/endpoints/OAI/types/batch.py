@@ -0,0 +1,116 @@
+from typing import Dict, List, Literal, Optional
+
+from pydantic import BaseModel, Field
+
+BatchEndpoint = Literal["/v1/completions", "/v1/chat/completions", "/v1/embeddings"]
+
+BatchStatus = Literal[
+    "validating",
+    "failed",
+    "in_progress",
+    "finalizing",
+    "completed",
+    "expired",
+    "cancelling",
+    "cancelled",
+]
+
+
+class FileObject(BaseModel):
+    id: str = Field(..., description="ID of the file.")
+    object: str = Field("file", description="Type of the object.")
+    bytes: int = Field(..., description="Size of the file in bytes.")
+    created_at: int = Field(..., description="Unix time the file was created.")
+    filename: str = Field(..., description="Name of the uploaded file.")
+    purpose: str = Field(
+        ..., description="Use of the file: batch, batch_output or batch_error."
+    )
+    owner: Optional[str] = Field(
+        None, description="Key ID of the API key that created the file."
+    )
+
+
+class FileList(BaseModel):
+    object: str = Field("list", description="Type of the response object.")
+    data: List[FileObject] = Field(default_factory=list)
+
+
+class FileDeleteResponse(BaseModel):
+    id: str = Field(..., description="ID of the deleted file.")
+    object: str = Field("file", description="Type of the object.")
+    deleted: bool = Field(True, description="Whether the file was deleted.")
+
+
+class BatchCreateRequest(BaseModel):
+    input_file_id: str = Field(..., description="ID of an uploaded JSONL file.")
+    endpoint: BatchEndpoint = Field(
+        ..., description="Endpoint that every request of the batch targets."
+    )
+    completion_window: Literal["24h"] = Field(
+        "24h", description="Time after which unfinished requests expire."
+    )
+    metadata: Optional[Dict[str, str]] = Field(
+        None, description="Key-value pairs stored with the batch."
+    )
+
+
+class BatchRequestCounts(BaseModel):
+    total: int = Field(0, description="Requests in the input file.")
+    completed: int = Field(0, description="Requests that succeeded.")
+    failed: int = Field(0, description="Requests that failed.")
+
+
+class BatchError(BaseModel):
+    code: str = Field(..., description="Type of the error.")
+    message: str = Field(..., description="Description of the error.")
+    line: Optional[int] = Field(
+        None, description="Line of the input file that caused the error."
+    )
+
+
+class BatchErrors(BaseModel):
+    object: str = Field("list", description="Type of the object.")
+    data: List[BatchError] = Field(default_factory=list)
+
+
+class BatchObject(BaseModel):
+    id: str = Field(..., description="ID of the batch.")
+    object: str = Field("batch", description="Type of the object.")
+    endpoint: BatchEndpoint
+    errors: Optional[BatchErrors] = Field(
+        None, description="Errors that failed the whole batch."
+    )
+    input_file_id: str
+    completion_window: str
+    status: BatchStatus = "validating"
+    output_file_id: Optional[str] = Field(
+        None, description="ID of the file with successful responses."
+    )
+    error_file_id: Optional[str] = Field(
+        None, description="ID of the file with failed requests."
+    )
+    created_at: int
+    in_progress_at: Optional[int] = None
+    expires_at: Optional[int] = None
+    finalizing_at: Optional[int] = None
+    completed_at: Optional[int] = None
+    failed_at: Optional[int] = None
+    expired_at: Optional[int] = None
+    cancelling_at: Optional[int] = None
+    cancelled_at: Optional[int] = None
+    request_counts: BatchRequestCounts = Field(default_factory=BatchRequestCounts)
+    metadata: Optional[Dict[str, str]] = None
+    owner: Optional[str] = Field(
+        None, description="Key ID of the API key that created the batch."
+    )
+    owner_permission: Optional[str] = Field(
+        None, description="Permission of the API key that created the batch."
+    )
+
+
+class BatchList(BaseModel):
+    object: str = Field("list", description="Type of the response object.")
+    data: List[BatchObject] = Field(default_factory=list)
+    first_id: Optional[str] = None
+    last_id: Optional[str] = None
+    has_more: bool = False
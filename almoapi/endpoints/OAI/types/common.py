@@ -6,6 +6,25 @@ from typing import Optional
 from samplers.sampling import BaseSamplerRequest
 
 
+class UsageTimings(BaseModel):
+    """Represents the server-side timings of a generation."""
+
+    queue_ms: float = Field(description="Time waiting for the generator")
+    prefill_ms: float = Field(description="Time processing the new prompt tokens")
+    cached_tokens: int = Field(description="Prompt tokens reused from the cache")
+    decode_ms: float = Field(description="Time generating tokens")
+    tokens_per_second: Optional[float] = Field(
+        None, description="Generated tokens per second of decoding"
+    )
+    time_to_first_token_ms: Optional[float] = Field(
+        None,
+        description=(
+            "Time from the start of the generation to its first token, "
+            "including the queue and prefill"
+        ),
+    )
+
+
 class UsageStats(BaseModel):
     """Represents usage stats."""
 
@@ -13,6 +32,9 @@ class UsageStats(BaseModel):
     completion_tokens: int
     total_tokens: int
 
+    # Missing for responses replayed from the cache
+    timings: Optional[UsageTimings] = None
+
 
 class CompletionResponseFormat(BaseModel):
     type: str = "text"
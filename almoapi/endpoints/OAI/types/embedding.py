@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import List, Literal, Optional, Union
 
 from pydantic import BaseModel, Field
 
@@ -7,16 +7,49 @@ class UsageInfo(BaseModel):
     prompt_tokens: int = 0
     total_tokens: int = 0
     completion_tokens: Optional[int] = 0
+    cached_inputs: Optional[int] = Field(
+        None, description="Inputs served from the embedding cache."
+    )
+    cache_hit_rate: Optional[float] = Field(
+        None, description="Share of inputs served from the embedding cache."
+    )
+    cache_bytes_saved: Optional[int] = Field(
+        None, description="Bytes of input text that skipped the embedding model."
+    )
 
 
 class EmbeddingsRequest(BaseModel):
     input: List[str] = Field(
         ..., description="List of input texts to generate embeddings for."
     )
-    encoding_format: str = Field(
+    encoding_format: Literal["float", "base64", "float16", "int8", "binary"] = Field(
         "float",
         description="Encoding format for the embeddings. "
-        "Can be 'float' or 'base64'.",
+        "Can be 'float' or 'base64'. "
+        "'float16', 'int8' and 'binary' return base64 of packed vectors, "
+        "with int8 scaled per vector and binary packed as one sign bit "
+        "per dimension. int8 vectors are direction-only: their scales are not "
+        "returned, so they suit cosine similarity but not magnitudes.",
+    )
+    dimensions: Optional[int] = Field(
+        None,
+        gt=0,
+        description="Number of dimensions to truncate the embeddings to. "
+        "Truncated vectors are normalized again, which suits models "
+        "trained with Matryoshka representation learning.",
+    )
+    chunk_pooling: Optional[Literal["mean", "max", "first", "none"]] = Field(
+        None,
+        description="Splits inputs longer than the model's max length into "
+        "overlapping chunks instead of truncating them. The chunk embeddings "
+        "are pooled into one vector per input, or returned per chunk "
+        "with 'none'.",
+    )
+    chunk_overlap: Optional[int] = Field(
+        None,
+        ge=0,
+        description="Tokens shared by neighbouring chunks. "
+        "Defaults to the server's embeddings_chunk_overlap.",
     )
     model: Optional[str] = Field(
         None,
@@ -27,11 +60,14 @@ class EmbeddingsRequest(BaseModel):
 
 class EmbeddingObject(BaseModel):
     object: str = Field("embedding", description="Type of the object.")
-    embedding: List[float] = Field(
-        ..., description="Embedding values as a list of floats."
+    embedding: Union[List[float], str] = Field(
+        ..., description="Embedding values as a list of floats or base64."
     )
     index: int = Field(
-        ..., description="Index of the input text corresponding to " "the embedding."
+        ..., description="Index of the input text corresponding to the embedding."
+    )
+    chunk: Optional[int] = Field(
+        None, description="Index of the chunk if chunk_pooling is 'none'."
     )
 
 
@@ -0,0 +1,43 @@
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+from endpoints.OAI.types.embedding import UsageInfo
+
+
+class RerankRequest(BaseModel):
+    query: str = Field(..., description="Query to score the documents against.")
+    documents: List[str] = Field(..., description="List of documents to rerank.")
+    top_n: Optional[int] = Field(
+        None,
+        gt=0,
+        description="Number of best documents to return. "
+        "If not provided, all documents are returned.",
+    )
+    return_documents: bool = Field(
+        False, description="Include the text of each document in the results."
+    )
+    model: Optional[str] = Field(
+        None,
+        description="Name of the reranker model to use. "
+        "If not provided, the loaded model will be used.",
+    )
+
+
+class RerankResult(BaseModel):
+    index: int = Field(..., description="Index of the document in the request.")
+    relevance_score: float = Field(
+        ..., description="Relevance of the document to the query."
+    )
+    document: Optional[str] = Field(
+        None, description="Text of the document if return_documents is set."
+    )
+
+
+class RerankResponse(BaseModel):
+    object: str = Field("rerank", description="Type of the response object.")
+    results: List[RerankResult] = Field(
+        ..., description="Results sorted by relevance, best first."
+    )
+    model: str = Field(..., description="Name of the reranker model used.")
+    usage: UsageInfo = Field(..., description="Information about token usage.")
@@ -0,0 +1,127 @@
+"""Runs the requests of offline batches outside of an HTTP request."""
+
+import asyncio
+from typing import Optional, Union
+
+from fastapi import HTTPException
+
+from common import model
+from common.model import check_embeddings_container, check_model_container
+from common.networking import handle_request_error
+from common.usage import generation_usage, record_key_usage
+from endpoints.OAI.types.chat_completion import ChatCompletionRequest
+from endpoints.OAI.types.completion import CompletionRequest
+from endpoints.OAI.types.embedding import EmbeddingsRequest
+from endpoints.OAI.utils.chat_completion import (
+    _create_response as create_chat_completion_response,
+    format_prompt_with_template,
+)
+from endpoints.OAI.utils.completion import (
+    _create_response as create_completion_response,
+)
+from endpoints.OAI.utils.embeddings import generate_embeddings_body
+
+BatchRequest = Union[CompletionRequest, ChatCompletionRequest, EmbeddingsRequest]
+
+BATCH_REQUEST_TYPES = {
+    "/v1/completions": CompletionRequest,
+    "/v1/chat/completions": ChatCompletionRequest,
+    "/v1/embeddings": EmbeddingsRequest,
+}
+
+
+def parse_batch_request(endpoint: str, body: dict) -> BatchRequest:
+    """Validates the body of a batch request for its endpoint."""
+
+    return BATCH_REQUEST_TYPES[endpoint].model_validate(body)
+
+
+async def get_batch_prompt(data: BatchRequest) -> str:
+    """
+    Renders the prompt of a generation request.
+    Embedding requests are keyed by their first input instead.
+    """
+
+    if isinstance(data, EmbeddingsRequest):
+        return data.input[0] if data.input else ""
+
+    await check_model_container()
+
+    if isinstance(data, CompletionRequest):
+        if isinstance(data.prompt, list):
+            data.prompt = "\n".join(data.prompt)
+
+        return data.prompt
+
+    if model.container.prompt_template is None:
+        error_message = handle_request_error(
+            "Chat completions are disabled because a prompt template is not set.",
+            exc_info=False,
+        ).error.message
+
+        raise HTTPException(422, error_message)
+
+    if isinstance(data.messages, str):
+        return data.messages
+
+    return await format_prompt_with_template(data)
+
+
+async def run_batch_request(
+    data: BatchRequest,
+    prompt: str,
+    request_id: str,
+    abort_event: Optional[asyncio.Event] = None,
+    key_id: Optional[str] = None,
+    permission: Optional[str] = None,
+) -> str:
+    """
+    Runs one request of a batch and returns its response JSON.
+
+    Its usage is accounted to the key that submitted the batch.
+    """
+
+    if isinstance(data, EmbeddingsRequest):
+        await check_embeddings_container()
+        body, usage_info = await generate_embeddings_body(data)
+
+        if key_id:
+            await record_key_usage(
+                key_id,
+                permission,
+                model.embeddings_container.model_dir.name,
+                usage_info.prompt_tokens,
+            )
+
+        return body
+
+    await check_model_container()
+
+    # Set an empty JSON schema if the request wants a JSON response
+    if data.response_format.type == "json":
+        data.json_schema = {"type": "object"}
+
+    generations = await asyncio.gather(
+        *[
+            model.container.generate(
+                prompt=prompt,
+                request_id=request_id,
+                gen_params=data.model_copy(deep=True),
+                abort_event=abort_event,
+            )
+            for _ in range(data.n)
+        ]
+    )
+
+    model_name = model.container.model_dir.name
+    if isinstance(data, ChatCompletionRequest):
+        response = create_chat_completion_response(request_id, generations, model_name)
+    else:
+        response = create_completion_response(request_id, generations, model_name)
+
+    if key_id:
+        await record_key_usage(
+            key_id, permission, model_name, **generation_usage(generations)
+        )
+
+    return response.model_dump_json()
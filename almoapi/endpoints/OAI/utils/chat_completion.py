@@ -3,7 +3,7 @@
 import asyncio
 import pathlib
 from asyncio import CancelledError
-from typing import List, Optional
+from typing import Dict, List, Optional
 import json
 
 from fastapi import HTTPException, Request
@@ -17,6 +17,9 @@ from common.networking import (
     handle_request_error,
     request_disconnect_loop,
 )
+from common.response_cache import ResponseCache
+from common.tracing import current_span, start_span, traced
+from common.usage import record_generation_usage
 from common.utils import unwrap
 from endpoints.OAI.types.chat_completion import (
     ChatCompletionLogprobs,
@@ -29,7 +32,11 @@ from endpoints.OAI.types.chat_completion import (
     ChatCompletionStreamChoice,
 )
 from endpoints.OAI.types.common import UsageStats
-from endpoints.OAI.utils.completion import _stream_collector
+from endpoints.OAI.utils.completion import (
+    _create_timings,
+    _generate,
+    _stream_collector,
+)
 from endpoints.OAI.types.tools import ToolCall
 
 
@@ -92,6 +99,7 @@ def _create_response(
             prompt_tokens=prompt_tokens,
             completion_tokens=completion_tokens,
             total_tokens=prompt_tokens + completion_tokens,
+            timings=_create_timings(generations[-1]),
         ),
     )
 
@@ -118,6 +126,7 @@ def _create_stream_chunk(
             prompt_tokens=prompt_tokens,
             completion_tokens=completion_tokens,
             total_tokens=prompt_tokens + completion_tokens,
+            timings=_create_timings(generation),
         )
     elif "finish_reason" in generation:
         choice = ChatCompletionStreamChoice(
@@ -199,6 +208,7 @@ async def _append_template_metadata(data: ChatCompletionRequest):
         data.stop.extend(template_metadata.tool_starts)
 
 
+@traced("template")
 async def format_prompt_with_template(
     data: ChatCompletionRequest, tool_precursor: Optional[str] = None
 ):
@@ -266,18 +276,28 @@ async def format_prompt_with_template(
         raise HTTPException(400, error_message) from exc
 
 
+@traced("stream_chat_completion")
 async def stream_generate_chat_completion(
     prompt: str, data: ChatCompletionRequest, request: Request, model_path: pathlib.Path
 ):
     """Generator for the generation process."""
+    stream_span = current_span()
     abort_event = asyncio.Event()
     gen_queue = asyncio.Queue()
     gen_tasks: List[asyncio.Task] = []
     disconnect_task = asyncio.create_task(request_disconnect_loop(request))
 
+    # Latest chunk of each choice. Usage is recorded from these once the
+    # stream ends, so streams that are cut short are still accounted.
+    latest_generations: Dict[int, dict] = {}
+
     try:
         logger.info(f"Received chat completion streaming request {request.state.id}")
 
+        cache_key, cached_chunks = await ResponseCache.lookup(request, prompt, data)
+        if cached_chunks is not None:
+            logger.info(f"Replaying chat completion {request.state.id} from the cache")
+
         for n in range(0, data.n):
             task_gen_params = data.model_copy(deep=True)
 
@@ -291,6 +311,8 @@ async def stream_generate_chat_completion(
                     request.state.id,
                     abort_event,
                     gen_params=task_gen_params,
+                    cache_key=cache_key,
+                    cached_chunks=cached_chunks,
                 )
             )
 
@@ -326,12 +348,17 @@ async def stream_generate_chat_completion(
             if isinstance(generation, Exception):
                 raise generation
 
-            response = _create_stream_chunk(
-                request_id=request.state.id,
-                generation=generation,
-                model_name=model_path.name,
-            )
-            yield response.model_dump_json()
+            latest_generations[generation["index"]] = generation
+
+            with stream_span.timer("serialize_ms"):
+                response = _create_stream_chunk(
+                    request_id=request.state.id,
+                    generation=generation,
+                    model_name=model_path.name,
+                )
+                chunk = response.model_dump_json()
+
+            yield chunk
 
             # Check if all tasks are completed
             if all(task.done() for task in gen_tasks) and gen_queue.empty():
@@ -361,21 +388,33 @@ async def stream_generate_chat_completion(
         yield get_generator_error(
             "Chat completion aborted. Please check the server console."
         )
+    finally:
+        if latest_generations:
+            await record_generation_usage(
+                request, model_path.name, list(latest_generations.values())
+            )
 
 
+@traced("chat_completion")
 async def generate_chat_completion(
     prompt: str, data: ChatCompletionRequest, request: Request, model_path: pathlib.Path
 ):
     gen_tasks: List[asyncio.Task] = []
 
     try:
+        cache_key, cached_chunks = await ResponseCache.lookup(request, prompt, data)
+        if cached_chunks is not None:
+            logger.info(f"Serving chat completion {request.state.id} from the cache")
+
         for _ in range(0, data.n):
             gen_tasks.append(
                 asyncio.create_task(
-                    model.container.generate(
+                    _generate(
                         prompt=prompt,
                         request_id=request.state.id,
                         gen_params=data.model_copy(deep=True),
+                        cache_key=cache_key,
+                        cached_chunks=cached_chunks,
                     )
                 )
             )
@@ -386,7 +425,10 @@ async def generate_chat_completion(
         if data.tool_call_start:
             generations = await generate_tool_calls(data, generations, request)
 
-        response = _create_response(request.state.id, generations, model_path.name)
+        with start_span("serialize"):
+            response = _create_response(request.state.id, generations, model_path.name)
+
+        await record_generation_usage(request, model_path.name, generations)
 
         logger.info(f"Finished chat completion request {request.state.id}")
 
@@ -8,7 +8,7 @@ import asyncio
 import pathlib
 from asyncio import CancelledError
 from fastapi import HTTPException, Request
-from typing import List, Union
+from typing import Dict, List, Optional, Union
 
 from loguru import logger
 
@@ -23,15 +23,43 @@ from common.networking import (
     handle_request_error,
     request_disconnect_loop,
 )
+from common.response_cache import ResponseCache
+from common.single_flight import SingleFlight
+from common.tracing import current_span, start_span, traced
+from common.usage import record_generation_usage
 from config.config import config
-from common.utils import unwrap
+from common.utils import join_generations, unwrap
 from endpoints.OAI.types.completion import (
     CompletionRequest,
     CompletionResponse,
     CompletionRespChoice,
     CompletionLogProbs,
 )
-from endpoints.OAI.types.common import UsageStats
+from endpoints.OAI.types.common import UsageStats, UsageTimings
+
+
+def _create_timings(generation: dict):
+    """Create the timings of a finished generation if it reports them."""
+
+    if generation.get("prompt_time") is None:
+        return None
+
+    generated_tokens = unwrap(generation.get("generated_tokens"), 0)
+    generate_time = unwrap(generation.get("generate_time"), 0)
+    first_token_time = generation.get("first_token_time")
+
+    return UsageTimings(
+        queue_ms=round(unwrap(generation.get("queue_time"), 0) * 1000, 2),
+        prefill_ms=round(generation["prompt_time"] * 1000, 2),
+        cached_tokens=unwrap(generation.get("cached_tokens"), 0),
+        decode_ms=round(generate_time * 1000, 2),
+        tokens_per_second=(
+            round(generated_tokens / generate_time, 2) if generate_time else None
+        ),
+        time_to_first_token_ms=(
+            round(first_token_time * 1000, 2) if first_token_time is not None else None
+        ),
+    )
 
 
 def _create_response(
@@ -80,12 +108,70 @@ def _create_response(
             prompt_tokens=prompt_tokens,
             completion_tokens=completion_tokens,
             total_tokens=prompt_tokens + completion_tokens,
+            timings=_create_timings(generations[-1]),
         ),
     )
 
     return response
 
 
+async def _generate_and_store(
+    prompt: str,
+    request_id: str,
+    abort_event: Optional[asyncio.Event],
+    gen_params: BaseSamplerRequest,
+    cache_key: Optional[str] = None,
+):
+    """Runs a generation and caches it once it finishes"""
+
+    chunks = []
+
+    async for generation in model.container.generate_gen(
+        prompt=prompt,
+        request_id=request_id,
+        abort_event=abort_event,
+        gen_params=gen_params,
+    ):
+        if cache_key:
+            chunks.append(generation.copy())
+
+            # Store before yielding since consumers stop at the last chunk
+            if "finish_reason" in generation:
+                await ResponseCache.store(cache_key, chunks)
+
+        yield generation
+
+
+def _new_generation(
+    prompt: str,
+    request_id: str,
+    abort_event: Optional[asyncio.Event],
+    gen_params: BaseSamplerRequest,
+    cache_key: Optional[str] = None,
+    cached_chunks: Optional[List[dict]] = None,
+):
+    """Picks the source of a generation's chunks"""
+
+    if cached_chunks is not None:
+        return ResponseCache.replay(cached_chunks)
+
+    flight_key = SingleFlight.get_key(prompt, gen_params)
+    if flight_key is None:
+        return _generate_and_store(
+            prompt, request_id, abort_event, gen_params, cache_key
+        )
+
+    # Share the job with identical requests that are in flight
+    return SingleFlight.subscribe(
+        flight_key,
+        request_id,
+        lambda flight_abort_event: _generate_and_store(
+            prompt, request_id, flight_abort_event, gen_params, cache_key
+        ),
+        abort_event,
+    )
+
+
 async def _stream_collector(
     task_idx: int,
     gen_queue: asyncio.Queue,
@@ -93,18 +179,18 @@ async def _stream_collector(
     request_id: str,
     abort_event: asyncio.Event,
     gen_params: BaseSamplerRequest,
+    cache_key: Optional[str] = None,
+    cached_chunks: Optional[List[dict]] = None,
 ):
     """Collects a stream and places results in a common queue"""
     assert model.container is not None, "Model container not loaded"
     assert gen_params is not None
 
     try:
-        new_generation = model.container.generate_gen(
-            prompt=prompt,
-            request_id=request_id,
-            abort_event=abort_event,
-            gen_params=gen_params,
+        new_generation = _new_generation(
+            prompt, request_id, abort_event, gen_params, cache_key, cached_chunks
         )
+
         async for generation in new_generation:
             generation["index"] = task_idx
 
@@ -116,6 +202,34 @@ async def _stream_collector(
         await gen_queue.put(e)
 
 
+async def _generate(
+    prompt: str,
+    request_id: str,
+    gen_params: BaseSamplerRequest,
+    cache_key: Optional[str] = None,
+    cached_chunks: Optional[List[dict]] = None,
+):
+    """Non-streaming generation that uses the response cache and in-flight jobs"""
+
+    if (
+        cache_key is None
+        and cached_chunks is None
+        and SingleFlight.get_key(prompt, gen_params) is None
+    ):
+        return await model.container.generate(
+            prompt=prompt, request_id=request_id, gen_params=gen_params
+        )
+
+    chunks = [
+        generation
+        async for generation in _new_generation(
+            prompt, request_id, None, gen_params, cache_key, cached_chunks
+        )
+    ]
+
+    return join_generations(chunks)
+
+
 async def load_inline_model(model_name: str, request: Request):
     """Load a model from the data.model parameter"""
 
@@ -158,19 +272,31 @@ async def load_inline_model(model_name: str, request: Request):
     await model.load_model(ModelInstanceConfig(model_name=model_name))
 
 
+@traced("stream_completion")
 async def stream_generate_completion(
     data: CompletionRequest, request: Request, model_path: pathlib.Path
 ):
     """Streaming generation for completions."""
 
+    stream_span = current_span()
     abort_event = asyncio.Event()
     gen_queue = asyncio.Queue()
     gen_tasks: List[asyncio.Task] = []
     disconnect_task = asyncio.create_task(request_disconnect_loop(request))
 
+    # Latest chunk of each choice. Usage is recorded from these once the
+    # stream ends, so streams that are cut short are still accounted.
+    latest_generations: Dict[int, dict] = {}
+
     try:
         logger.info(f"Received streaming completion request {request.state.id}")
 
+        cache_key, cached_chunks = await ResponseCache.lookup(
+            request, data.prompt, data
+        )
+        if cached_chunks is not None:
+            logger.info(f"Replaying completion {request.state.id} from the cache")
+
         for n in range(0, data.n):
             task_gen_params = data.model_copy(deep=True)
 
@@ -184,6 +310,8 @@ async def stream_generate_completion(
                     request_id=request.state.id,
                     abort_event=abort_event,
                     gen_params=task_gen_params,
+                    cache_key=cache_key,
+                    cached_chunks=cached_chunks,
                 )
             )
 
@@ -203,8 +331,15 @@ async def stream_generate_completion(
             if isinstance(generation, Exception):
                 raise generation
 
-            response = _create_response(request.state.id, generation, model_path.name)
-            yield response.model_dump_json()
+            latest_generations[generation["index"]] = generation
+
+            with stream_span.timer("serialize_ms"):
+                response = _create_response(
+                    request.state.id, generation, model_path.name
+                )
+                chunk = response.model_dump_json()
+
+            yield chunk
 
             # Check if all tasks are completed
             if all(task.done() for task in gen_tasks) and gen_queue.empty():
@@ -223,8 +358,14 @@ async def stream_generate_completion(
         yield get_generator_error(
             f"Completion {request.state.id} aborted. Please check the server console."
         )
+    finally:
+        if latest_generations:
+            await record_generation_usage(
+                request, model_path.name, list(latest_generations.values())
+            )
 
 
+@traced("completion")
 async def generate_completion(
     data: CompletionRequest, request: Request, model_path: pathlib.Path
 ):
@@ -235,19 +376,30 @@ async def generate_completion(
     try:
         logger.info(f"Recieved completion request {request.state.id}")
 
+        cache_key, cached_chunks = await ResponseCache.lookup(
+            request, data.prompt, data
+        )
+        if cached_chunks is not None:
+            logger.info(f"Serving completion {request.state.id} from the cache")
+
         for _ in range(0, data.n):
             gen_tasks.append(
                 asyncio.create_task(
-                    model.container.generate(
+                    _generate(
                         prompt=data.prompt,
                         request_id=request.state.id,
                         gen_params=data.model_copy(deep=True),
+                        cache_key=cache_key,
+                        cached_chunks=cached_chunks,
                     )
                 )
             )
 
         generations = await asyncio.gather(*gen_tasks)
-        response = _create_response(request.state.id, generations, model_path.name)
+
+        with start_span("serialize"):
+            response = _create_response(request.state.id, generations, model_path.name)
+        await record_generation_usage(request, model_path.name, generations)
 
         logger.info(f"Finished completion request {request.state.id}")
 
@@ -8,57 +8,154 @@ embeddings function declared async.
 """
 
 import base64
-from fastapi import Request
+import json
+from fastapi import HTTPException, Request, Response
 import numpy as np
 from loguru import logger
+from typing import List, Tuple
 
 from common import model
+from common.utils import unwrap
+from common.networking import handle_request_error
+from common.usage import record_usage
+from config.config import config
 from endpoints.OAI.types.embedding import (
-    EmbeddingObject,
     EmbeddingsRequest,
-    EmbeddingsResponse,
     UsageInfo,
 )
 
 
-def float_list_to_base64(float_array: np.ndarray) -> str:
+def truncate_embeddings(embeddings: np.ndarray, dimensions: int) -> np.ndarray:
+    """Keeps the leading dimensions of each vector and renormalizes them."""
+
+    truncated = embeddings[:, :dimensions]
+    norms = np.linalg.norm(truncated, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return truncated / norms
+
+
+def quantize_int8(embeddings: np.ndarray) -> np.ndarray:
     """
-    Converts the provided list to a float32 array for OpenAI
-    Ex. float_array = np.array(float_list, dtype="float32")
+    Scales each vector to the int8 range.
+    Directions (and cosine similarity) are kept, magnitudes are not, since
+    the per-vector scales are not returned.
     """
 
-    # Encode raw bytes into base64
-    encoded_bytes = base64.b64encode(float_array.tobytes())
+    scale = np.abs(embeddings).max(axis=-1, keepdims=True)
+    scale[scale == 0] = 1
 
-    # Turn raw base64 encoded bytes into ASCII
-    ascii_string = encoded_bytes.decode("ascii")
-    return ascii_string
+    return np.rint(embeddings * (127 / scale)).astype(np.int8)
 
 
-async def get_embeddings(data: EmbeddingsRequest, request: Request) -> dict:
-    model_path = model.embeddings_container.model_dir
+def encode_embeddings(embeddings: np.ndarray, encoding_format: str) -> List[str]:
+    """
+    Encodes every row of an embedding matrix as a JSON value in one pass.
+    Packed formats are base64 slices of a single contiguous buffer.
+    """
 
-    logger.info(f"Recieved embeddings request {request.state.id}")
-    embedding_data = await model.embeddings_container.generate(data.input)
-
-    # OAI expects a return of base64 if the input is base64
-    embedding_object = [
-        EmbeddingObject(
-            embedding=float_list_to_base64(emb)
-            if data.encoding_format == "base64"
-            else emb.tolist(),
-            index=n,
-        )
-        for n, emb in enumerate(embedding_data.get("embeddings"))
+    if encoding_format == "float":
+        return [json.dumps(row) for row in embeddings.tolist()]
+
+    if encoding_format == "float16":
+        packed = embeddings.astype(np.float16)
+    elif encoding_format == "int8":
+        packed = quantize_int8(embeddings)
+    elif encoding_format == "binary":
+        # One sign bit per dimension, most significant bit first
+        packed = np.packbits(embeddings > 0, axis=-1)
+    else:
+        packed = embeddings
+
+    packed = np.ascontiguousarray(packed)
+    buffer = memoryview(packed).cast("B")
+    row_size = packed.itemsize * packed.shape[-1]
+
+    return [
+        '"' + base64.b64encode(buffer[start : start + row_size]).decode("ascii") + '"'
+        for start in range(0, len(buffer), row_size)
     ]
 
-    usage = embedding_data.get("usage")
-    response = EmbeddingsResponse(
-        data=embedding_object,
-        model=model_path.name,
-        usage=UsageInfo(prompt_tokens=usage, total_tokens=usage),
+
+async def get_embeddings(data: EmbeddingsRequest, request: Request) -> Response:
+    logger.info(f"Recieved embeddings request {request.state.id}")
+
+    body, usage_info = await generate_embeddings_body(data)
+    await record_usage(
+        request, model.embeddings_container.model_dir.name, usage_info.prompt_tokens
     )
 
     logger.info(f"Finished embeddings request {request.state.id}")
 
-    return response
+    return Response(content=body, media_type="application/json")
+
+
+async def generate_embeddings_body(data: EmbeddingsRequest) -> Tuple[str, UsageInfo]:
+    """Embeds the inputs of a request and returns the response JSON and usage."""
+
+    model_path = model.embeddings_container.model_dir
+
+    try:
+        embedding_data = await model.embeddings_container.generate(
+            data.input,
+            chunk_pooling=data.chunk_pooling,
+            chunk_overlap=unwrap(
+                data.chunk_overlap, config.embeddings.embeddings_chunk_overlap
+            ),
+        )
+    except ValueError as exc:
+        error_message = handle_request_error(str(exc), exc_info=False).error.message
+
+        raise HTTPException(400, error_message) from exc
+
+    embeddings = embedding_data.get("embeddings")
+    if len(embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+
+        if data.dimensions:
+            if data.dimensions > embeddings.shape[-1]:
+                error_message = handle_request_error(
+                    f"Requested {data.dimensions} dimensions, but the model "
+                    f"only returns {embeddings.shape[-1]}.",
+                    exc_info=False,
+                ).error.message
+
+                raise HTTPException(400, error_message)
+
+            embeddings = truncate_embeddings(embeddings, data.dimensions)
+
+        rows = encode_embeddings(embeddings, data.encoding_format)
+    else:
+        rows = []
+
+    usage = embedding_data.get("usage")
+    usage_info = UsageInfo(prompt_tokens=usage, total_tokens=usage)
+
+    # Only set if the embedding cache is enabled
+    cached = embedding_data.get("cached")
+    if cached is not None:
+        usage_info.cached_inputs = cached
+        usage_info.cache_hit_rate = embedding_data.get("hit_rate")
+        usage_info.cache_bytes_saved = embedding_data.get("bytes_saved")
+
+    # Per-chunk embeddings also carry the index of their chunk
+    chunk_indices = embedding_data.get("chunk_indices")
+    if chunk_indices is not None:
+        object_fields = [
+            f'"index":{index},"chunk":{chunk}' for index, chunk in chunk_indices
+        ]
+    else:
+        object_fields = [f'"index":{index}' for index in range(len(rows))]
+
+    # Write the EmbeddingsResponse JSON directly instead of a model per vector
+    embedding_objects = ",".join(
+        f'{{"object":"embedding","embedding":{row},{fields}}}'
+        for row, fields in zip(rows, object_fields, strict=True)
+    )
+    body = (
+        f'{{"object":"list","data":[{embedding_objects}],'
+        f'"model":{json.dumps(model_path.name)},'
+        f'"usage":{usage_info.model_dump_json(exclude_none=True)}}}'
+    )
+
+    return body, usage_info
@@ -0,0 +1,35 @@
+from fastapi import Request
+from loguru import logger
+
+from common import model
+from common.usage import record_usage
+from endpoints.OAI.types.embedding import UsageInfo
+from endpoints.OAI.types.rerank import RerankRequest, RerankResponse, RerankResult
+
+
+async def get_rerank(data: RerankRequest, request: Request) -> RerankResponse:
+    model_path = model.rerank_container.model_dir
+
+    logger.info(f"Recieved rerank request {request.state.id}")
+
+    indexes, scores, usage = await model.rerank_container.rerank(
+        data.query, data.documents, data.top_n
+    )
+    await record_usage(request, model_path.name, usage)
+
+    results = [
+        RerankResult(
+            index=index,
+            relevance_score=score,
+            document=data.documents[index] if data.return_documents else None,
+        )
+        for index, score in zip(indexes.tolist(), scores.tolist(), strict=True)
+    ]
+
+    logger.info(f"Finished rerank request {request.state.id}")
+
+    return RerankResponse(
+        results=results,
+        model=model_path.name,
+        usage=UsageInfo(prompt_tokens=usage, total_tokens=usage),
+    )
@@ -1,11 +1,16 @@
 import asyncio
 import pathlib
 from sys import maxsize
-from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import PlainTextResponse
+from typing import List, Optional
 from sse_starlette import EventSourceResponse
 
 from auth import AuthManager, check_admin_key, check_api_key
+from auth.rate_limit import check_rate_limit
 from auth.types import AuthPermission
+from backends.infinity.batching import EmbeddingBatchStats
+from backends.vector_store.store import VectorStore, check_vector_store
 from common import model
 from common.downloader import hf_repo_download
 from common.model import check_embeddings_container, check_model_container
@@ -14,6 +19,16 @@ from config.config import config
 from templating.templating import PromptTemplate, get_all_templates
 from common.utils import unwrap
 from common.health import HealthManager
+from common.loop_monitor import LoopLagStats, LoopMonitor, check_loop_monitor
+from common.profiler import MAX_PROFILE_SECONDS, MAX_SAMPLE_RATE, Profiler
+from common.response_cache import ResponseCache, ResponseCacheStats
+from common.usage import (
+    UsageGroup,
+    UsageLedger,
+    UsageReport,
+    check_usage_ledger,
+    record_usage,
+)
 from endpoints.core.types.auth import AuthPermissionResponse
 from endpoints.core.types.download import DownloadRequest, DownloadResponse
 from endpoints.core.types.lora import LoraList, LoraLoadRequest, LoraLoadResponse
@@ -27,6 +42,18 @@ from endpoints.core.types.model import (
 from endpoints.core.types.health import HealthCheckResponse
 from endpoints.core.types.tags import Tags
 from endpoints.core.types.template import TemplateList, TemplateSwitchRequest
+from endpoints.core.types.vector_store import (
+    VectorCollectionCard,
+    VectorCollectionCreateRequest,
+    VectorCollectionList,
+    VectorDeleteRequest,
+    VectorDeleteResponse,
+    VectorSearchRequest,
+    VectorSearchResponse,
+    VectorSearchResult,
+    VectorUpsertRequest,
+    VectorUpsertResponse,
+)
 from endpoints.core.types.token import (
     TokenDecodeRequest,
     TokenDecodeResponse,
@@ -34,6 +61,7 @@ from endpoints.core.types.token import (
     TokenEncodeResponse,
 )
 from endpoints.core.utils.lora import get_active_loras, get_lora_list
+from endpoints.core.utils.vector_store import resolve_vectors
 from endpoints.core.utils.model import (
     get_current_model,
     get_current_model_list,
@@ -364,6 +392,18 @@ async def unload_embedding_model():
     await model.unload_embedding_model()
 
 
+@router.get(
+    "/v1/model/embedding/stats",
+    dependencies=[Depends(check_admin_key), Depends(check_embeddings_container)],
+    tags=[Tags.Admin],
+)
+async def embedding_batch_stats() -> EmbeddingBatchStats:
+    """Returns the achieved batch sizes of the embedding model."""
+
+    batcher = model.embeddings_container.batcher
+    return batcher.get_stats() if batcher else EmbeddingBatchStats()
+
+
 # Encode tokens endpoint
 @router.post(
     "/v1/token/encode",
@@ -486,3 +526,232 @@ async def unload_template():
     """Unloads the currently selected template"""
 
     model.container.prompt_template = None
+
+
+# Response cache endpoints
+@router.get(
+    "/v1/cache/stats", dependencies=[Depends(check_admin_key)], tags=[Tags.Admin]
+)
+async def response_cache_stats() -> ResponseCacheStats:
+    """Returns hit and miss statistics of the response cache."""
+
+    return ResponseCache.get_stats()
+
+
+@router.post(
+    "/v1/cache/clear", dependencies=[Depends(check_admin_key)], tags=[Tags.Admin]
+)
+async def clear_response_cache():
+    """Drops every cached response."""
+
+    await ResponseCache.clear()
+
+
+# Usage ledger endpoints
+@router.get(
+    "/v1/usage",
+    dependencies=[Depends(check_admin_key), Depends(check_usage_ledger)],
+    tags=[Tags.Admin],
+)
+async def get_usage(
+    key_id: Optional[str] = None,
+    model: Optional[str] = None,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    group_by: List[UsageGroup] = Query(["key", "model"]),  # noqa: B008
+) -> UsageReport:
+    """
+    Totals recorded usage for each group of hour, key and model.
+
+    Filter by key ID, model name and Unix times from start to end.
+    """
+
+    return await UsageLedger.query(key_id, model, start, end, group_by)
+
+
+# Event loop monitor endpoints
+@router.get(
+    "/v1/loop/stats",
+    dependencies=[Depends(check_admin_key), Depends(check_loop_monitor)],
+    tags=[Tags.Admin],
+)
+async def loop_lag_stats() -> LoopLagStats:
+    """Returns the event loop lag and the stacks of recent stalls."""
+
+    return LoopMonitor.get_stats()
+
+
+# Profiling endpoints
+@router.get(
+    "/v1/debug/profile",
+    dependencies=[Depends(check_admin_key)],
+    tags=[Tags.Admin],
+    response_class=PlainTextResponse,
+)
+async def profile_server(
+    request: Request,
+    seconds: float = Query(10, gt=0, le=MAX_PROFILE_SECONDS),  # noqa: B008
+    rate: int = Query(100, gt=0, le=MAX_SAMPLE_RATE),  # noqa: B008
+):
+    """
+    Samples the stacks of every thread for a number of seconds.
+
+    Returns collapsed stacks for flamegraph.pl, inferno or speedscope.
+    Each line is a stack from the thread name to the leaf and its sample count.
+    """
+
+    profile_task = asyncio.create_task(Profiler.profile(seconds, rate))
+    collapsed_stacks = await run_with_request_disconnect(
+        request,
+        profile_task,
+        f"Profile {request.state.id} cancelled by user.",
+    )
+
+    return PlainTextResponse(
+        collapsed_stacks,
+        headers={"Content-Disposition": 'attachment; filename="profile.folded"'},
+    )
+
+
+# Vector store endpoints
+def _collection_card(collection):
+    return VectorCollectionCard(
+        id=collection.name,
+        dimensions=collection.dimensions,
+        metric=collection.metric,
+        index=collection.index_type,
+        count=collection.count,
+    )
+
+
+@router.get(
+    "/v1/vectors/collections",
+    dependencies=[Depends(check_api_key), Depends(check_vector_store)],
+    tags=[Tags.Vectors],
+)
+async def list_vector_collections() -> VectorCollectionList:
+    """Lists all vector collections."""
+
+    return VectorCollectionList(
+        data=[
+            _collection_card(collection)
+            for collection in VectorStore.collections.values()
+        ]
+    )
+
+
+@router.post(
+    "/v1/vectors/collections",
+    dependencies=[Depends(check_admin_key), Depends(check_vector_store)],
+    tags=[Tags.Vectors],
+)
+async def create_vector_collection(
+    data: VectorCollectionCreateRequest,
+) -> VectorCollectionCard:
+    """Creates an empty vector collection."""
+
+    try:
+        collection = VectorStore.create(
+            data.name, data.metric, data.index, data.dimensions
+        )
+    except ValueError as exc:
+        error_message = handle_request_error(str(exc), exc_info=False).error.message
+
+        raise HTTPException(400, error_message) from exc
+
+    return _collection_card(collection)
+
+
+@router.delete(
+    "/v1/vectors/collections/{name}",
+    dependencies=[Depends(check_admin_key), Depends(check_vector_store)],
+    tags=[Tags.Vectors],
+)
+async def drop_vector_collection(name: str):
+    """Deletes a vector collection and its saved files."""
+
+    await VectorStore.drop(name)
+
+
+@router.post(
+    "/v1/vectors/collections/{name}/upsert",
+    dependencies=[
+        Depends(check_api_key),
+        Depends(check_rate_limit),
+        Depends(check_vector_store),
+    ],
+    tags=[Tags.Vectors],
+)
+async def upsert_vectors(
+    request: Request, name: str, data: VectorUpsertRequest
+) -> VectorUpsertResponse:
+    """Inserts or replaces vectors, embedding texts with the loaded model."""
+
+    collection = VectorStore.get(name)
+    vectors, usage = await resolve_vectors(
+        [item.vector for item in data.items], [item.text for item in data.items]
+    )
+    if usage:
+        await record_usage(request, model.embeddings_container.model_dir.name, usage)
+
+    try:
+        await asyncio.to_thread(
+            collection.upsert,
+            [item.id for item in data.items],
+            vectors,
+            [item.metadata for item in data.items],
+        )
+    except ValueError as exc:
+        error_message = handle_request_error(str(exc), exc_info=False).error.message
+
+        raise HTTPException(400, error_message) from exc
+
+    return VectorUpsertResponse(upserted=len(data.items), count=collection.count)
+
+
+@router.post(
+    "/v1/vectors/collections/{name}/delete",
+    dependencies=[Depends(check_api_key), Depends(check_vector_store)],
+    tags=[Tags.Vectors],
+)
+async def delete_vectors(name: str, data: VectorDeleteRequest) -> VectorDeleteResponse:
+    """Removes vectors by ID."""
+
+    collection = VectorStore.get(name)
+    deleted = await asyncio.to_thread(collection.delete, data.ids)
+
+    return VectorDeleteResponse(deleted=deleted, count=collection.count)
+
+
+@router.post(
+    "/v1/vectors/collections/{name}/search",
+    dependencies=[
+        Depends(check_api_key),
+        Depends(check_rate_limit),
+        Depends(check_vector_store),
+    ],
+    tags=[Tags.Vectors],
+)
+async def search_vectors(
+    request: Request, name: str, data: VectorSearchRequest
+) -> VectorSearchResponse:
+    """Finds the closest vectors to a vector or an embedded text."""
+
+    collection = VectorStore.get(name)
+    query, usage = await resolve_vectors([data.vector], [data.text])
+    if usage:
+        await record_usage(request, model.embeddings_container.model_dir.name, usage)
+
+    try:
+        results = await asyncio.to_thread(collection.search, query[0], data.top_k)
+    except ValueError as exc:
+        error_message = handle_request_error(str(exc), exc_info=False).error.message
+
+        raise HTTPException(400, error_message) from exc
+
+    return VectorSearchResponse(
+        data=[
+            VectorSearchResult(id=item_id, score=score, metadata=metadata)
+            for item_id, score, metadata in results
+        ]
+    )
@@ -10,3 +10,4 @@ class Tags(str, Enum):
     Tokenisation = "Tokenisation"
     Core = "Core"
     Auth = "Auth"
+    Vectors = "Vectors"
@@ -0,0 +1,119 @@
+"""Vector store types"""
+
+from pydantic import BaseModel, Field, model_validator
+from typing import List, Literal, Optional
+
+
+class VectorCollectionCreateRequest(BaseModel):
+    """Represents a vector collection create request."""
+
+    name: str = Field(
+        ..., description="Letters, digits, underscores and dashes (max 64)."
+    )
+    dimensions: Optional[int] = Field(
+        None, gt=0, description="Inferred from the first upsert if not provided."
+    )
+    metric: Literal["cosine", "dot", "l2"] = "cosine"
+    index: Literal["auto", "flat", "ivf"] = Field(
+        "auto",
+        description=(
+            "flat always searches exactly, ivf always clusters the vectors and "
+            "auto switches to ivf once the collection is large."
+        ),
+    )
+
+
+class VectorCollectionCard(BaseModel):
+    """Represents a single vector collection."""
+
+    id: str
+    object: str = "vector_collection"
+    dimensions: Optional[int] = None
+    metric: str
+    index: str
+    count: int = 0
+
+
+class VectorCollectionList(BaseModel):
+    """Represents a list of vector collections."""
+
+    object: str = "list"
+    data: List[VectorCollectionCard] = Field(default_factory=list)
+
+
+class VectorItem(BaseModel):
+    """Represents a vector to upsert, given directly or as text to embed."""
+
+    id: str
+    vector: Optional[List[float]] = None
+    text: Optional[str] = Field(
+        None, description="Embedded with the loaded embedding model."
+    )
+    metadata: Optional[dict] = None
+
+    @model_validator(mode="after")
+    def check_vector_or_text(self):
+        if (self.vector is None) == (self.text is None):
+            raise ValueError("Provide either a vector or a text for each item.")
+
+        return self
+
+
+class VectorUpsertRequest(BaseModel):
+    """Represents a vector upsert request."""
+
+    items: List[VectorItem]
+
+
+class VectorUpsertResponse(BaseModel):
+    """Represents a vector upsert response."""
+
+    upserted: int
+    count: int
+
+
+class VectorDeleteRequest(BaseModel):
+    """Represents a vector delete request."""
+
+    ids: List[str]
+
+
+class VectorDeleteResponse(BaseModel):
+    """Represents a vector delete response."""
+
+    deleted: int
+    count: int
+
+
+class VectorSearchRequest(BaseModel):
+    """Represents a vector search request with a vector or text query."""
+
+    vector: Optional[List[float]] = None
+    text: Optional[str] = Field(
+        None, description="Embedded with the loaded embedding model."
+    )
+    top_k: int = Field(10, gt=0)
+
+    @model_validator(mode="after")
+    def check_vector_or_text(self):
+        if (self.vector is None) == (self.text is None):
+            raise ValueError("Provide either a vector or a text to search with.")
+
+        return self
+
+
+class VectorSearchResult(BaseModel):
+    """Represents a single search result."""
+
+    id: str
+    score: float = Field(
+        ..., description="Higher is closer. Negated squared distance for l2."
+    )
+    metadata: Optional[dict] = None
+
+
+class VectorSearchResponse(BaseModel):
+    """Represents a vector search response."""
+
+    object: str = "list"
+    data: List[VectorSearchResult] = Field(default_factory=list)
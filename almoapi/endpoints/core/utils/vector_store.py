@@ -0,0 +1,51 @@
+from typing import List, Optional
+
+import numpy as np
+from fastapi import HTTPException
+
+from common import model
+from common.networking import handle_request_error
+
+
+async def resolve_vectors(
+    vectors: List[Optional[List[float]]], texts: List[Optional[str]]
+):
+    """
+    Builds a matrix from given vectors, embedding texts where provided.
+    Returns the matrix and the prompt tokens used to embed the texts.
+    """
+
+    text_positions = [
+        position for position, text in enumerate(texts) if text is not None
+    ]
+
+    embedded = []
+    usage = 0
+    if text_positions:
+        if model.embeddings_container is None or not model.embeddings_container.engine:
+            error_message = handle_request_error(
+                "Texts can't be embedded since no embedding model is loaded.",
+                exc_info=False,
+            ).error.message
+
+            raise HTTPException(400, error_message)
+
+        embedding_data = await model.embeddings_container.generate(
+            [texts[position] for position in text_positions]
+        )
+        embedded = embedding_data.get("embeddings")
+        usage = embedding_data.get("usage")
+
+    rows = list(vectors)
+    for position, embedding in zip(text_positions, embedded, strict=True):
+        rows[position] = embedding
+
+    try:
+        return np.asarray(rows, dtype=np.float32).reshape(len(rows), -1), usage
+    except ValueError as exc:
+        error_message = handle_request_error(
+            "All vectors must have the same number of dimensions.",
+            exc_info=False,
+        ).error.message
+
+        raise HTTPException(400, error_message) from exc
@@ -1,7 +1,10 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from common.capture import CaptureMiddleware
 from common.networking import get_global_depends
+from common.tracing import TracingMiddleware
+from config.config import config
 from endpoints.OAI import router as OAIRouter
 from endpoints.core.router import router as CoreRouter
 
@@ -29,6 +32,14 @@ def setup_app(lifespan=None):
         allow_headers=["*"],
     )
 
+    # Record sampled requests for replay workloads
+    if config.capture.enable:
+        app.add_middleware(CaptureMiddleware)
+
+    # Trace requests, outermost so the span covers the whole response
+    if config.tracing.enable:
+        app.add_middleware(TracingMiddleware)
+
     app.include_router(OAIRouter.setup())
 
     # Include core API request paths
@@ -8,17 +8,33 @@ from loguru import logger
 
 from auth import AuthManager
 from common import gen_logging, model
+from common.batches import Batches
+from common.capture import TrafficCapture
+from common.loop_monitor import LoopMonitor
+from common.tracing import Tracer
+from common.usage import UsageLedger
 from common.actions import branch_to_actions
 from config.config import config
 from endpoints.server import setup_app
 
 from backends.exllamav2.version import check_exllama_version
+from backends.vector_store.store import VectorStore
 
 
 async def startup():
     """Async entry function for program startup"""
 
     gen_logging.broadcast_status()
+    gen_logging.GenerationLogger.start()
+
+    if config.capture.enable:
+        TrafficCapture.start()
+
+    if config.tracing.enable:
+        Tracer.start()
+
+    if config.loop_monitor.enable:
+        LoopMonitor.start()
 
     # If an initial model name is specified, create a container
     # and load the model
@@ -51,14 +67,65 @@ async def startup():
         except ImportError as ex:
             logger.error(ex.msg)
 
+    # Rerankers are cross-encoders, so they get their own container
+    reranker_model_name = config.embeddings.reranker_model_name
+    if reranker_model_name:
+        reranker_model_path = pathlib.Path(config.embeddings.embedding_model_dir)
+        reranker_model_path = reranker_model_path / reranker_model_name
+
+        try:
+            await model.load_rerank_model(
+                reranker_model_path, **config.embeddings.model_dump()
+            )
+        except ImportError as ex:
+            logger.error(ex.msg)
+        except ValueError as ex:
+            logger.error(str(ex))
+
+    # Open saved vector collections
+    if config.vector_store.enable:
+        await VectorStore.load()
+
+    # Open the usage ledger
+    if config.usage.enable:
+        await UsageLedger.load()
+
+    # Resume unfinished batches
+    if config.batches.enable:
+        await Batches.load()
+
 
 async def shutdown():
+    # Stop batches first, or their pending requests fail once the models unload
+    if config.batches.enable:
+        await Batches.shutdown()
+
     if model.container:
         await model.unload_model(skip_wait=True, shutdown=True)
 
     if model.embeddings_container:
         await model.unload_embedding_model()
 
+    if model.rerank_container:
+        await model.unload_rerank_model()
+
+    if config.vector_store.enable:
+        await VectorStore.shutdown()
+
+    if config.capture.enable:
+        TrafficCapture.stop()
+
+    if config.usage.enable:
+        await UsageLedger.shutdown()
+
+    if config.tracing.enable:
+        Tracer.stop()
+
+    if config.loop_monitor.enable:
+        LoopMonitor.stop()
+
+    gen_logging.GenerationLogger.stop()
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
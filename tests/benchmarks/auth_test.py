@@ -0,0 +1,46 @@
+"""Benchmarks for the per-request API key check."""
+
+from pydantic import SecretStr
+
+from auth.simple_auth_provider import SimpleAuthProvider
+from auth.types import AuthPermission
+from auth.utils import get_test_key
+
+
+def make_provider():
+    provider = SimpleAuthProvider()
+    provider.tokens = {f"{index:032x}": AuthPermission.api for index in range(1000)} | {
+        "admin": AuthPermission.admin
+    }
+
+    return provider
+
+
+def test_simple_auth_lookup(benchmark, event_loop_runner):
+    """Parsing a bearer header and authenticating it, as check_api_key does."""
+
+    provider = make_provider()
+    header = SecretStr(f"Bearer {500:032x}")
+
+    def run():
+        test_key = get_test_key(header)
+        return event_loop_runner(
+            provider.authenticate(test_key, AuthPermission.api, AuthPermission.admin)
+        )
+
+    assert benchmark(run)
+
+
+def test_simple_auth_miss(benchmark, event_loop_runner):
+    """Rejecting an unknown key."""
+
+    provider = make_provider()
+    header = SecretStr("Bearer unknown")
+
+    def run():
+        test_key = get_test_key(header)
+        return event_loop_runner(
+            provider.authenticate(test_key, AuthPermission.api, AuthPermission.admin)
+        )
+
+    assert not benchmark(run)
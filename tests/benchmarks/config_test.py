@@ -0,0 +1,25 @@
+"""Benchmarks for loading and validating the config."""
+
+from config.config import TabbyConfig, generate_config_file
+from config.models import TabbyConfigModel
+
+
+def test_config_from_file(benchmark, tmp_path):
+    """Parsing the full sample config from YAML."""
+
+    config_path = tmp_path / "config.yml"
+    generate_config_file(filename=config_path)
+
+    loaded = benchmark(TabbyConfig()._from_file, config_path)
+
+    assert "model" in loaded
+
+
+def test_config_validation(benchmark, tmp_path):
+    """Validating a parsed config into the config models."""
+
+    config_path = tmp_path / "config.yml"
+    generate_config_file(filename=config_path)
+    loaded = TabbyConfig()._from_file(config_path)
+
+    benchmark(lambda: TabbyConfigModel(**loaded))
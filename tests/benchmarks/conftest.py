@@ -0,0 +1,120 @@
+"""
+Shared fixtures for the CPU micro-benchmarks.
+
+Run with pytest-benchmark from the repository root:
+    pytest tests/benchmarks --benchmark-storage=tests/benchmarks/baselines
+
+Compare against the stored baseline and fail on regressions with:
+    pytest tests/benchmarks --benchmark-storage=tests/benchmarks/baselines \
+        --benchmark-compare=0001 --benchmark-compare-fail=mean:20%
+"""
+
+import asyncio
+import pathlib
+import sys
+
+import pytest
+
+REPO_DIR = pathlib.Path(__file__).parents[2]
+sys.path.insert(0, str(REPO_DIR / "almoapi"))
+
+# Import in the same order as main.py, since config and auth import each other
+import auth  # noqa: E402, F401
+from backends.exllamav2.vocab import TokenVocabulary  # noqa: E402
+
+TEMPLATES_DIR = REPO_DIR / "templates"
+
+EOS_TOKEN_ID = 0
+
+
+@pytest.fixture(scope="session")
+def event_loop_runner():
+    """Runs coroutines on one loop, so loop creation isn't measured."""
+
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def long_transcript():
+    """A chat of 201 messages of a few sentences each, ending with the user."""
+
+    sentence = "The quick brown fox jumps over the lazy dog near the river bank. "
+
+    return [
+        {
+            "role": "user" if index % 2 == 0 else "assistant",
+            "content": f"Message {index}. " + sentence * (3 + index % 5),
+        }
+        for index in range(201)
+    ]
+
+
+def build_toy_pieces():
+    """Token pieces resembling a small BPE vocabulary."""
+
+    pieces = ["</s>"]
+
+    # Every printable ASCII character, so any text can be spelled out
+    pieces.extend(chr(code) for code in range(32, 127))
+    pieces.extend(["\n", "\t", "\\n", '\\"'])
+
+    # JSON punctuation fused with whitespace and quotes
+    pieces.extend(
+        ['{"', '"}', '":', '",', '":"', '", "', '": "', "{\n", "}\n", "[]", "{}"]
+    )
+    pieces.extend(["true", "false", "null", "  ", "    ", "\n  ", "\n    "])
+
+    # Digits and short numbers
+    pieces.extend(str(number) for number in range(1000))
+
+    # Words with and without a leading space
+    words = (
+        "the of and to in is that for it as with was on be by at this from or "
+        "name age city country value type items list id title description "
+        "quick brown fox jumps over lazy dog river bank message user assistant "
+        "system content role function call result error status data count"
+    ).split()
+    for word in words:
+        pieces.extend([word, " " + word, word.capitalize(), " " + word.capitalize()])
+
+    # Letter pairs fill the vocabulary out to a realistic size
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    pieces.extend(first + second for first in letters for second in letters)
+    pieces.extend(" " + first + second for first in letters for second in letters)
+
+    return list(dict.fromkeys(pieces))
+
+
+@pytest.fixture(scope="session")
+def toy_pieces():
+    return build_toy_pieces()
+
+
+@pytest.fixture(scope="session")
+def toy_vocab(toy_pieces):
+    return TokenVocabulary(
+        toy_pieces, eos_token_ids=[EOS_TOKEN_ID], excluded_ids={EOS_TOKEN_ID}
+    )
+
+
+def tokenize(pieces, text: str):
+    """Greedy longest-match tokenization with the toy vocabulary."""
+
+    piece_ids = {piece: token_id for token_id, piece in enumerate(pieces)}
+    longest = max(len(piece) for piece in pieces)
+
+    token_ids = []
+    position = 0
+    while position < len(text):
+        for length in range(min(longest, len(text) - position), 0, -1):
+            token_id = piece_ids.get(text[position : position + length])
+            if token_id is not None and token_id != EOS_TOKEN_ID:
+                token_ids.append(token_id)
+                position += length
+                break
+        else:
+            raise ValueError(f"Can't tokenize {text[position]!r}")
+
+    return token_ids
@@ -0,0 +1,204 @@
+"""Benchmarks for constrained decoding with a toy tokenizer."""
+
+import json
+
+import pytest
+from lmformatenforcer import JsonSchemaParser, TokenEnforcer
+from lmformatenforcer import TokenEnforcerTokenizerData
+
+from backends.exllamav2.ebnf import CfgEngine, Grammar
+from backends.exllamav2.json_mode import INITIAL_STATE, JsonModeEngine
+from backends.exllamav2.regex_dfa import RegexEngine
+
+from conftest import EOS_TOKEN_ID, tokenize
+
+JSON_OUTPUT = (
+    '{"name": "quick brown fox", "age": 12, "city": "river bank", '
+    '"items": [1, 2, 3], "status": true, "description": null}'
+)
+
+JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "age": {"type": "integer"},
+        "city": {"type": "string"},
+    },
+    "required": ["name", "age", "city"],
+}
+
+REGEX_PATTERN = r"[A-Z][a-z]+ (is|was) [0-9]{1,3} (years|days) old\."
+
+REGEX_OUTPUT = "Fox was 12 days old."
+
+EBNF_GRAMMAR = """
+start: sentence+
+sentence: subject " " verb " " object "."
+subject: "The fox" | "The dog"
+verb: "jumps over" | "runs to"
+object: "the river" | "the bank"
+"""
+
+EBNF_OUTPUT = "The fox jumps over the river.The dog runs to the bank."
+
+JSON_SAMPLES = [
+    JSON_OUTPUT,
+    json.dumps(
+        {"user": {"name": "fox", "items": [[1, 2], {"id": -0.5e3}], "data": {}}},
+        indent=4,
+    ),
+    '{"a": [], "b": {}, "c": "\\"quoted\\"\\n", "d": -12.5E+3}',
+    '{"a": "\\u00e9", "b": [true, false, null]}\n',
+    "{}",
+    '{"a": 1,}',
+    '{"a": [1, 2}',
+    '{"a": 01}',
+    '{"a": 1.}',
+    '{"a": tru}',
+    "{'a': 1}",
+    '{"a": "\\x"}',
+    '{"a": NaN}',
+    '{"a" 1}',
+    '{"a": 1}}',
+    "[1, 2]",
+    '"text"',
+]
+
+
+def run_engine(engine, initial_state, token_ids):
+    """Feeds tokens like a filter, computing the mask before every token."""
+
+    state = initial_state
+    for token_id in token_ids:
+        engine.get_mask(state)
+        state = engine.advance(state, token_id)
+
+    return engine.get_mask(state)
+
+
+def test_json_mode_engine_build(benchmark, toy_vocab):
+    """Precomputing the token classes of the JSON mode engine."""
+
+    benchmark(JsonModeEngine, toy_vocab)
+
+
+def test_json_mode_next(benchmark, toy_pieces, toy_vocab):
+    """Masks for every token of a JSON object, with a warm cache."""
+
+    engine = JsonModeEngine(toy_vocab)
+    token_ids = tokenize(toy_pieces, JSON_OUTPUT)
+
+    mask = benchmark(run_engine, engine, INITIAL_STATE, token_ids)
+
+    assert EOS_TOKEN_ID in mask.allowed
+
+
+def json_mode_accepts(engine, token_ids):
+    """Whether JSON mode allows every token and then EOS."""
+
+    state = INITIAL_STATE
+    for token_id in token_ids:
+        if token_id not in engine.get_mask(state).allowed:
+            return False
+
+        state = engine.advance(state, token_id)
+
+    return EOS_TOKEN_ID in engine.get_mask(state).allowed
+
+
+def reject_constant(name):
+    raise ValueError(f"{name} is not valid JSON")
+
+
+def is_json_object(text):
+    """Whether json.loads parses text as an object, without NaN or Infinity."""
+
+    try:
+        return isinstance(json.loads(text, parse_constant=reject_constant), dict)
+    except ValueError:
+        return False
+
+
+@pytest.mark.parametrize("text", JSON_SAMPLES)
+def test_json_mode_matches_json_loads(toy_pieces, toy_vocab, text):
+    """JSON mode accepts exactly the samples that parse as JSON objects."""
+
+    engine = JsonModeEngine(toy_vocab)
+    token_ids = tokenize(toy_pieces, text)
+
+    assert json_mode_accepts(engine, token_ids) == is_json_object(text)
+
+
+def test_regex_compile(benchmark, toy_vocab):
+    """Compiling a regex into a token-level table."""
+
+    benchmark(RegexEngine.compile, REGEX_PATTERN, toy_vocab)
+
+
+def test_regex_next(benchmark, toy_pieces, toy_vocab):
+    """Masks for every token of a regex match."""
+
+    engine = RegexEngine.compile(REGEX_PATTERN, toy_vocab)
+    token_ids = tokenize(toy_pieces, REGEX_OUTPUT)
+
+    mask = benchmark(run_engine, engine, 0, token_ids)
+
+    assert EOS_TOKEN_ID in mask.allowed
+
+
+def test_ebnf_build(benchmark, toy_vocab):
+    """Parsing a grammar and building its engine."""
+
+    benchmark(lambda: CfgEngine(Grammar(EBNF_GRAMMAR), toy_vocab))
+
+
+def test_ebnf_next(benchmark, toy_pieces, toy_vocab):
+    """Masks for every token of a grammar match."""
+
+    engine = CfgEngine(Grammar(EBNF_GRAMMAR), toy_vocab)
+    token_ids = tokenize(toy_pieces, EBNF_OUTPUT)
+
+    mask = benchmark(run_engine, engine, engine.initial_state, token_ids)
+
+    assert EOS_TOKEN_ID in mask.allowed
+
+
+@pytest.fixture(scope="module")
+def lmfe_tokenizer_data(toy_pieces):
+    regular_tokens = [
+        (token_id, piece, piece.startswith(" "))
+        for token_id, piece in enumerate(toy_pieces)
+        if token_id != EOS_TOKEN_ID
+    ]
+
+    return TokenEnforcerTokenizerData(
+        regular_tokens,
+        lambda token_ids: "".join(toy_pieces[token_id] for token_id in token_ids),
+        EOS_TOKEN_ID,
+        use_bitmask=False,
+        vocab_size=len(toy_pieces),
+    )
+
+
+def test_lmfe_schema_filter_build(benchmark, lmfe_tokenizer_data):
+    """Creating the LMFE enforcer used for JSON schemas."""
+
+    benchmark(lambda: TokenEnforcer(lmfe_tokenizer_data, JsonSchemaParser(JSON_SCHEMA)))
+
+
+def test_lmfe_schema_filter_next(benchmark, toy_pieces, lmfe_tokenizer_data):
+    """Allowed tokens for every prefix of a schema-conforming object."""
+
+    token_ids = tokenize(toy_pieces, '{"name": "fox", "age": 12, "city": "river bank"}')
+
+    # LMFE caches prefixes per enforcer, so each round gets a new one
+    def run():
+        enforcer = TokenEnforcer(lmfe_tokenizer_data, JsonSchemaParser(JSON_SCHEMA))
+        for length in range(len(token_ids) + 1):
+            allowed = enforcer.get_allowed_tokens(token_ids[:length])
+
+        return allowed
+
+    allowed = benchmark(run)
+
+    assert EOS_TOKEN_ID in allowed.allowed_tokens
@@ -0,0 +1,27 @@
+"""Benchmarks for converting sampled token probabilities to logprobs."""
+
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+model = pytest.importorskip("backends.exllamav2.model")
+
+
+def test_get_logprobs(benchmark, toy_pieces):
+    """Top 10 logprobs of one token, as requested with logprobs=10."""
+
+    tokenizer = SimpleNamespace(
+        extended_id_to_piece={0: toy_pieces[0]},
+        get_id_to_piece_list=lambda include_special_tokens=False: toy_pieces,
+    )
+    container = SimpleNamespace(tokenizer=tokenizer)
+
+    token_ids = torch.arange(10, 20).reshape(1, 1, 10)
+    token_probs = torch.full((1, 1, 10), 0.1)
+
+    logprobs = benchmark(
+        model.ExllamaV2Container.get_logprobs, container, token_ids, token_probs
+    )
+
+    assert len(logprobs) == 10
@@ -0,0 +1,81 @@
+"""Benchmarks for building and serializing response objects."""
+
+from endpoints.OAI.utils.chat_completion import (
+    _create_response as create_chat_completion_response,
+    _create_stream_chunk,
+)
+from endpoints.OAI.utils.completion import (
+    _create_response as create_completion_response,
+)
+
+TOP_LOGPROBS = {f" token{index}": -0.5 * index for index in range(5)}
+
+
+def make_generation(text: str, with_logprobs: bool):
+    generation = {
+        "text": text,
+        "index": 0,
+        "prompt_tokens": 512,
+        "generated_tokens": 128,
+        "tool_calls": None,
+    }
+
+    if with_logprobs:
+        generation["token_probs"] = {" token0": -0.01}
+        generation["logprobs"] = TOP_LOGPROBS
+        generation["offset"] = 0
+
+    return generation
+
+
+def test_stream_chunk(benchmark):
+    """One streamed chat completion token, as sent over SSE."""
+
+    generation = make_generation(" token", with_logprobs=False)
+
+    benchmark(
+        lambda: _create_stream_chunk("request", generation, "model").model_dump_json()
+    )
+
+
+def test_stream_chunk_with_logprobs(benchmark):
+    """One streamed chat completion token with its top logprobs."""
+
+    generation = make_generation(" token0", with_logprobs=True)
+
+    benchmark(
+        lambda: _create_stream_chunk("request", generation, "model").model_dump_json()
+    )
+
+
+def test_chat_completion_response(benchmark):
+    """A finished chat completion with a long message."""
+
+    generation = make_generation("word " * 500, with_logprobs=False)
+    generation["finish_reason"] = "stop"
+
+    benchmark(
+        lambda: create_chat_completion_response(
+            "request", [generation], "model"
+        ).model_dump_json()
+    )
+
+
+def test_completion_response_with_logprobs(benchmark):
+    """A finished completion with logprobs for every token."""
+
+    generation = {
+        "text": " token0" * 128,
+        "prompt_tokens": 512,
+        "generated_tokens": 128,
+        "finish_reason": "stop",
+        "token_probs": {f" token{index}": -0.01 for index in range(128)},
+        "logprobs": [TOP_LOGPROBS] * 128,
+        "offset": list(range(128)),
+    }
+
+    benchmark(
+        lambda: create_completion_response(
+            "request", generation, "model"
+        ).model_dump_json()
+    )
@@ -0,0 +1,66 @@
+"""Benchmarks for chat template rendering."""
+
+from types import SimpleNamespace
+
+from common import model
+from endpoints.OAI.types.chat_completion import ChatCompletionRequest
+from endpoints.OAI.utils.chat_completion import format_prompt_with_template
+from templating.templating import PromptTemplate
+
+from conftest import TEMPLATES_DIR
+
+SPECIAL_TOKENS = {
+    "bos_token": "<s>",
+    "eos_token": "</s>",
+    "pad_token": "",
+    "unk_token": "<unk>",
+}
+
+
+def load_template(name: str):
+    raw_template = (TEMPLATES_DIR / f"{name}.jinja").read_text(encoding="utf8")
+    return PromptTemplate(name, raw_template)
+
+
+def test_render_long_transcript(benchmark, event_loop_runner, long_transcript):
+    """PromptTemplate.render on a 200 message chat."""
+
+    template = load_template("chatml")
+    template_vars = {
+        "messages": long_transcript,
+        "add_generation_prompt": True,
+        **SPECIAL_TOKENS,
+    }
+
+    prompt = benchmark(lambda: event_loop_runner(template.render(template_vars)))
+
+    assert prompt.count("<|im_start|>") == len(long_transcript) + 1
+
+
+def test_format_prompt_with_template(benchmark, event_loop_runner, long_transcript):
+    """The full prompt preparation of a chat completion request."""
+
+    template = load_template("chatml")
+    container = SimpleNamespace(
+        prompt_template=template,
+        get_special_tokens=lambda add_bos_token, ban_eos_token: SPECIAL_TOKENS,
+    )
+
+    # Requests are changed in place, so each round gets a new one
+    def setup():
+        request = ChatCompletionRequest(messages=long_transcript, max_tokens=16)
+        return (request,), {}
+
+    previous_container = getattr(model, "container", None)
+    model.container = container
+
+    try:
+        prompt = benchmark.pedantic(
+            lambda request: event_loop_runner(format_prompt_with_template(request)),
+            setup=setup,
+            rounds=200,
+        )
+    finally:
+        model.container = previous_container
+
+    assert prompt.endswith("<|im_start|>assistant\n")
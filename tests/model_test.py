@@ -1,45 +1,94 @@
 """Test the model container."""
 
-from backends.exllamav2.model import ModelContainer
+import asyncio
+import os
+import pathlib
+
+import pytest
+
+pytest.importorskip("exllamav2")
+
+from backends.exllamav2.model import ExllamaV2Container  # noqa: E402
+from backends.exllamav2.types import (  # noqa: E402
+    DraftModelInstanceConfig,
+    ModelInstanceConfig,
+)
+from config.config import config  # noqa: E402
+from endpoints.OAI.types.completion import CompletionRequest  # noqa: E402
+
+
+@pytest.fixture
+def model_path():
+    """Path of an exl2 model, set with the ALMOAPI_TEST_MODEL env var."""
+
+    path = os.getenv("ALMOAPI_TEST_MODEL")
+    if not path:
+        pytest.skip("ALMOAPI_TEST_MODEL is not set")
+
+    return path
+
+
+async def create_container(model_path):
+    """Creates a container for a model path outside of the model dir."""
+
+    model_path = pathlib.Path(model_path)
+    config.model.model_dir = model_path.parent
+
+    return await ExllamaV2Container.create(
+        model=ModelInstanceConfig(model_name=model_path.name),
+        draft=DraftModelInstanceConfig(),
+    )
 
 
 def progress(module, modules):
     """Wrapper callback for load progress."""
-    yield module, modules
+    print(module, modules)
 
 
-def test_load_gen(model_path):
-    """Test loading a model."""
-    container = ModelContainer(model_path)
-    loader = container.load_gen(progress)
-    for module, modules in loader:
+async def load_gen(model_path):
+    container = await create_container(model_path)
+    async for module, modules in container.load_gen(progress):
         print(module, modules)
-    container.unload()
-    del container
+    await container.unload()
 
 
-def test_generate_gen(model_path):
-    """Test generating from a model."""
-    container = ModelContainer(model_path)
-    generator = container.generate_gen("Once upon a tim", token_healing=True)
-    for chunk in generator:
-        print(chunk, end="")
-    container.unload()
-    del container
+async def generate_gen(model_path):
+    container = await create_container(model_path)
+    await container.load(progress)
+    gen_params = CompletionRequest(prompt="Once upon a tim", max_tokens=100)
+    async for chunk in container.generate_gen(
+        "Once upon a tim", "test", gen_params=gen_params
+    ):
+        print(chunk.get("text", ""), end="")
+    await container.unload()
 
 
-def test_generate(model_path):
-    """Test generating from a model."""
-    model_container = ModelContainer(model_path)
-    model_container.load(progress)
+async def generate(model_path):
+    container = await create_container(model_path)
+    await container.load(progress)
     prompt = (
         "All work and no play makes turbo a derpy cat.\n"
         "All work and no play makes turbo a derpy cat.\nAll"
     )
-    response = model_container.generate(
-        prompt, top_k=1, max_new_tokens=1000, stream_interval=0.5
-    )
+    gen_params = CompletionRequest(prompt=prompt, top_k=1, max_tokens=1000)
+    response = await container.generate(gen_params, prompt, "test")
     print(response)
+    await container.unload()
+
+
+def test_load_gen(model_path):
+    """Test loading a model."""
+    asyncio.run(load_gen(model_path))
+
+
+def test_generate_gen(model_path):
+    """Test generating from a model."""
+    asyncio.run(generate_gen(model_path))
+
+
+def test_generate(model_path):
+    """Test generating from a model."""
+    asyncio.run(generate(model_path))
 
 
 if __name__ == "__main__":